@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+"""
+CT Resampling Benchmark for MC-DCaRE
+====================================
+
+Re-runs a finished DICOM simulation on the clinical CT and on the CT resampled to each given voxel size, then reports
+the simulation speedup against the dose difference. The resampled doses are compared with the clinical dose averaged
+onto the same coarse grid.
+
+Usage:
+    python benchmark_ct_resampling.py runfolder/2025-01-01_12-00-00 --voxel-sizes 2 3 4
+    python benchmark_ct_resampling.py runfolder/2025-01-01_12-00-00 --voxel-sizes 2.5 --crop
+
+Output:
+    runfolder/resampling_benchmark_YYYY-MM-DD_HH-MM-SS/
+    - resampling_benchmark.csv: One row per voxel size with wall time, speedup and dose differences
+    - native/, 2mm/, ...: Run folder of every simulation
+"""
+
+import argparse
+import csv
+import os
+import time
+from datetime import datetime
+
+import numpy as np
+
+from src.defaultvalues import *
+from src.ct_resampling import CtResampling, dose_difference
+from src.dose_analysis import DoseGrid, run_dose_file
+from src.runtime_handler import log_output
+from src.topas_parameters import TopasParameterFile
+
+BENCHMARK_CSV = 'resampling_benchmark.csv'
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark DICOM simulations on resampled CT against the clinical CT",
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    parser.add_argument('reference', help='Run folder of a DICOM simulation (headsourcecode.txt, patientDICOM.txt, ...)')
+    parser.add_argument('--voxel-sizes', nargs='+', type=float, required=True, help='Voxel sizes to test, in mm')
+    parser.add_argument('--crop', action='store_true', help='Also crop the CT to the body outline')
+    parser.add_argument('--topas-path', default=default_TOPAS_Directory, help='TOPAS executable path')
+    parser.add_argument('--output-dir', help='Output folder (default: runfolder/resampling_benchmark_<timestamp>)')
+    args = parser.parse_args()
+
+    reference = os.path.abspath(args.reference)
+    output_dir = args.output_dir or os.path.join(
+        os.getcwd(), 'runfolder', 'resampling_benchmark_' + datetime.now().strftime('%Y-%m-%d_%H-%M-%S'))
+    head_file = os.path.join(reference, 'headsourcecode.txt')
+    fan_tag = 'Full Fan' if 'fullfan.txt' in TopasParameterFile.from_file(head_file).include_files() else 'Half Fan'
+
+    rows = []
+    native = None
+    for voxel_size in [None] + args.voxel_sizes:
+        label = 'native' if voxel_size is None else format(voxel_size, 'g') + 'mm'
+        rundatadir = os.path.join(output_dir, label)
+        resampling = None if voxel_size is None else CtResampling(voxel_size, args.crop)
+        print(f"[{label}] simulating...")
+        start = time.time()
+        status = log_output(head_file, 'dicom', args.topas_path, fan_tag, tmp_dir=reference, rundatadir=rundatadir,
+                            use_cache=False, ct_resampling=resampling)
+        seconds = time.time() - start
+        grid = DoseGrid(run_dose_file(rundatadir))
+        dose, spacing = grid.slices(0, grid.shape[0]), grid.spacing
+        corner = tuple(value - step / 2. for value, step in zip(grid.origin, spacing))
+        row = {'voxel_size': label, 'voxels': dose.size, 'wall_seconds': seconds, 'status': status}
+        if native is None:
+            native = (dose, spacing, corner, seconds)
+            row.update({'speedup': 1.})
+        else:
+            offset = [test - ref for test, ref in zip(corner, native[2])]
+            row.update({'speedup': native[3] / seconds if seconds > 0 else np.inf,
+                        **dose_difference(native[0], native[1], dose, spacing, offset)})
+        rows.append(row)
+
+    columns = ['voxel_size', 'voxels', 'wall_seconds', 'speedup', 'mean_dose_difference', 'mean_absolute_difference',
+               'max_absolute_difference', 'voxels_compared', 'status']
+    with open(os.path.join(output_dir, BENCHMARK_CSV), 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=columns)
+        writer.writeheader()
+        writer.writerows(rows)
+
+    print()
+    print(f"{'voxels':>10} {'wall s':>9} {'speedup':>8} {'mean dose':>10} {'mean |d|':>9} {'max |d|':>9}")
+    for row in rows:
+        differences = [row.get(key) for key in ('mean_dose_difference', 'mean_absolute_difference',
+                                                'max_absolute_difference')]
+        print(f"{row['voxel_size']:>10} {row['wall_seconds']:9.1f} {row['speedup']:8.2f} "
+              + ' '.join('        -' if value is None else f"{100 * value:8.2f}%" for value in differences))
+    print(f"\nDifferences relative to the maximum dose of the native run. Results: {os.path.join(output_dir, BENCHMARK_CSV)}")
+
+if __name__ == "__main__":
+    main()
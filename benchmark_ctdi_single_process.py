@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+"""
+Single-Process CTDI Benchmark for MC-DCaRE
+==========================================
+
+Simulates one CTDI configuration with one TOPAS process per plug position (the default layout) and with all 5 positions
+scored in a single process (all plugs Air, and all plugs PMMA), then reports the wall time, the TOPAS initialisation
+time and the CTDI100 and CTDIw differences against the 5-process layout. On short validation runs the Geant4
+initialisation (geometry, physics tables, stopping power ratios) dominates the wall time and is paid once instead of 5
+times in the single-process layouts.
+
+The single-process layouts are an approximation, not a faster copy of the same result: the 5-process layout fills the
+holes that are not scored with PMMA, the single-process layouts fill every hole with the one material. The reported
+differences are the bias of that approximation for the protocol, not Monte Carlo noise around the same quantity.
+
+Usage:
+    python benchmark_ctdi_single_process.py --phantom 16 --protocol "CBCT Clockwise_Head" --histories 20000
+    python benchmark_ctdi_single_process.py --phantom 32 --layouts separate Air --threads 4
+
+Output:
+    runfolder/ctdi_single_process_benchmark_YYYY-MM-DD_HH-MM-SS/
+    - ctdi_single_process_benchmark.csv: One row per layout with wall and initialisation time, speedup, whether the
+      layout is an approximation and the CTDI differences
+    - separate/, Air/, PMMA/: Run folder of every layout
+"""
+
+import argparse
+import csv
+import os
+import time
+from datetime import datetime
+
+import numpy as np
+
+from src.defaultvalues import *
+from src.ctdi_analysis import analyse_ctdi_run
+from src.progress_monitor import get_monitor
+from src.protocol_sweep import SweepConfiguration, run_configuration
+
+BENCHMARK_CSV = 'ctdi_single_process_benchmark.csv'
+SEPARATE = 'separate'
+
+
+def initialisation_seconds(rundatadir):
+    """Longest initialisation (process start to the first run start) of the TOPAS processes of a run folder."""
+    seconds = [job['initialisation_seconds'] for job in get_monitor().jobs()
+               if os.path.dirname(job['log_file']) == rundatadir and job['initialisation_seconds'] is not None]
+    return max(seconds) if seconds else np.nan
+
+
+def relative_difference(value, reference, uncertainty, reference_uncertainty):
+    """Relative difference to the reference and its 1 SE uncertainty."""
+    difference = value / reference - 1.
+    error = abs(value / reference) * np.sqrt((uncertainty / value) ** 2 + (reference_uncertainty / reference) ** 2)
+    return difference, error
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark CTDI runs with all plug positions in one TOPAS process against one process per plug",
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    parser.add_argument('--phantom', type=int, choices=[16, 32], default=16, help='CTDI phantom diameter in cm')
+    parser.add_argument('--protocol', default='CBCT Clockwise_Head', help='Imaging protocol')
+    parser.add_argument('--histories', type=int, default=20000, help='Histories per run and file')
+    parser.add_argument('--threads', type=int, default=1, help='TOPAS threads per plug file')
+    parser.add_argument('--seed', type=int, default=9, help='Random seed')
+    parser.add_argument('--layouts', nargs='+', choices=[SEPARATE, 'Air', 'PMMA'], default=[SEPARATE, 'Air', 'PMMA'],
+                        help='Layouts to run, the first is the reference (default: separate Air PMMA)')
+    parser.add_argument('--g4-data', default=default_G4_Directory, help='Geant4 data directory path')
+    parser.add_argument('--topas-path', default=default_TOPAS_Directory, help='TOPAS executable path')
+    parser.add_argument('--output-dir',
+                        help='Output folder (default: runfolder/ctdi_single_process_benchmark_<timestamp>)')
+    args = parser.parse_args()
+
+    output_dir = args.output_dir or os.path.join(
+        os.getcwd(), 'runfolder', 'ctdi_single_process_benchmark_' + datetime.now().strftime('%Y-%m-%d_%H-%M-%S'))
+    configuration = SweepConfiguration(args.protocol, f"{args.phantom} cm", None, default_IMAGE_START_ANGLE, True,
+                                       str(args.histories))
+    settings = {'-G4FOLDERNAME-': args.g4_data, '-SEED-': str(args.seed), '-THREAD-': str(args.threads)}
+
+    rows = []
+    reference = None
+    for layout in args.layouts:
+        rundatadir = os.path.join(output_dir, layout)
+        os.makedirs(rundatadir, exist_ok=True)
+        print(f"[{layout}] simulating...")
+        start = time.time()
+        status = run_configuration(configuration, rundatadir, args.topas_path, settings, use_cache=False,
+                                   ctdi_single_process=None if layout == SEPARATE else layout)
+        seconds = time.time() - start
+        results = analyse_ctdi_run(rundatadir, single_process_material=None if layout == SEPARATE else layout)
+        row = {'layout': layout, 'processes': 5 if layout == SEPARATE else 1,
+               'approximation': results['plugs']['approximation'], 'wall_seconds': seconds,
+               'initialisation_seconds': initialisation_seconds(rundatadir), 'status': status}
+        if reference is None:
+            reference = (results, seconds)
+        row['speedup'] = reference[1] / seconds if seconds > 0 else np.inf
+        for tag, ctdi_w in results['ctdi_w'].items():
+            reference_w = reference[0]['ctdi_w'][tag]
+            row['CTDIw_' + tag] = ctdi_w['value']
+            row['CTDIw_' + tag + '_difference'], row['CTDIw_' + tag + '_difference_uncertainty'] = relative_difference(
+                ctdi_w['value'], reference_w['value'], ctdi_w['uncertainty'], reference_w['uncertainty'])
+            reference_positions = reference[0]['positions']
+            differences = [relative_difference(position[tag]['ctdi100'], reference_positions[name][tag]['ctdi100'],
+                                               position[tag]['ctdi100_uncertainty'],
+                                               reference_positions[name][tag]['ctdi100_uncertainty'])[0]
+                           for name, position in results['positions'].items()]
+            row['CTDI100_' + tag + '_max_abs_difference'] = max(abs(value) for value in differences)
+        rows.append(row)
+
+    columns = list(rows[0].keys())
+    for row in rows[1:]:
+        columns += [key for key in row if key not in columns]
+    with open(os.path.join(output_dir, BENCHMARK_CSV), 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=columns)
+        writer.writeheader()
+        writer.writerows(rows)
+
+    print()
+    tags = list(reference[0]['ctdi_w'])
+    print(f"{'layout':>10} {'wall s':>9} {'init s':>8} {'speedup':>8} " + ' '.join(f"{'CTDIw ' + tag:>16}" for tag in tags))
+    for row in rows:
+        differences = [f"{100 * row['CTDIw_' + tag + '_difference']:+7.2f}+-{100 * row['CTDIw_' + tag + '_difference_uncertainty']:.2f}%"
+                       for tag in tags]
+        print(f"{row['layout']:>10} {row['wall_seconds']:9.1f} {row['initialisation_seconds']:8.1f} {row['speedup']:8.2f} "
+              + ' '.join(f"{difference:>16}" for difference in differences))
+    print(f"\nDifferences relative to the {args.layouts[0]} layout. Results: {os.path.join(output_dir, BENCHMARK_CSV)}")
+    approximations = [layout for layout in args.layouts if layout != SEPARATE]
+    if approximations:
+        print(f"Note: the single-process layouts ({', '.join(approximations)}) are an approximation, not a faster copy of "
+              f"the 5-process result. Every plug is of one material, while the 5-process layout fills the holes that are "
+              f"not scored with PMMA, the differences above are the bias of that approximation.")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+"""
+Per-Angle Dose Library for MC-DCaRE
+===================================
+
+Simulates the patient of a DICOM run once over 360 deg in angular bins (build), then composes the dose of any imaging
+protocol, start angle, direction or kV-kV angle set from the bin doses by weighted summation, in seconds and without
+simulating (compose). The library is bound to the kVp, fan and blades of the run it was built from.
+
+Usage:
+    python compose_dose.py build runfolder/<DICOM run> --bins 36 --runs-per-bin 4
+    python compose_dose.py compose runfolder/<DICOM run>/angular_library --protocol "CBCT Anticlockwise_Head" --start-angle "45 deg"
+    python compose_dose.py compose runfolder/<DICOM run>/angular_library --protocol "kV-kV_Head" --angles 0 90
+    python compose_dose.py check runfolder/composed_<timestamp> runfolder/<simulated run of the same protocol>
+
+Output:
+    build: <run folder>/angular_library/
+    - library.json: Bins, histories, dose grid, fan, blades and spectrum of the library
+    - bin_doses.npy, bin_scales.npy: uint16 dose of every bin and its scale
+    compose: runfolder/composed_YYYY-MM-DD_HH-MM-SS/ (a run folder)
+    - <protocol>_<start>deg_COMPOSED_DOSE.dcm: Composed dose, calibrated with head_calibration_factor.txt
+    - composition.json: Angles, bin weights, histories and compose time
+    check: adds the comparison of the calibrated composed and simulated doses to composition.json
+"""
+
+import argparse
+import os
+from datetime import datetime
+
+from src.defaultvalues import *
+from src.angular_library import build_angular_library, check_composition, compose_protocol
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Build a per-angle dose library of a DICOM run and compose protocol doses from it",
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    commands = parser.add_subparsers(dest='command', required=True)
+    build = commands.add_parser('build', help='Simulate a DICOM run folder over 360 deg in angular bins')
+    build.add_argument('run_folder', help='DICOM run folder with headsourcecode.txt and its includes')
+    build.add_argument('--bins', type=int, default=default_ANGULAR_BINS, help='Angular bins over 360 deg')
+    build.add_argument('--runs-per-bin', type=int, default=default_ANGULAR_RUNS_PER_BIN,
+                       help='Gantry angles simulated per bin')
+    build.add_argument('--histories', type=int, help='Histories per gantry angle (default: those of the run)')
+    build.add_argument('--threads', type=int, help='TOPAS threads per bin (default: those of the run)')
+    build.add_argument('--seed', type=int, help='Seed of the first bin (default: the seed of the run)')
+    build.add_argument('--library-dir', help='Library folder (default: <run folder>/angular_library)')
+    build.add_argument('--topas-path', default=default_TOPAS_Directory, help='TOPAS executable path')
+
+    compose = commands.add_parser('compose', help='Compose the dose of a protocol from a library')
+    compose.add_argument('library_dir', help='Library folder written by build')
+    compose.add_argument('--protocol', required=True, help='Imaging protocol, eg. "CBCT Clockwise_Head"')
+    compose.add_argument('--start-angle', default=default_IMAGE_START_ANGLE, help='Gantry start angle, eg. "45 deg"')
+    compose.add_argument('--sequential-times', default=default_TIME_SEQ_TIME, help='Sequential times of the protocol run')
+    compose.add_argument('--angles', type=float, nargs='+', help='Gantry angles in deg instead of the protocol arc')
+    compose.add_argument('--exposure', help='Exposure instead of the protocol one, eg. "200 mAs"')
+    compose.add_argument('--output-dir', help='Output folder (default: runfolder/composed_<timestamp>)')
+
+    check = commands.add_parser('check', help='Compare a composed dose with a simulated run of the same arc')
+    check.add_argument('composed_dir', help='Folder written by compose')
+    check.add_argument('simulated_dir', help='Run folder of the same protocol, start angle and exposure')
+    check.add_argument('--tolerance', type=float, default=0.05,
+                       help='Accepted relative difference of the mean dose (default: %(default)s)')
+    args = parser.parse_args()
+
+    if args.command == 'build':
+        library = build_angular_library(args.run_folder, args.topas_path, args.bins, args.runs_per_bin,
+                                        args.library_dir, args.histories, args.seed, args.threads)
+        print(f"{library.bins} bins of {library.manifest['bin_width']:g} deg in "
+              f"{library.manifest['build_seconds']:.0f} s: {library.library_dir}")
+        return
+
+    if args.command == 'check':
+        result = check_composition(args.composed_dir, args.simulated_dir, tolerance=args.tolerance)
+        print(f"Composed / simulated mean dose: {result['mean_dose_ratio']:.4f} over {result['voxels_compared']} "
+              f"voxels, mean |difference| {100 * result['mean_absolute_difference']:.2f} % of the maximum: "
+              + ('agrees' if result['agrees'] else 'DOES NOT AGREE'))
+        if not result['agrees']:
+            raise SystemExit(1)
+        return
+
+    output_dir = args.output_dir or os.path.join(
+        os.getcwd(), 'runfolder', 'composed_' + datetime.now().strftime('%Y-%m-%d_%H-%M-%S'))
+    result = compose_protocol(args.library_dir, args.protocol, args.start_angle, output_dir, args.sequential_times,
+                              args.angles, args.exposure)
+    print(f"{len(result['angles'])} gantry angles from {result['angles'][0]:g} to {result['angles'][-1]:g} deg "
+          f"composed in {result['seconds']:.1f} s: {result['output']}")
+
+if __name__ == "__main__":
+    main()
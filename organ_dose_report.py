@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+"""
+Organ Dose Report for MC-DCaRE
+==============================
+
+Organ mean, minimum and maximum dose and DVHs of DICOM simulations, from the RTSTRUCT of each patient. Dose grids are
+memory-mapped and processed in chunks of slices, and patients are processed in parallel.
+
+Usage:
+    python organ_dose_report.py --case runfolder/2025-01-01_12-00-00 /data/patient1/RS.dcm
+    python organ_dose_report.py --case run1 /data/patient1 --case run2 /data/patient2 --roi Bladder --roi Rectum
+
+Output:
+    runfolder/organ_dose_report_YYYY-MM-DD_HH-MM-SS/
+    - organ_doses.csv: One row per patient and ROI, doses in mGy
+    - organ_dvh.csv: Cumulative DVH of every patient and ROI
+"""
+
+import argparse
+import os
+from datetime import datetime
+
+from src.dose_analysis import ORGAN_DOSES_CSV, DEFAULT_CHUNK_SLICES, DVH_BINS, cohort_report
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Organ doses and DVHs of DICOM simulations",
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    parser.add_argument('--case', nargs=2, action='append', required=True, metavar=('DOSE', 'STRUCTURES'),
+                        help='Run folder or RTDOSE file, and RTSTRUCT file or DICOM folder holding one')
+    parser.add_argument('--roi', action='append', help='ROI to report (repeat for several, default: all)')
+    parser.add_argument('--workers', type=int, default=4, help='Patients processed at the same time')
+    parser.add_argument('--chunk-slices', type=int, default=DEFAULT_CHUNK_SLICES, help='Dose planes read at a time')
+    parser.add_argument('--dvh-bins', type=int, default=DVH_BINS, help='DVH bins up to the maximum dose')
+    parser.add_argument('--output-dir', help='Output folder (default: runfolder/organ_dose_report_<timestamp>)')
+    args = parser.parse_args()
+
+    output_dir = args.output_dir or os.path.join(
+        os.getcwd(), 'runfolder', 'organ_dose_report_' + datetime.now().strftime('%Y-%m-%d_%H-%M-%S'))
+    results = cohort_report([tuple(case) for case in args.case], output_dir, args.roi, args.workers,
+                            args.chunk_slices, args.dvh_bins)
+
+    print(f"{'case':<40} {'roi':<20} {'volume cc':>10} {'mean mGy':>10} {'max mGy':>10}")
+    for case, organs in results.items():
+        if 'error' in organs:
+            print(f"{case[-40:]:<40} error: {organs['error']}")
+            continue
+        for roi, result in organs.items():
+            print(f"{case[-40:]:<40} {roi[:20]:<20} {result['volume_cc']:10.1f} {1000 * result['mean']:10.4g} "
+                  f"{1000 * result['max']:10.4g}")
+    print(f"\nResults: {os.path.join(output_dir, ORGAN_DOSES_CSV)}")
+
+if __name__ == "__main__":
+    main()
@@ -12,8 +12,12 @@ Usage:
 
 Output:
     Results are saved in runfolder/YYYY-MM-DD_HH-MM-SS/
-    - dose_results.csv: Dose values at 5 positions
-    - simulation.log: TOPAS execution log
+    - dose_results.csv: CTDI100 at the 5 positions, CTDIw and CTDIvol
+    - ctdi_estimate.json: Deterministic primary dose estimate and its ratio to the Monte Carlo result
+    - NbParticlesInTime.txt, NbParticlesWeights.txt, history_allocation.json: Histories and weights of every
+      sequential time when --allocation is given
+    - ChamberPlug*.log: TOPAS execution log of every plug position
+    - tmp/: The edited templates and beam files of the run
     - configuration files: All TOPAS input files used
 """
 
@@ -21,77 +25,41 @@ import argparse
 import os
 import sys
 from datetime import datetime
-from src.runtime_handler import run_topas
-from src.edits_handler import editor
-from src.Energyspectrum import generate_new_topas_beam_profile
 from src.defaultvalues import *
+from src.protocol_sweep import (SweepConfiguration, configuration_values, estimate_configuration, render_configuration,
+                                run_configuration)
+from src.ctdi_analysis import RESULTS_CSV
+from src.ctdi_estimator import ESTIMATE_JSON, format_estimate, write_estimate
+from src.phase_space import PhaseSpaceSettings
+from src.history_allocation import MODES, HistoryAllocationSettings
 
 def create_run_directory():
     """Create timestamped run directory"""
     timestamp = datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
-    run_dir = os.path.join("runfolder", timestamp)
-    os.makedirs(run_dir, exist_ok=True)
+    run_dir = os.path.join(os.getcwd(), "runfolder", timestamp)
     os.makedirs(os.path.join(run_dir, "tmp"), exist_ok=True)
     return run_dir
 
-def setup_ctdi_simulation(run_dir, args):
-    """Configure CTDI simulation based on command-line arguments"""
-    
-    # Generate beam profile
-    generate_new_topas_beam_profile(
-        args.kvp, 
-        args.exposure, 
-        str(args.histories), 
-        run_dir
-    )
-    
-    # Copy and modify boilerplate files
-    boilerplate_dir = "src/boilerplates"
-    
-    # Select phantom file
-    phantom_file = f"CTDIphantom_{args.phantom}.txt"
-    
-    # Files to copy and modify
-    files_to_copy = [
-        "headsourcecode_boilerplate.txt",
-        f"TOPAS_includeFiles/{phantom_file}",
-        "TOPAS_includeFiles/fullfan.txt",
-        "TOPAS_includeFiles/HUtoMaterialSchneider.txt",
-        "TOPAS_includeFiles/Muen.dat",
-        "TOPAS_includeFiles/NbParticlesInTime.txt"
-    ]
-    
-    # Copy files to tmp directory
-    for file in files_to_copy:
-        src = os.path.join(boilerplate_dir, file)
-        dst = os.path.join(run_dir, "tmp", os.path.basename(file))
-        with open(src, 'r') as f_src, open(dst, 'w') as f_dst:
-            f_dst.write(f_src.read())
-    
-    # Modify main configuration file
-    head_file = os.path.join(run_dir, "tmp", "headsourcecode_boilerplate.txt")
-    
-    # Parameter mapping for replacements
-    replacements = {
-        "default_G4_Directory": args.g4_data,
-        "default_TOPAS_Directory": args.topas_path,
-        "default_Seed": str(args.seed),
-        "default_Threads": str(args.threads),
-        "default_Histories": str(args.histories),
-        "default_IMAGEVOLTAGE": str(args.kvp) + " kV",
-        "default_EXPOSURE": str(args.exposure) + " mAs",
-        "default_FAN_MODE": args.fan_mode,
-        "default_FIELD_X1": str(args.field_x1) + " cm",
-        "default_FIELD_X2": str(args.field_x2) + " cm",
-        "default_FIELD_Y1": str(args.field_y1) + " cm",
-        "default_FIELD_Y2": str(args.field_y2) + " cm"
+def ctdi_settings(args):
+    """GUI value overrides for the command-line arguments, anything not given keeps the protocol setting"""
+    settings = {
+        '-G4FOLDERNAME-': args.g4_data,
+        '-SEED-': str(args.seed),
+        '-THREAD-': str(args.threads),
     }
-    
-    # Apply replacements
-    for key, value in replacements.items():
-        editor(head_file, key, value)
-    
-    return head_file
+    if args.kvp is not None:
+        settings['-IMAGEVOLTAGE-'] = str(args.kvp) + " kV"
+    if args.exposure is not None:
+        settings['-EXPOSURE-'] = str(args.exposure) + " mAs"
+    fields = [args.field_x1, args.field_x2, args.field_y1, args.field_y2]
+    if any(field is not None for field in fields):
+        # Same as the CTDI user blade toggle of the GUI, the field sizes are converted to blade positions
+        defaults = [default_FIELD_X1, default_FIELD_X2, default_FIELD_Y1, default_FIELD_Y2]
+        settings['-CTDI_BLADE_TOG-'] = True
+        for key, field, default in zip(['-CTDI_FIELD_X1-', '-CTDI_FIELD_X2-', '-CTDI_FIELD_Y1-', '-CTDI_FIELD_Y2-'],
+                                       fields, defaults):
+            settings[key] = default if field is None else str(field) + " cm"
+    return settings
 
 def main():
     parser = argparse.ArgumentParser(
@@ -102,18 +70,30 @@ Examples:
   python run_ctdi.py --phantom 16 --kvp 100 --exposure 100
   python run_ctdi.py --phantom 32 --kvp 120 --exposure 200 --histories 500000
   python run_ctdi.py --phantom 16 --kvp 80 --exposure 50 --threads 4
+  python run_ctdi.py --phantom 32 --protocol "CBCT Clockwise_Pelvis"
+  python run_ctdi.py --phantom 32 --protocol "CBCT Clockwise_Pelvis" --estimate-only
+  python run_ctdi.py --phantom 32 --protocol "CBCT Clockwise_Pelvis" --allocation variance_optimal --segments 18
+  For sweeps over several protocols or phantoms use run_sweep.py
         """
     )
     
     # Phantom selection
     parser.add_argument('--phantom', type=int, choices=[16, 32], default=16,
                         help='CTDI phantom diameter (16cm or 32cm)')
+
+    # Protocol from imaging_modes_lookup, gives the rotation, timeline, beam and blade settings
+    parser.add_argument('--protocol', default='CBCT Clockwise_Head',
+                        help='Imaging protocol (default: CBCT Clockwise_Head)')
+    parser.add_argument('--start-angle', default=default_IMAGE_START_ANGLE,
+                        help='Start angle of the rotation (default: %s)' % default_IMAGE_START_ANGLE)
+    parser.add_argument('--no-couch', action='store_true',
+                        help='Remove the couch from the simulation')
     
     # Beam parameters
-    parser.add_argument('--kvp', type=float, default=100,
-                        help='X-ray tube voltage in kV (default: 100)')
-    parser.add_argument('--exposure', type=float, default=100,
-                        help='Exposure in mAs (default: 100)')
+    parser.add_argument('--kvp', type=float, default=None,
+                        help='X-ray tube voltage in kV (default: protocol value)')
+    parser.add_argument('--exposure', type=float, default=None,
+                        help='Exposure in mAs (default: protocol value)')
     
     # Simulation parameters
     parser.add_argument('--histories', type=int, default=100000,
@@ -124,18 +104,47 @@ Examples:
                         help='Random seed (default: 9)')
     
     # Field parameters
-    parser.add_argument('--field-x1', type=float, default=14,
-                        help='Field X1 size in cm (default: 14)')
-    parser.add_argument('--field-x2', type=float, default=14,
-                        help='Field X2 size in cm (default: 14)')
-    parser.add_argument('--field-y1', type=float, default=10.7,
-                        help='Field Y1 size in cm (default: 10.7)')
-    parser.add_argument('--field-y2', type=float, default=10.7,
-                        help='Field Y2 size in cm (default: 10.7)')
+    parser.add_argument('--field-x1', type=float, default=None,
+                        help='Field X1 size in cm (default: protocol blades)')
+    parser.add_argument('--field-x2', type=float, default=None,
+                        help='Field X2 size in cm (default: protocol blades)')
+    parser.add_argument('--field-y1', type=float, default=None,
+                        help='Field Y1 size in cm (default: protocol blades)')
+    parser.add_argument('--field-y2', type=float, default=None,
+                        help='Field Y2 size in cm (default: protocol blades)')
     
     # Fan mode
-    parser.add_argument('--fan-mode', choices=['Full Fan', 'Half Fan'], default='Full Fan',
-                        help='Beam collimation mode (default: Full Fan)')
+    parser.add_argument('--fan-mode', choices=['Full Fan', 'Half Fan'], default=None,
+                        help='Beam collimation mode (default: protocol fan)')
+    
+    # All plug positions in one TOPAS process
+    parser.add_argument('--single-process', choices=['Air', 'PMMA'], default=None,
+                        help='Score the 5 plug positions in one TOPAS process with all plugs of this material, '
+                             'instead of one process per position (an approximation, see render_combined_plug_file)')
+    
+    # Gantry arc split into concurrent sub-arc jobs
+    parser.add_argument('--arcs', type=int, default=1,
+                        help='Split the gantry arc of every plug file into this many concurrent sub-arcs (default: 1)')
+    
+    # Histories spread over the gantry angles, the segments run as weighted sub-arcs
+    parser.add_argument('--allocation', choices=MODES, default=None,
+                        help='Allocate the histories over the sequential times (see src/history_allocation.py)')
+    parser.add_argument('--segments', type=int, default=HistoryAllocationSettings().segments,
+                        help='Segments of the arc the allocation is constant over (default: %(default)s)')
+    parser.add_argument('--tube-currents', default=None,
+                        help='Text file with the relative tube current over the arc, one value (or time and value) '
+                             'per line')
+    
+    # Two-stage run from the head phase space library
+    parser.add_argument('--phase-space', action='store_true',
+                        help='Start the plug runs from the phase space below the bowtie, simulating the head once '
+                             'per protocol into ' + default_PHASE_SPACE_DIR)
+    parser.add_argument('--phase-space-histories', type=int, default=default_PHASE_SPACE_HISTORIES,
+                        help='Histories of the head-only run (default: %(default)s)')
+    
+    # Deterministic estimate without the Monte Carlo run
+    parser.add_argument('--estimate-only', action='store_true',
+                        help='Only compute the primary dose estimate of the configuration (see src/ctdi_estimator.py)')
     
     # Paths
     parser.add_argument('--g4-data', default=default_G4_Directory,
@@ -148,7 +157,8 @@ Examples:
     print("MC-DCaRE CTDI Command-Line Interface")
     print("=" * 40)
     print(f"Phantom: {args.phantom}cm")
-    print(f"Beam: {args.kvp} kV, {args.exposure} mAs")
+    print(f"Protocol: {args.protocol}")
+    print(f"Beam: {args.kvp or 'protocol'} kV, {args.exposure or 'protocol'} mAs")
     print(f"Histories: {args.histories}")
     print(f"Threads: {args.threads}")
     print()
@@ -157,19 +167,40 @@ Examples:
     run_dir = create_run_directory()
     print(f"Created run directory: {run_dir}")
     
-    # Setup simulation
-    print("Configuring simulation...")
-    head_file = setup_ctdi_simulation(run_dir, args)
-    
-    # Run simulation
-    print("Starting TOPAS simulation...")
+    # Setup and run simulation
+    configuration = SweepConfiguration(args.protocol, f"{args.phantom} cm", args.fan_mode, args.start_angle,
+                                       not args.no_couch, str(args.histories))
+    if args.estimate_only:
+        values = configuration_values(configuration, ctdi_settings(args))
+        render_configuration(values, run_dir)
+        estimate = estimate_configuration(values, run_dir)
+        if estimate is None:
+            print("Error: the configuration could not be estimated", file=sys.stderr)
+            sys.exit(1)
+        print(format_estimate(estimate))
+        print(f"Estimate saved in: {write_estimate(estimate, run_dir)}")
+        return
+    print("Configuring and starting TOPAS simulation...")
     try:
-        run_topas(head_file, run_dir)
-        print("Simulation completed successfully!")
-        print(f"Results saved in: {run_dir}")
+        run_options = {'ctdi_single_process': args.single_process, 'arcs': args.arcs}
+        if args.phase_space:
+            run_options['phase_space'] = PhaseSpaceSettings(args.phase_space_histories, protocol=args.protocol)
+        if args.allocation is not None:
+            currents = None
+            if args.tube_currents is not None:
+                with open(args.tube_currents, 'r') as f:
+                    currents = tuple(float(line.split()[-1]) for line in f if line.strip())
+            run_options['history_allocation'] = HistoryAllocationSettings(args.allocation, args.segments, currents)
+        run_status = run_configuration(configuration, run_dir, args.topas_path, ctdi_settings(args), **run_options)
     except Exception as e:
         print(f"Error running simulation: {e}", file=sys.stderr)
         sys.exit(1)
+    print(run_status)
+    print(f"Results saved in: {run_dir}")
+    if 'failing' in run_status or run_status.startswith('Error'):
+        sys.exit(1)
+    print(f"CTDI results: {os.path.join(run_dir, RESULTS_CSV)}")
+    print(f"Estimate and comparison: {os.path.join(run_dir, ESTIMATE_JSON)}")
 
 if __name__ == "__main__":
     main()
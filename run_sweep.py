@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+"""
+CTDI Protocol Sweep Command-Line Interface for MC-DCaRE
+=======================================================
+
+Runs CTDI simulations for every combination of protocols (from imaging_modes_lookup), phantom sizes, fan modes,
+start angles, couch on/off and history counts without the GUI. Identical configurations are simulated once.
+
+Usage:
+    python run_sweep.py sweep.json
+    python run_sweep.py --protocols "CBCT*" --phantoms "16 cm" "32 cm" --histories 100000
+    python run_sweep.py --protocols all --phantoms "16 cm" "32 cm" --dry-run
+
+Sweep specification (JSON, every key optional):
+    {
+        "protocols": ["CBCT Clockwise_Head", "kV-kV_*"],
+        "phantoms": ["16 cm", "32 cm"],
+        "fans": [null],
+        "start_angles": ["0 deg", "90 deg"],
+        "couch": [true, false],
+        "histories": ["100000"],
+        "settings": {"-THREAD-": "4"}
+    }
+
+Output:
+    runfolder/sweep_YYYY-MM-DD_HH-MM-SS/
+    - sweep_summary.csv: One row per configuration with its run folder, status, CTDIw and the estimated CTDIw
+    - runs/<key>/: Run folder of every unique configuration (dose_results.csv, logs, TOPAS files)
+    - configurations/<n>/tmp/: Rendered templates of every configuration
+"""
+
+import argparse
+import os
+import sys
+from datetime import datetime
+from src.defaultvalues import *
+from src.job_scheduler import get_scheduler
+from src.progress_monitor import get_monitor, print_progress
+from src.protocol_sweep import expand_sweep, format_summary, load_sweep_spec, run_sweep
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Run CTDI simulations over a sweep of protocols and settings",
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog="""
+Examples:
+  python run_sweep.py sweep.json --concurrency 2
+  python run_sweep.py --protocols all --phantoms "16 cm" "32 cm"
+  python run_sweep.py --protocols "CBCT Clockwise_*" --start-angles "0 deg" "180 deg" --couch on off --dry-run
+        """
+    )
+    parser.add_argument('spec', nargs='?', help='JSON sweep specification, the options below override its entries')
+
+    # Sweep axes
+    parser.add_argument('--protocols', nargs='+', help='Protocol names or patterns, "all" for every protocol')
+    parser.add_argument('--phantoms', nargs='+', choices=['16 cm', '32 cm'], help='CTDI phantoms')
+    parser.add_argument('--fans', nargs='+', choices=['Full Fan', 'Half Fan', 'protocol'],
+                        help='Fan modes, "protocol" keeps the fan of the protocol')
+    parser.add_argument('--start-angles', nargs='+', help='Start angles, eg. "0 deg" "90 deg"')
+    parser.add_argument('--couch', nargs='+', choices=['on', 'off'], help='Couch in or out of the beam')
+    parser.add_argument('--histories', nargs='+', help='Histories per run')
+
+    # Settings shared by every configuration
+    parser.add_argument('--threads', help='TOPAS threads per run (default: %s)' % default_Threads)
+    parser.add_argument('--seed', help='Random seed (default: %s)' % default_Seed)
+    parser.add_argument('--g4-data', help='Geant4 data directory path')
+    parser.add_argument('--topas-path', default=default_TOPAS_Directory, help='TOPAS executable path')
+
+    # Execution
+    parser.add_argument('--sweep-dir', help='Output folder (default: runfolder/sweep_<timestamp>)')
+    parser.add_argument('--concurrency', type=int, default=2, help='Configurations simulated at once (default: 2)')
+    parser.add_argument('--thread-budget', type=int, help='CPU threads shared by all TOPAS runs (default: all CPUs)')
+    parser.add_argument('--dry-run', action='store_true',
+                        help='Only expand, render, dedupe and estimate the sweep (see src/ctdi_estimator.py)')
+    parser.add_argument('--progress', action='store_true', help='Print histories/s, percent and ETA while running')
+
+    args = parser.parse_args()
+
+    spec = load_sweep_spec(args.spec) if args.spec else {}
+    if args.protocols:
+        spec['protocols'] = args.protocols
+    if args.phantoms:
+        spec['phantoms'] = args.phantoms
+    if args.fans:
+        spec['fans'] = [None if fan == 'protocol' else fan for fan in args.fans]
+    if args.start_angles:
+        spec['start_angles'] = args.start_angles
+    if args.couch:
+        spec['couch'] = [couch == 'on' for couch in args.couch]
+    if args.histories:
+        spec['histories'] = args.histories
+    settings = spec.setdefault('settings', {})
+    for key, value in (('-THREAD-', args.threads), ('-SEED-', args.seed), ('-G4FOLDERNAME-', args.g4_data)):
+        if value is not None:
+            settings[key] = value
+
+    sweep_dir = args.sweep_dir or os.path.join(
+        os.getcwd(), 'runfolder', 'sweep_' + datetime.now().strftime('%Y-%m-%d_%H-%M-%S'))
+
+    print("MC-DCaRE CTDI Protocol Sweep")
+    print("=" * 40)
+    print(f"Configurations: {len(expand_sweep(spec))}")
+    print(f"Output: {sweep_dir}")
+    print()
+
+    get_scheduler(args.thread_budget)
+    if args.progress:
+        get_monitor().subscribe(print_progress)
+
+    rows = run_sweep(spec, sweep_dir, args.topas_path, concurrency=args.concurrency, dry_run=args.dry_run,
+                     on_result=lambda row: print(f"[{row['configuration']}] {row['status']}"))
+    print()
+    print(format_summary(rows))
+    unique_runs = sum(1 for row in rows if row['duplicate_of'] == '')
+    print(f"\n{len(rows)} configurations, {unique_runs} unique runs. Summary: {os.path.join(sweep_dir, 'sweep_summary.csv')}")
+    if any('failing' in str(row['status']) or 'Error' in str(row['status']) for row in rows):
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -1,23 +1,143 @@
+import re
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, Optional
+
 import spekpy as sp
 import numpy as np
 import matplotlib.pyplot as plt
 
-def generate_new_topas_beam_profile(anode_voltage:float, exposure:float, Histories:str, path):
-    s=sp.Spek(kvp=anode_voltage,th=14,mas =exposure,dk = 0.2, z=0.1,
+from src.defaultvalues import default_SPECTRUM_CACHE_DIR, default_SPECTRUM_CACHE_SIZE
+from src.imaging_modes_lookuptable import imaging_modes_lookup
+from src.materialdata import AIR, mass_coefficients
+from src.spectrum_cache import spectrum_cache_key, load_cached_spectrum, store_cached_spectrum
+
+# Tube model shared by all protocols, only the kVp and exposure change between the imaging modes
+TARGET_ANGLE = 14 # anode angle in degrees
+ENERGY_BIN = 0.2 # keV
+SOURCE_DISTANCE = 0.1 # cm, spectrum is evaluated 1mm from the focal spot
+FILTRATION = (('Al', 2.7),) #2.7mm filter at the kV xray tube exit window from manual
+# TOPAS interpolates the weights of a Continuous spectrum linearly between the energies as a density, which only matches
+# the spekpy bins on their even grid. Rebinned spectra are uneven and written as Discrete lines instead.
+CONTINUOUS = 'Continuous'
+DISCRETE = 'Discrete'
+
+
+def calculate_spectrum(anode_voltage: float, target_angle: float = TARGET_ANGLE, energy_bin: float = ENERGY_BIN,
+                       distance: float = SOURCE_DISTANCE, filtration=FILTRATION) -> Dict[str, np.ndarray]:
+    """Runs the spekpy model for 1 mAs. Fluence is linear in the exposure so the caller scales it.
+
+    Kept at module level so that it can be sent to a process pool by prewarm_spectrum_cache.
+
+    Returns:
+        Dict[str, np.ndarray]: energies (keV), fluence per bin, total_fluence and the spekpy summary of inputs/outputs.
+    """
+    s=sp.Spek(kvp=anode_voltage,th=target_angle,mas =1,dk = energy_bin, z=distance,
               ) # unfiltered spectrum at 1mm 
-    s.filter('Al',2.7) #2.7mm filter at the kV xray tube exit window from manual
-    
-    summary_of_inputs = s.state.get_current_state_str('full', s.get_std_results())
-    # Export (save) spectrum to file, doesnt seem to be used
-    # s.export_spectrum('imaging_params.spk', comment='for topas export')
+    for material, thickness in filtration:
+        s.filter(material, thickness)
+
     # by default, diff is true but if not true, means fluence is given per bin (with width) instead of per energy (keV)
     # which results in sum(spkarr) = 2* s.get_flu. reason unknown. if diff set to true (use fluence in bin instead of 
     # per energy in keV)
     # this does not change the spectrum dynamic- only scale it across the whole spectrum by 0.5
     karr, spkarr = s.get_spectrum(edges= False, diff = False) # returns an array of photon energies and its corresponding fluence
-    no_particles = 4*np.pi*0.1**2*s.get_flu()
+    return {
+        'energies': karr,
+        'fluence': spkarr,
+        'total_fluence': np.asarray(s.get_flu()),
+        'summary': np.asarray(s.state.get_current_state_str('full', s.get_std_results())),
+    }
+
+
+def _cache_key(anode_voltage: float) -> str:
+    return spectrum_cache_key(anode_voltage, TARGET_ANGLE, ENERGY_BIN, FILTRATION, sp.__version__, SOURCE_DISTANCE)
+
+
+def get_beam_spectrum(anode_voltage: float, exposure: float, cache_dir: Optional[str] = default_SPECTRUM_CACHE_DIR,
+                      max_entries: int = default_SPECTRUM_CACHE_SIZE) -> Dict[str, np.ndarray]:
+    """Returns the spectrum for the tube settings, from the spectrum cache when available.
+
+    Args:
+        anode_voltage (float): Tube voltage in kV.
+        exposure (float): Exposure in mAs, used to scale the cached 1 mAs fluence.
+        cache_dir (str, optional): Cache folder. None disables the cache and always runs spekpy.
+        max_entries (int): Number of spectra kept in the cache.
+
+    Returns:
+        Dict[str, np.ndarray]: energies, fluence and total_fluence for the requested exposure, and the 1 mAs summary.
+    """
+    if cache_dir is not None:
+        key = _cache_key(anode_voltage)
+        spectrum = load_cached_spectrum(cache_dir, key)
+        if spectrum is None:
+            spectrum = calculate_spectrum(anode_voltage)
+            store_cached_spectrum(cache_dir, key, spectrum, max_entries)
+    else:
+        spectrum = calculate_spectrum(anode_voltage)
+
+    scaled = dict(spectrum)
+    scaled['fluence'] = spectrum['fluence'] * exposure
+    scaled['total_fluence'] = spectrum['total_fluence'] * exposure
+    return scaled
+
+
+def prewarm_spectrum_cache(protocols: dict = imaging_modes_lookup, cache_dir: str = default_SPECTRUM_CACHE_DIR,
+                           max_entries: int = default_SPECTRUM_CACHE_SIZE, max_workers: Optional[int] = None) -> int:
+    """Fills the spectrum cache for every kVp used by the protocols, generating missing spectra in a process pool.
+
+    Args:
+        protocols (dict): Lookup table in the imaging_modes_lookup layout, the kVp is the second entry of each protocol.
+        cache_dir (str): Cache folder.
+        max_entries (int): Number of spectra kept in the cache.
+        max_workers (int, optional): Size of the process pool, defaults to the number of CPUs.
+
+    Returns:
+        int: Number of spectra that had to be generated.
+    """
+    voltages = sorted({float(settings[1].split()[0]) for name, settings in protocols.items() if name != 'selection'})
+    missing = [kvp for kvp in voltages if load_cached_spectrum(cache_dir, _cache_key(kvp)) is None]
+    if not missing:
+        return 0
+    with ProcessPoolExecutor(max_workers=max_workers) as pool:
+        # Only this process writes into the cache, workers just return the spectra
+        for kvp, spectrum in zip(missing, pool.map(calculate_spectrum, missing)):
+            store_cached_spectrum(cache_dir, _cache_key(kvp), spectrum, max_entries)
+    return len(missing)
+
+
+def generate_new_topas_beam_profile(anode_voltage:float, exposure:float, Histories:str, path,
+                                    cache_dir: Optional[str] = default_SPECTRUM_CACHE_DIR,
+                                    rebin_bins: Optional[int] = None, rebin_tolerance: Optional[float] = None):
+    """Writes tmp/ConvertedTopasFile.txt and tmp/head_calibration_factor.txt for the tube settings.
+
+    Giving rebin_bins or rebin_tolerance merges the spekpy bins with rebin_spectrum before writing, the
+    spectral-moment errors are then added to head_calibration_factor.txt and returned. The spectrum type is written
+    with the spectrum, Continuous for the spekpy bins and Discrete for a rebinned spectrum.
+    """
+    spectrum = get_beam_spectrum(anode_voltage, exposure, cache_dir)
+    karr, spkarr = spectrum['energies'], spectrum['fluence']
+    total_fluence = float(spectrum['total_fluence'])
+    # spekpy summary is stored for 1 mAs, exposure dependent outputs are restated below it
+    summary_of_inputs = str(spectrum['summary']) + '\nScaled to ' + str(exposure) + ' mAs: Fluence: ' \
+                        + format(total_fluence, '.4f') + ' [Photons cm^-2]\n'
+    # Export (save) spectrum to file, doesnt seem to be used
+    # s.export_spectrum('imaging_params.spk', comment='for topas export')
+    no_particles = 4*np.pi*0.1**2*total_fluence
+
+    #normalising fluence by the total fluence to get weights for each energy bin 
+    normalised_spec = spkarr/total_fluence
+    #check that all weights sum up close to one
+    # print(sum(normalised_spec))
+
+    rebin_report = None
+    spectrum_type = CONTINUOUS
+    if rebin_bins is not None or rebin_tolerance is not None:
+        karr, normalised_spec, rebin_report = rebin_spectrum(karr, normalised_spec, rebin_bins, rebin_tolerance)
+        summary_of_inputs += '\n' + format_rebin_report(rebin_report)
+        spectrum_type = DISCRETE
     
-    #multiply dose by this factor to get absolute dose - since reduce the numberhistories to 2009895
+    #multiply dose by this factor to get absolute dose - Histories is the number of histories per run of the rendered file.
+    #runs with a history allocation keep this factor, their segments are weighted back to Histories per run (history_allocation.py)
     calib_factor = no_particles/int(Histories) # no_particles/Histories
     with open(path + '/tmp/head_calibration_factor.txt', 'w') as f:
         f.write('%d' % calib_factor)
@@ -27,59 +147,240 @@ def generate_new_topas_beam_profile(anode_voltage:float, exposure:float, Histori
         f.write('\n')
         f.write(summary_of_inputs)
 
-    #normalising fluence by the total fluence to get weights for each energy bin 
-    normalised_spec = spkarr/s.get_flu()
-    #check that all weights sum up close to one
-    # print(sum(normalised_spec))
+    write_topas_spectrum(path +'/tmp/ConvertedTopasFile.txt', karr, normalised_spec, spectrum_type=spectrum_type)
+    return rebin_report
+
+
+def spectral_moments(energies: np.ndarray, weights: np.ndarray) -> Dict[str, float]:
+    """Fluence, mean energy and air-kerma-weighted mean energy of a binned spectrum.
+
+    The air kerma of a bin is proportional to fluence * E * muen/rho(air, E), muen/rho is taken from Muen.dat.
+    """
+    energies = np.asarray(energies, dtype=float)
+    weights = np.asarray(weights, dtype=float)
+    _, muen_air = mass_coefficients(AIR, energies)
+    kerma = weights * energies * muen_air
+    return {
+        'fluence': float(weights.sum()),
+        'mean_energy': float((weights * energies).sum() / weights.sum()),
+        'air_kerma': float(kerma.sum()),
+        'kerma_weighted_mean_energy': float((kerma * energies).sum() / kerma.sum()),
+    }
+
+
+def sampled_spectrum(energies: np.ndarray, weights: np.ndarray, spectrum_type: str = CONTINUOUS,
+                     trim: float = 0.000001, decimals: int = 6, subdivisions: int = 16):
+    """Energies and weights of the spectrum TOPAS samples from a written spectrum, for spectral_moments.
 
-    normalised_spec_trimmed = []
-    for i in normalised_spec:
-        if i >0.000001:
-            #normalised_spec_trimmed.append(float(format(i, '.6f')))
-            normalised_spec_trimmed.append(float(format(i, '.6f')))
-        else:
-            normalised_spec_trimmed.append(0)
-
-    np.set_printoptions(suppress=True) #suppress removes scientific notation
-    weightedFluence = np.asarray(normalised_spec_trimmed)
-    weightedFluence = np.insert(weightedFluence, 0, weightedFluence.size)
-    energySpectrum = np.insert(karr, 0, karr.size)
-    energySpectrum = np.delete(energySpectrum, 0)
-    weightedFluence = np.delete(weightedFluence, 0)
-    convertedFile = "dv:So/beam/BeamEnergySpectrumValues = " + str(energySpectrum.size) + "\n " \
-                    + str(energySpectrum)[1:-1] + " keV \n" \
-                    + "\n uv:So/beam/BeamEnergySpectrumWeights = " + str(weightedFluence.size) + "\n "\
-                    + str(weightedFluence)[1:-1]
-
-
-    with open(path +'/tmp/ConvertedTopasFile.txt', 'w') as f:
+    The weights are trimmed and rounded as write_topas_spectrum writes them. A Discrete spectrum is sampled as written,
+    a Continuous one as the density interpolated linearly between the energies, here split into subdivisions points per
+    interval. The weights keep the written total.
+    """
+    energies = np.asarray(energies, dtype=float)
+    weights = trim_weights(weights, trim, decimals)
+    if spectrum_type == DISCRETE or energies.size < 2:
+        return energies, weights
+    fractions = (np.arange(subdivisions) + 0.5) / subdivisions
+    widths = np.diff(energies)[:, None]
+    points = energies[:-1, None] + widths * fractions
+    density = weights[:-1, None] + (weights[1:] - weights[:-1])[:, None] * fractions
+    sampled = (density * widths).ravel()
+    return points.ravel(), sampled * weights.sum() / sampled.sum()
+
+
+def _merge_bins(energies: np.ndarray, weights: np.ndarray, kerma_fraction: np.ndarray, groups: int):
+    # Group boundaries at equal steps of cumulative air kerma, so groups stay narrow where the dose comes from
+    cuts = np.searchsorted(kerma_fraction, np.linspace(0., 1., groups + 1)[1:-1], side='right')
+    starts = np.unique(np.concatenate(([0], cuts)))
+    starts = starts[starts < energies.size]
+    group_weights = np.add.reduceat(weights, starts)
+    means = np.add.reduceat(weights * energies, starts) / group_weights
+    sizes = np.diff(np.append(starts, energies.size))
+    deviations = energies - np.repeat(means, sizes)
+    variances = np.add.reduceat(weights * deviations ** 2, starts) / group_weights
+    third_moments = np.add.reduceat(weights * deviations ** 3, starts) / group_weights
+    # Two point quadrature of every group: the pair of lines that keeps the fluence and the first three energy moments
+    # of the group, so mean energy is exact and the kerma, smooth in E within a group, is integrated to third order
+    skew = np.divide(third_moments, variances, out=np.zeros_like(variances), where=variances > 0)
+    root = np.sqrt(skew ** 2 + 4 * variances)
+    low, high = (skew - root) / 2, (skew + root) / 2
+    spread = np.where(variances > 0, high - low, 1.)
+    low_weights = np.where(variances > 0, group_weights * high / spread, group_weights)
+    high_weights = group_weights - low_weights
+    merged_energies = np.column_stack((means + low, means + high)).ravel()
+    merged_weights = np.column_stack((low_weights, high_weights)).ravel()
+    lines = merged_weights > 0 # groups of a single bin have one line
+    return merged_energies[lines], merged_weights[lines]
+
+
+def rebin_spectrum(energies: np.ndarray, weights: np.ndarray, bins: Optional[int] = None,
+                   tolerance: Optional[float] = None):
+    """Merges adjacent spectrum bins to reduce the number of bins TOPAS has to sample from.
+
+    The bins are grouped at equal steps of cumulative air kerma and each group is replaced by two lines that keep its
+    fluence and its first three energy moments. Total fluence and mean energy of the spekpy bins are conserved exactly,
+    the air kerma and the air-kerma-weighted mean energy to the third order of the energy spread of a group. The new
+    lines are uneven and have to be written as a Discrete spectrum (generate_new_topas_beam_profile does).
+
+    The report compares what TOPAS samples, the original bins as a Continuous spectrum against the new lines as a
+    Discrete one (see sampled_spectrum), so it also holds the small difference between the Continuous reading and the
+    spekpy bins.
+
+    Args:
+        energies (np.ndarray): Bin energies in keV, on the even spekpy grid.
+        weights (np.ndarray): Fluence (or normalised fluence) per bin.
+        bins (int, optional): Target number of lines, two per group.
+        tolerance (float, optional): Largest accepted relative error of the spectral moments. When given without bins,
+            the smallest line count meeting it is used. When given with bins, bins is the starting point.
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray, dict]: New energies, new weights and the moment report (see spectral_moments).
+    """
+    if bins is None and tolerance is None:
+        raise ValueError('rebin_spectrum needs a target number of bins or a tolerance')
+    energies = np.asarray(energies, dtype=float)
+    weights = np.asarray(weights, dtype=float)
+    reference = spectral_moments(*sampled_spectrum(energies, weights, CONTINUOUS))
+    populated = weights > 0 # empty bins below the low energy cutoff do not need a bin of their own
+    energies, weights = energies[populated], weights[populated]
+    _, muen_air = mass_coefficients(AIR, energies)
+    kerma = weights * energies * muen_air
+    kerma_fraction = np.cumsum(kerma) / kerma.sum()
+
+    groups = min(max(1, (bins if bins is not None else 2) // 2), energies.size)
+    while True:
+        merged_energies, merged_weights = _merge_bins(energies, weights, kerma_fraction, groups)
+        report = _rebin_report(reference, spectral_moments(*sampled_spectrum(merged_energies, merged_weights,
+                                                                             DISCRETE)))
+        if tolerance is None or report['max_relative_error'] <= tolerance or groups >= energies.size:
+            break
+        groups = min(energies.size, max(groups + 1, int(groups * 1.25)))
+    report['bins_in'] = int(populated.size)
+    report['bins_out'] = int(merged_energies.size)
+    return merged_energies, merged_weights, report
+
+
+def _rebin_report(reference: Dict[str, float], rebinned: Dict[str, float]) -> dict:
+    report = {'reference': reference, 'rebinned': rebinned, 'relative_error': {}}
+    for moment, value in reference.items():
+        report['relative_error'][moment] = abs(rebinned[moment] - value) / abs(value)
+    report['max_relative_error'] = max(report['relative_error'].values())
+    return report
+
+
+def format_rebin_report(report: dict) -> str:
+    """Text version of the rebin_spectrum report, written into head_calibration_factor.txt."""
+    lines = ['Spectrum rebinned from ' + str(report['bins_in']) + ' Continuous bins to ' + str(report['bins_out'])
+             + ' Discrete lines, moments as sampled by TOPAS']
+    for moment, error in report['relative_error'].items():
+        lines.append(moment + ': ' + format(report['reference'][moment], '.6g') + ' -> '
+                     + format(report['rebinned'][moment], '.6g') + ' (relative error ' + format(error, '.3e') + ')')
+    return '\n'.join(lines) + '\n'
+
+
+def trim_weights(weights: np.ndarray, trim: float = 0.000001, decimals: int = 6) -> np.ndarray:
+    """Weights as written to TOPAS, those at or below trim set to 0 and the rest rounded to decimals."""
+    weights = np.asarray(weights, dtype=float)
+    return np.where(weights > trim, np.round(weights, decimals), 0.)
+
+
+def write_topas_spectrum(filepath: str, energies: np.ndarray, weights: np.ndarray, trim: float = 0.000001,
+                         decimals: int = 6, values_per_line: int = 10, spectrum_type: str = CONTINUOUS) -> None:
+    """Writes the So/beam/BeamEnergySpectrumType, BeamEnergySpectrumValues and BeamEnergySpectrumWeights parameters
+    for TOPAS.
+
+    Weights at or below trim are set to 0 and the rest rounded to decimals, as a whole array. Every value is written
+    out explicitly, numpy's print summarisation ("...") is never involved so any number of bins is safe.
+
+    Args:
+        filepath (str): Output include file, usually tmp/ConvertedTopasFile.txt.
+        energies (np.ndarray): Bin energies in keV.
+        weights (np.ndarray): Normalised fluence per bin.
+        trim (float): Weights at or below this value are written as 0.
+        decimals (int): Number of decimals kept for the weights.
+        values_per_line (int): Number of values on each line of the file.
+        spectrum_type (str): 'Continuous' for the even spekpy grid, 'Discrete' for lines on an uneven grid.
+    """
+    energies = np.asarray(energies, dtype=float)
+    weights = np.asarray(weights, dtype=float)
+    if energies.size != weights.size:
+        raise ValueError('Spectrum has ' + str(energies.size) + ' energies but ' + str(weights.size) + ' weights')
+    trimmed_weights = trim_weights(weights, trim, decimals)
+
+    convertedFile = 's:So/beam/BeamEnergySpectrumType = "' + spectrum_type + '"\n\n' \
+                    + "dv:So/beam/BeamEnergySpectrumValues = " + str(energies.size) + "\n" \
+                    + _format_topas_vector(np.char.mod('%.15g', energies), values_per_line) + " keV\n" \
+                    + "\nuv:So/beam/BeamEnergySpectrumWeights = " + str(trimmed_weights.size) + "\n" \
+                    + _format_topas_vector(np.char.mod('%.' + str(decimals) + 'f', trimmed_weights), values_per_line) + "\n"
+    with open(filepath, 'w') as f:
         f.write(convertedFile)
-        # ...
 
-def parse_topas_file(filepath):
-    """Parse the TOPAS energy spectrum file."""
+
+def _format_topas_vector(tokens: np.ndarray, values_per_line: int) -> str:
+    # TOPAS accepts vector values split over several lines, this keeps the file readable for QA
+    lines = [' '.join(tokens[i:i + values_per_line]) for i in range(0, tokens.size, values_per_line)]
+    return '\n'.join(' ' + line for line in lines)
+
+
+# <type>:<name> = <count> <values...>, the values may continue on the following lines
+_VECTOR_PARAMETER = re.compile(r'^\s*(?P<type>\w+):(?P<name>\S+?)\s*=\s*(?P<count>\d+)(?P<rest>.*)$')
+# Unit words such as keV or MeV, numbers with exponents (1e-05) are not matched as the e follows a digit
+_UNIT_WORD = re.compile(r'(?<![\w.+-])[A-Za-z][\w/]*')
+
+
+def read_topas_vectors(filepath: str, names: list) -> Dict[str, np.ndarray]:
+    """Reads vector parameters (dv:, uv:, iv: ...) from a TOPAS parameter file by name.
+
+    The file is streamed line by line, the lines belonging to each requested parameter are parsed in bulk with numpy.
+    Parameter names are matched case insensitively as in TOPAS, units and comments are ignored.
+
+    Args:
+        filepath (str): TOPAS parameter file.
+        names (list): Parameter names without type prefix, eg. 'So/beam/BeamEnergySpectrumValues'.
+
+    Returns:
+        Dict[str, np.ndarray]: Values of each parameter, keyed by the names as given.
+
+    Raises:
+        ValueError: If a parameter is missing or has fewer values than its declared count.
+    """
+    wanted = {name.lower(): name for name in names}
+    chunks = {}
+    counts = {}
+    current = None
+    remaining = 0
     with open(filepath, 'r') as f:
-        content = f.read()
-    
-    # Split by the TOPAS parameter markers
-    parts = content.split('dv:So/beam/BeamEnergySpectrumValues = 620')
-    if len(parts) < 2:
-        raise ValueError("Could not find energy values in file")
-    
-    energy_part = parts[1].split('uv:So/beam/BeamEnergySpectrumWeights = 620')[0]
-    weight_part = parts[1].split('uv:So/beam/BeamEnergySpectrumWeights = 620')[1]
-    
-    # Parse energy values - handle 'keV' suffix
-    energy_str = energy_part.replace('\n', ' ').strip()
-    energy_tokens = [x.replace('keV', '') for x in energy_str.split() if x.strip()]
-    energies = [float(x) for x in energy_tokens if x]
-    
-    # Parse weight values
-    weight_str = weight_part.replace('\n', ' ').strip()
-    weight_tokens = [x for x in weight_str.split() if x.strip()]
-    weights = [float(x) for x in weight_tokens if x]
-    
-    return np.array(energies), np.array(weights)
+        for line in f:
+            text = line.split('#', 1)[0]
+            if current is None:
+                match = _VECTOR_PARAMETER.match(text)
+                if match is None or match.group('name').lower() not in wanted:
+                    continue
+                current = wanted[match.group('name').lower()]
+                remaining = counts[current] = int(match.group('count'))
+                chunks[current] = []
+                text = match.group('rest')
+            values = np.fromstring(_UNIT_WORD.sub(' ', text), sep=' ')
+            chunks[current].append(values)
+            remaining -= values.size
+            if remaining <= 0:
+                current = None
+
+    vectors = {}
+    for name in names:
+        if name not in chunks:
+            raise ValueError('Could not find ' + name + ' in ' + filepath)
+        values = np.concatenate(chunks[name]) if chunks[name] else np.empty(0)
+        if values.size != counts[name]:
+            raise ValueError(name + ' declares ' + str(counts[name]) + ' values but ' + str(values.size) + ' were found')
+        vectors[name] = values
+    return vectors
+
+
+def parse_topas_file(filepath):
+    """Parse the TOPAS energy spectrum file, for any number of bins."""
+    vectors = read_topas_vectors(filepath, ['So/beam/BeamEnergySpectrumValues', 'So/beam/BeamEnergySpectrumWeights'])
+    return vectors['So/beam/BeamEnergySpectrumValues'], vectors['So/beam/BeamEnergySpectrumWeights']
 
 def plot_spectrum(energies, weights, output_file='spectrum_plot.png'):
     """Plot the energy spectrum."""
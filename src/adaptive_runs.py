@@ -0,0 +1,247 @@
+# Adaptive history control: instead of guessing the number of histories, a run is simulated in batches with fresh seeds
+# until the relative standard error of a chosen quantity reaches a target, or a history or time budget runs out.
+# Every batch is a seeded copy of the run files (see sharding.render_seeded_copy), after each batch its outputs are merged
+# into the outputs of the batches before it under the original file names, so the run folder always holds the combined
+# result. The history count and uncertainty after every batch are written to adaptive_report.json/.csv in the run folder.
+import os
+import csv
+import json
+import time
+import shutil
+from typing import Dict, List, NamedTuple, Optional, Tuple, Union
+
+import numpy as np
+from pydicom import dcmread
+
+from src.ctdi_analysis import analyse_ctdi_run, json_safe
+from src.dose_summation import sum_dose_grids
+from src.job_scheduler import JobScheduler, get_scheduler, parameter_file_job, wait_for_jobs
+from src.sharding import (SeedStream, chain_value, find_scorers, histories_per_run_count, load_parameter_chain,
+                          render_seeded_copy)
+from src.topas_outputs import merge_topas_csv, scorer_output_files
+
+ADAPTIVE_REPORT = 'adaptive_report'
+MIN_BATCHES = 2 # batch based uncertainties need at least two batches
+
+
+class AdaptiveTarget(NamedTuple):
+    relative_error: float # stop when the relative standard error of the metric is at or below this, eg. 0.01
+    batch_histories: int # histories per batch and run file, over all sequential times
+    max_histories: Optional[int] = None # budget of histories per run file
+    max_seconds: Optional[float] = None # wall time budget, checked after every batch
+    threads_per_batch: Optional[int] = None # overrides i:Ts/NumberOfThreads of the batch files
+
+
+class CtdiwMetric:
+    """CTDIw of the merged plug outputs and its standard error, from ctdi_analysis.analyse_ctdi_run.
+
+    Args:
+        scorer_tag (str): Plug scorer the CTDIw is taken from, 'tle', 'dtm' or 'dtw'.
+    """
+
+    def __init__(self, scorer_tag: str = 'dtm'):
+        self.scorer_tag = scorer_tag
+        self.name = 'CTDIw_' + scorer_tag
+
+    def evaluate(self, rundatadir: str, batches: List[Dict[str, object]]) -> Tuple[float, float]:
+        ctdi_w = analyse_ctdi_run(rundatadir)['ctdi_w'][self.scorer_tag]
+        return ctdi_w['value'], ctdi_w['uncertainty']
+
+
+class DicomRoiMetric:
+    """Mean dose in a region of the DICOM dose grid, with the standard error from the spread of the batch means.
+
+    TOPAS DICOM outputs only hold the summed dose, so the uncertainty comes from the batches: with x_b the ROI mean
+    dose per history of batch b and N_b its histories, SE^2 = sum(N_b (x_b - m)^2) / ((B - 1) sum(N_b)) around the
+    history weighted mean m.
+
+    Args:
+        roi (np.ndarray or tuple of slices, optional): Boolean mask or index of the dose grid (frames, rows, columns).
+            Defaults to the voxels at or above relative_threshold of the maximum of the merged dose.
+        relative_threshold (float): Threshold of the default region.
+        scorer (str, optional): DICOM scorer, defaults to the first DICOM scorer of the run.
+    """
+
+    def __init__(self, roi: Optional[Union[np.ndarray, tuple]] = None, relative_threshold: float = 0.5,
+                 scorer: Optional[str] = None):
+        self.roi = roi
+        self.relative_threshold = relative_threshold
+        self.scorer = scorer
+        self.name = 'DICOM_ROI_mean_dose'
+
+    def _region(self, dose: np.ndarray):
+        if self.roi is None:
+            return dose >= self.relative_threshold * dose.max()
+        return self.roi
+
+    def evaluate(self, rundatadir: str, batches: List[Dict[str, object]]) -> Tuple[float, float]:
+        merged = batches[-1]['merged']
+        parameter_file = next(iter(merged))
+        scorer = self.scorer or next(name for name, path in merged[parameter_file].items() if path.endswith('.dcm'))
+        region = self._region(read_dicom_dose(merged[parameter_file][scorer]))
+        histories = np.array([batch['histories'][parameter_file] for batch in batches], dtype=float)
+        per_history = np.array([read_dicom_dose(batch['outputs'][parameter_file][scorer])[region].mean()
+                                for batch in batches]) / histories
+        mean = float(np.sum(histories * per_history) / histories.sum())
+        if len(batches) < MIN_BATCHES:
+            return mean * histories.sum(), np.inf
+        variance = np.sum(histories * (per_history - mean) ** 2) / ((len(batches) - 1) * histories.sum())
+        return mean * histories.sum(), float(np.sqrt(variance) * histories.sum())
+
+
+def read_dicom_dose(filepath: str) -> np.ndarray:
+    dataset = dcmread(filepath)
+    return dataset.pixel_array.astype(np.float64) * float(dataset.DoseGridScaling)
+
+
+def _accumulate(merged_path: str, batch_path: str, merged_histories: int, batch_histories: int) -> None:
+    """Merges one batch output into the running merged output (the pooled merge is associative)."""
+    if merged_histories == 0:
+        shutil.copyfile(batch_path, merged_path)
+    elif batch_path.endswith('.csv'):
+        merge_topas_csv([merged_path, batch_path], [merged_histories, batch_histories], merged_path)
+    elif batch_path.endswith('.dcm'):
+        sum_dose_grids([merged_path, batch_path], merged_path)
+
+
+def rescale_calibration_factor(rundatadir: str, nominal_histories: int, used_histories: int) -> None:
+    """Rewrites the factor in head_calibration_factor.txt for the histories actually simulated.
+
+    The factor is number of particles / histories of the original run file, doses summed over used_histories need
+    the factor times nominal_histories / used_histories.
+    """
+    filepath = os.path.join(rundatadir, 'head_calibration_factor.txt')
+    if not os.path.isfile(filepath) or used_histories == 0:
+        return
+    with open(filepath, 'r') as f:
+        lines = f.readlines()
+    factor = float(lines[0].split()[0])
+    lines[0] = '%d\n' % (factor * nominal_histories / used_histories)
+    lines.append('\nAdaptive run: factor rescaled from ' + format(factor, '.0f') + ' for ' + str(used_histories)
+                 + ' histories instead of ' + str(nominal_histories) + '\n')
+    with open(filepath, 'w') as f:
+        f.writelines(lines)
+
+
+def run_adaptive(parameter_files: List[str], topas_application_path: str, target: AdaptiveTarget, metric,
+                 scheduler: Optional[JobScheduler] = None, priority: int = 0) -> Dict[str, object]:
+    """Runs batches of all parameter files until the metric reaches the target relative standard error.
+
+    Every batch runs each parameter file once with target.batch_histories histories and a new seed from the file's
+    seed stream. The batch outputs are merged into the original output names and the metric is evaluated on them.
+    Histories are counted per file (batch['histories'][parameter_file]), files with other sequential times round the
+    batch to another whole number of histories per run.
+
+    Args:
+        parameter_files (List[str]): Rendered run files in one run folder, eg. the 5 CTDI plug files.
+        topas_application_path (str): TOPAS executable.
+        target (AdaptiveTarget): Uncertainty target and budgets.
+        metric: CtdiwMetric, DicomRoiMetric or any object with a name and evaluate(rundatadir, batches) returning the
+            value and its standard error.
+        scheduler (JobScheduler, optional): Defaults to the shared scheduler.
+        priority (int): Queue priority of the batch jobs.
+
+    Returns:
+        Dict[str, object]: The report, also written to adaptive_report.json and adaptive_report.csv. 'stop_reason' is
+        'target', 'histories', 'time' or 'failed'.
+    """
+    scheduler = scheduler or get_scheduler()
+    rundatadir = os.path.dirname(os.path.abspath(parameter_files[0]))
+    runs_setup = {}
+    for parameter_file in parameter_files:
+        chain = load_parameter_chain(parameter_file)
+        histories, runs = histories_per_run_count(chain)
+        seed = int(chain_value(chain, 'Ts/Seed', '1').split()[0])
+        runs_setup[parameter_file] = {'template': chain[0], 'scorers': find_scorers(chain), 'runs': runs,
+                                      'nominal_histories': histories * runs, 'seeds': SeedStream(seed)}
+
+    batches, rows = [], []
+    merged_histories = {parameter_file: 0 for parameter_file in runs_setup}
+    stop_reason = None
+    start = time.time()
+    while stop_reason is None:
+        index = len(batches)
+        suffix = '_batch' + format(index, '02d')
+        copies, futures, batch_histories = {}, [], {}
+        for parameter_file, setup in runs_setup.items():
+            histories_per_run = max(1, -(-target.batch_histories // setup['runs']))
+            batch_histories[parameter_file] = histories_per_run * setup['runs']
+            copies[parameter_file] = render_seeded_copy(setup['template'], setup['scorers'], parameter_file, suffix,
+                                                        setup['seeds'].take(1)[0], histories_per_run,
+                                                        target.threads_per_batch)
+            job = parameter_file_job(topas_application_path, copies[parameter_file]['file'], rundatadir, priority)
+            futures.append(scheduler.submit(job))
+        exit_codes = wait_for_jobs(futures)
+        if any(exit_codes):
+            stop_reason = 'failed'
+            break
+
+        batch = {'index': index, 'histories': batch_histories, 'seeds': {}, 'outputs': {}, 'merged': {}}
+        for parameter_file, copy in copies.items():
+            batch['seeds'][parameter_file] = copy['seed']
+            batch['outputs'][parameter_file], batch['merged'][parameter_file] = {}, {}
+            for scorer, output_name in copy['outputs'].items():
+                files = scorer_output_files(rundatadir, output_name)
+                if not files:
+                    continue
+                extension = os.path.splitext(files[0])[1]
+                merged_path = os.path.join(rundatadir, runs_setup[parameter_file]['scorers'][scorer]['output_file']
+                                           + extension)
+                _accumulate(merged_path, files[0], merged_histories[parameter_file], batch_histories[parameter_file])
+                batch['outputs'][parameter_file][scorer] = files[0]
+                batch['merged'][parameter_file][scorer] = merged_path
+        for parameter_file in merged_histories:
+            merged_histories[parameter_file] += batch_histories[parameter_file]
+        batch['cumulative_histories'] = dict(merged_histories)
+        batches.append(batch)
+        # the report counts the histories of the first file, as the calibration factor (all CTDI plug files agree)
+        histories = next(iter(merged_histories.values()))
+
+        value, standard_error = metric.evaluate(rundatadir, batches)
+        relative_error = standard_error / abs(value) if value else np.inf
+        elapsed = time.time() - start
+        rows.append({'batch': index, 'histories': histories, 'value': value, 'standard_error': standard_error,
+                     'relative_error': relative_error, 'elapsed_seconds': elapsed})
+        if relative_error <= target.relative_error and len(batches) >= MIN_BATCHES:
+            stop_reason = 'target'
+        elif target.max_histories is not None and any(merged_histories[parameter_file] + batch_histories[parameter_file]
+                                                      > target.max_histories for parameter_file in merged_histories):
+            stop_reason = 'histories'
+        elif target.max_seconds is not None and elapsed * (len(batches) + 1) / len(batches) > target.max_seconds:
+            stop_reason = 'time' # the next batch would not finish within the budget
+
+    if len(batches) >= MIN_BATCHES:
+        # the running sums of DICOM outputs are summed again over all batches for the per voxel standard error
+        for parameter_file, merged in batches[-1]['merged'].items():
+            for scorer, merged_path in merged.items():
+                if merged_path.endswith('.dcm'):
+                    sum_dose_grids([batch['outputs'][parameter_file][scorer] for batch in batches], merged_path,
+                                   [batch['histories'][parameter_file] for batch in batches], replicates=True)
+
+    first_file = next(iter(runs_setup))
+    nominal, histories = runs_setup[first_file]['nominal_histories'], merged_histories[first_file]
+    rescale_calibration_factor(rundatadir, nominal, histories)
+    report = {'metric': metric.name, 'target_relative_error': target.relative_error, 'stop_reason': stop_reason,
+              'histories': histories, 'nominal_histories': nominal,
+              'histories_per_file': {os.path.basename(parameter_file): count
+                                     for parameter_file, count in merged_histories.items()},
+              'batches': rows}
+    if rows:
+        last = rows[-1]
+        # with the standard error falling as 1/sqrt(N), histories needed for the target from the last estimate
+        report['projected_histories_for_target'] = (int(np.ceil(histories * (last['relative_error']
+                                                    / target.relative_error) ** 2))
+                                                    if np.isfinite(last['relative_error']) else None)
+    write_adaptive_report(report, rundatadir)
+    return report
+
+
+def write_adaptive_report(report: Dict[str, object], rundatadir: str) -> None:
+    """Writes the report as adaptive_report.json and the per batch rows (histories against uncertainty) as CSV."""
+    with open(os.path.join(rundatadir, ADAPTIVE_REPORT + '.json'), 'w') as f:
+        json.dump(json_safe(report), f, indent=2)
+    with open(os.path.join(rundatadir, ADAPTIVE_REPORT + '.csv'), 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=['batch', 'histories', 'value', 'standard_error', 'relative_error',
+                                               'elapsed_seconds'])
+        writer.writeheader()
+        writer.writerows(report['batches'])
@@ -0,0 +1,391 @@
+# Per-angle dose library of one patient and head setting. The dose of an arc is the sum of the doses of its gantry
+# angles, so a CBCT protocol, its clockwise or anticlockwise variant, another start angle or a kV-kV angle set only
+# change which angles are summed and with which weights. The run folder of a DICOM run is simulated once over 360 deg:
+# its headsourcecode.txt is rendered with bins x runs_per_bin sequential times, the gantry (Tf/Rotate) turning 360 deg
+# over the timeline, and split with arc_splitting.render_arcs into one job per angular bin. Bin b covers the gantry
+# angles [b w, (b + 1) w) of Tf/Rotate/Value, w = 360 / bins, its runs sit at the centres of equal sub-bins.
+# The bin doses are kept as one uint16 stack (bins, z, y, x) with a scale per bin (bin_doses.npy, bin_scales.npy), half
+# the size of 32 bit RTDOSE files, memory-mapped when composing. A protocol sampled at the gantry angles t_i of its
+# sequential times with h histories per run is composed as
+#   D = sum_i h * D(t_i) / H,   D(t) interpolated linearly between the two nearest bin centres, H the histories of a bin,
+# i.e. the dose the protocol run reports before calibration, and written as an RTDOSE slab by slab. The library is
+# bound to the spectrum, fan and blades it was simulated with; the exposure only changes the calibration factor.
+import os
+import json
+import time
+from typing import Dict, List, Optional, Sequence
+
+import numpy as np
+from pydicom import dcmread
+
+from src.arc_splitting import linear_time_features, record_arc_results, render_arcs, save_manifest, submit_pending_arcs
+from src.defaultvalues import default_ANGULAR_BINS, default_ANGULAR_RUNS_PER_BIN, default_TIME_SEQ_TIME
+from src.dose_analysis import DEFAULT_CHUNK_SLICES, DoseGrid
+from src.dose_summation import write_dose_grid
+from src.Energyspectrum import generate_new_topas_beam_profile
+from src.imaging_modes_lookuptable import imaging_modes_lookup
+from src.job_scheduler import JobScheduler
+from src.phase_space import FAN_FILES, head_settings
+from src.run_cache import file_digest, link_or_copy
+from src.sharding import SeedStream, histories_per_run_count
+from src.topas_outputs import scorer_output_files
+from src.topas_parameters import TopasParameterFile, chain_value, find_scorers, length_mm, load_parameter_chain
+
+LIBRARY_DIR = 'angular_library'
+FULL_ROTATION_FILE = 'angular_library.txt'
+LIBRARY_MANIFEST = 'library.json'
+BIN_DOSES = 'bin_doses.npy'
+BIN_SCALES = 'bin_scales.npy'
+DOSE_HEADER = 'dose_header.dcm'
+RUN_FILES = 'run'
+COMPOSITION_RECORD = 'composition.json'
+RUN_FILE = 'headsourcecode.txt'
+SPECTRUM_FILE = 'ConvertedTopasFile.txt'
+CALIBRATION_FILE = 'head_calibration_factor.txt'
+_UINT16_MAX = 2 ** 16 - 1
+
+
+def _number(value) -> float:
+    # '45 deg' -> 45., '0.4 deg/s' -> 0.4, 45 -> 45.
+    return float(str(value).split()[0])
+
+
+def render_full_rotation(parameter_file: str, bins: int, runs_per_bin: int,
+                         histories_per_run: Optional[int] = None) -> str:
+    """Writes angular_library.txt next to parameter_file: the run with bins * runs_per_bin sequential times over one
+    full gantry rotation, the first run at the centre of the first sub-bin.
+
+    Raises:
+        ValueError: If the run has no linear Tf/Rotate, or other time features whose timing would change.
+    """
+    chain = load_parameter_chain(parameter_file)
+    features = linear_time_features(chain)
+    if 'Rotate' not in features or len(features) > 1:
+        raise ValueError(parameter_file + ' needs the linear Tf/Rotate gantry rotation as its only time feature, it has '
+                         + (', '.join('Tf/' + feature for feature in features) or 'none'))
+    runs = bins * runs_per_bin
+    step_angle = 360. / runs
+    parameters = chain[0].copy()
+    parameters.set('i:Tf/NumberOfSequentialTimes', str(runs), 'i')
+    parameters.set('d:Tf/TimelineStart', '0 s', 'd')
+    parameters.set('d:Tf/TimelineEnd', str(runs) + ' s', 'd')
+    parameters.set('d:Tf/Rotate/Rate', format(step_angle, '.10g') + ' deg/s', 'd')
+    parameters.set('d:Tf/Rotate/StartValue', format(step_angle / 2, '.10g') + ' deg', 'd')
+    if histories_per_run is not None:
+        parameters.set('i:So/beam/NumberOfHistoriesInRun', str(int(histories_per_run)), 'i')
+    full_rotation = os.path.join(os.path.dirname(os.path.abspath(parameter_file)), FULL_ROTATION_FILE)
+    parameters.write(full_rotation)
+    return full_rotation
+
+
+def _pack_bins(bin_files: List[str], library_dir: str, chunk_slices: int) -> Dict[str, object]:
+    # uint16 stack of the bin doses with a scale per bin, and a header-only RTDOSE for the composed files
+    grids = [DoseGrid(filepath) for filepath in bin_files]
+    first = grids[0]
+    for grid in grids[1:]:
+        if grid.shape != first.shape or not np.allclose(grid.origin, first.origin, atol=1e-3) \
+                or not np.allclose(grid.spacing, first.spacing, atol=1e-4):
+            raise ValueError(grid.filepath + ' is not on the same dose grid as ' + first.filepath)
+    doses = np.lib.format.open_memmap(os.path.join(library_dir, BIN_DOSES), mode='w+', dtype=np.uint16,
+                                      shape=(len(grids),) + first.shape)
+    scales = np.ones(len(grids))
+    for index, grid in enumerate(grids):
+        maximum = grid.max(chunk_slices)
+        if maximum > 0:
+            scales[index] = maximum / _UINT16_MAX
+        for start, dose in grid.chunks(chunk_slices):
+            doses[index, start:start + dose.shape[0]] = np.clip(np.rint(dose / scales[index]), 0, _UINT16_MAX)
+    doses.flush()
+    del doses
+    np.save(os.path.join(library_dir, BIN_SCALES), scales)
+    dcmread(first.filepath, stop_before_pixels=True).save_as(os.path.join(library_dir, DOSE_HEADER),
+                                                             enforce_file_format=True)
+    return {'shape': list(first.shape), 'origin': list(first.origin), 'spacing': list(first.spacing)}
+
+
+def build_angular_library(rundatadir: str, topas_application_path: str, bins: int = default_ANGULAR_BINS,
+                          runs_per_bin: int = default_ANGULAR_RUNS_PER_BIN, library_dir: Optional[str] = None,
+                          histories_per_run: Optional[int] = None, base_seed: Optional[int] = None,
+                          threads_per_bin: Optional[int] = None, scheduler: Optional[JobScheduler] = None,
+                          priority: int = 0, chunk_slices: int = DEFAULT_CHUNK_SLICES) -> 'AngularDoseLibrary':
+    """Simulates the patient of a DICOM run folder over 360 deg in angular bins and stores the bin doses.
+
+    Args:
+        rundatadir (str): Run folder with the rendered headsourcecode.txt and its includes (eg. a finished DICOM run).
+        topas_application_path (str): TOPAS executable.
+        bins (int): Angular bins over 360 deg, one TOPAS job each.
+        runs_per_bin (int): Sequential times (gantry angles) per bin.
+        library_dir (str, optional): Defaults to <rundatadir>/angular_library.
+        histories_per_run (int, optional): Overrides i:So/beam/NumberOfHistoriesInRun.
+        base_seed (int, optional): Start of the bin seeds, defaults to the i:Ts/Seed of the run.
+        threads_per_bin (int, optional): Overrides i:Ts/NumberOfThreads of every bin.
+        scheduler (JobScheduler, optional): Defaults to the shared scheduler.
+        priority (int): Queue priority of the bins.
+        chunk_slices (int): Planes per slab when packing the bin doses.
+
+    Raises:
+        ValueError: If the run has no DICOM scorer or no linear gantry rotation.
+        RuntimeError: If a bin fails, the bins are in <rundatadir>/angular_library_arcs.json.
+    """
+    start_time = time.time()
+    parameter_file = os.path.join(rundatadir, RUN_FILE)
+    library_dir = os.path.abspath(library_dir or os.path.join(rundatadir, LIBRARY_DIR))
+    full_rotation = render_full_rotation(parameter_file, bins, runs_per_bin, histories_per_run)
+    chain = load_parameter_chain(full_rotation)
+    dose_scorers = [name for name, settings in find_scorers(chain).items() if settings['output_type'] == 'dicom']
+    if not dose_scorers:
+        raise ValueError('No DICOM scorer in ' + parameter_file)
+    seed = base_seed if base_seed is not None else int(chain_value(chain, 'Ts/Seed', '1').split()[0])
+    manifest = render_arcs(full_rotation, bins, SeedStream(seed), threads_per_bin)
+    save_manifest(manifest)
+    failed = record_arc_results(manifest, submit_pending_arcs(manifest, topas_application_path, scheduler, priority))
+    if failed:
+        raise RuntimeError('Angular bins failed: ' + ', '.join(manifest['arcs'][index]['file'] for index in failed))
+
+    os.makedirs(os.path.join(library_dir, RUN_FILES), exist_ok=True)
+    bin_files = [scorer_output_files(rundatadir, arc['outputs'][dose_scorers[0]])[0] for arc in manifest['arcs']]
+    grid = _pack_bins(bin_files, library_dir, chunk_slices)
+    for filepath in bin_files:
+        os.remove(filepath)
+    # the run files of the patient, composed doses are written into a copy of them
+    original = load_parameter_chain(parameter_file)
+    names = [RUN_FILE] + [name for parameters in original for name in parameters.include_files()]
+    for name in dict.fromkeys(names):
+        if os.path.isfile(os.path.join(rundatadir, name)):
+            link_or_copy(os.path.join(rundatadir, name), os.path.join(library_dir, RUN_FILES, name))
+
+    histories, _ = histories_per_run_count(chain)
+    spectrum = os.path.join(rundatadir, SPECTRUM_FILE)
+    library = {
+        'run_folder': os.path.abspath(rundatadir), 'bins': bins, 'runs_per_bin': runs_per_bin,
+        'bin_width': 360. / bins, 'histories_per_run': histories,
+        'bin_histories': [arc['histories'] for arc in manifest['arcs']], 'base_seed': seed,
+        'dose_scorer': dose_scorers[0], **grid, 'blades': head_settings(original[0])['blades'],
+        # runtime_handler stages only the fan file of the run
+        'fan': ' + '.join(fan for name, fan in FAN_FILES.items() if os.path.isfile(os.path.join(rundatadir, name))),
+        'spectrum_digest': file_digest(spectrum) if os.path.isfile(spectrum) else None,
+        'build_seconds': round(time.time() - start_time, 1),
+    }
+    with open(os.path.join(library_dir, LIBRARY_MANIFEST), 'w') as f:
+        json.dump(library, f, indent=2)
+    return AngularDoseLibrary(library_dir)
+
+
+class AngularDoseLibrary:
+    """Bin doses of a library written by build_angular_library, memory-mapped.
+
+    Attributes:
+        manifest (Dict[str, object]): Contents of library.json (bins, histories, grid, fan, blades, spectrum digest).
+        doses (np.ndarray): uint16 bin doses (bins, z, y, x).
+        scales (np.ndarray): Dose per stored value of every bin.
+    """
+
+    def __init__(self, library_dir: str):
+        self.library_dir = library_dir
+        with open(os.path.join(library_dir, LIBRARY_MANIFEST), 'r') as f:
+            self.manifest = json.load(f)
+        self.doses = np.load(os.path.join(library_dir, BIN_DOSES), mmap_mode='r')
+        self.scales = np.load(os.path.join(library_dir, BIN_SCALES))
+
+    @property
+    def bins(self) -> int:
+        return int(self.manifest['bins'])
+
+    @property
+    def histories_per_run(self) -> int:
+        return int(self.manifest['histories_per_run'])
+
+    def bin_centres(self) -> np.ndarray:
+        return (np.arange(self.bins) + 0.5) * self.manifest['bin_width']
+
+    def bin_weights(self, angles: Sequence[float], histories_per_angle: Optional[int] = None) -> np.ndarray:
+        """Weight of every bin dose in the dose of the gantry angles (deg), with histories_per_angle histories each
+        (default: the histories per run of the library)."""
+        histories = histories_per_angle or self.histories_per_run
+        weights = np.zeros(self.bins)
+        for angle in angles:
+            # linear interpolation between the two nearest bin centres, around the circle
+            position = (float(angle) % 360.) / self.manifest['bin_width'] - 0.5
+            lower = int(np.floor(position))
+            fraction = position - lower
+            weights[lower % self.bins] += 1. - fraction
+            weights[(lower + 1) % self.bins] += fraction
+        return weights * histories / np.asarray(self.manifest['bin_histories'], dtype=np.float64)
+
+    def compose(self, angles: Sequence[float], output_filepath: str, histories_per_angle: Optional[int] = None,
+                chunk_slices: int = DEFAULT_CHUNK_SLICES) -> Dict[str, object]:
+        """Writes the dose of the gantry angles as an RTDOSE, summing the weighted bin doses slab by slab.
+
+        Returns:
+            Dict[str, object]: 'output', 'max_dose', 'histories' (total of the composed run) and 'weights' per bin.
+        """
+        weights = self.bin_weights(angles, histories_per_angle)
+        used = np.flatnonzero(weights)
+        factors = weights * self.scales
+        shape = self.doses.shape[1:]
+        directory = os.path.dirname(os.path.abspath(output_filepath))
+        scratch = os.path.join(directory, '.' + os.path.basename(output_filepath) + '.sum' + str(os.getpid()))
+        total = np.memmap(scratch, dtype=np.float32, mode='w+', shape=shape)
+        try:
+            for start in range(0, shape[0], chunk_slices):
+                stop = min(start + chunk_slices, shape[0])
+                slab = np.zeros((stop - start,) + shape[1:], dtype=np.float64)
+                for index in used:
+                    slab += self.doses[index, start:stop] * factors[index]
+                total[start:stop] = slab
+            max_dose = write_dose_grid(total, os.path.join(self.library_dir, DOSE_HEADER), output_filepath,
+                                       chunk_slices, entropy=[self.library_dir] + [str(angle) for angle in angles])
+        finally:
+            del total
+            os.remove(scratch)
+        return {'output': output_filepath, 'max_dose': max_dose,
+                'histories': len(angles) * (histories_per_angle or self.histories_per_run),
+                'weights': weights.tolist()}
+
+
+def protocol_angles(protocol: str, start_angle: str, sequential_times: Optional[str] = None) -> List[float]:
+    """Gantry angles (Tf/Rotate/Value, deg) of the sequential times of a protocol run, as editor() renders it: the
+    rotation rate and timeline end of imaging_modes_lookup, the start angle and the number of sequential times."""
+    rotrate, _, _, _, timeend = imaging_modes_lookup[protocol][:5]
+    runs = int(sequential_times or default_TIME_SEQ_TIME)
+    step = _number(timeend) / runs
+    return [_number(start_angle) + _number(rotrate) * index * step for index in range(runs)]
+
+
+def protocol_head_differences(library: AngularDoseLibrary, protocol: str) -> List[str]:
+    """Fan and blade settings of the protocol that differ from the library's."""
+    values = imaging_modes_lookup[protocol]
+    differences = []
+    if values[3] != library.manifest['fan']:
+        differences.append('fan ' + values[3] + ' (library: ' + library.manifest['fan'] + ')')
+    for name, value, simulated in zip(['BLADE_X1', 'BLADE_X2', 'BLADE_Y1', 'BLADE_Y2'], values[9:13],
+                                      library.manifest['blades']):
+        if not simulated or abs(length_mm(value) - length_mm(simulated)) > 1e-6:
+            differences.append(name + ' ' + value + ' (library: ' + (simulated or 'unset') + ')')
+    return differences
+
+
+def compose_protocol(library_dir: str, protocol: str, start_angle: str, output_dir: str,
+                     sequential_times: Optional[str] = None, angles: Optional[Sequence[float]] = None,
+                     exposure: Optional[str] = None, histories_per_angle: Optional[int] = None,
+                     chunk_slices: int = DEFAULT_CHUNK_SLICES) -> Dict[str, object]:
+    """Composes the dose of an imaging protocol from a library into a run folder, without simulating.
+
+    The output folder gets the library's run files with the protocol timing, the composed dose under the scorer's
+    output name, ConvertedTopasFile.txt and head_calibration_factor.txt of the protocol kVp and exposure, so it is read
+    like a run folder (eg. DoseGrid.from_run, organ_dose_report.py). composition.json records the angles and weights.
+
+    Args:
+        library_dir (str): Folder written by build_angular_library.
+        protocol (str): Key of imaging_modes_lookup, eg. 'CBCT Anticlockwise_Head'.
+        start_angle (str): Gantry start angle of the protocol arc, eg. '45 deg'.
+        output_dir (str): Folder of the composed run.
+        sequential_times (str, optional): Sequential times of the protocol run, defaults to default_TIME_SEQ_TIME.
+        angles (Sequence[float], optional): Gantry angles to compose instead of the protocol arc, eg. a kV-kV pair.
+        exposure (str, optional): Overrides the protocol exposure, eg. '200 mAs'.
+        histories_per_angle (int, optional): Defaults to the histories per run of the library.
+
+    Raises:
+        ValueError: If the protocol's fan, blades or spectrum differ from the library's.
+    """
+    start_time = time.time()
+    library = AngularDoseLibrary(library_dir)
+    differences = protocol_head_differences(library, protocol)
+    if differences:
+        raise ValueError('The library was simulated with another head setting than ' + protocol + ': '
+                         + ', '.join(differences))
+    rotrate, voltage, protocol_exposure, _, timeend = imaging_modes_lookup[protocol][:5]
+    runs = sequential_times or default_TIME_SEQ_TIME
+    arc = angles is None
+    if arc:
+        angles = protocol_angles(protocol, start_angle, runs)
+    histories = histories_per_angle or library.histories_per_run
+
+    os.makedirs(os.path.join(output_dir, 'tmp'), exist_ok=True)
+    # the factor is per history of one run, as for a simulated protocol run with histories per sequential time
+    generate_new_topas_beam_profile(_number(voltage), _number(exposure or protocol_exposure), str(histories),
+                                    output_dir)
+    spectrum_digest = file_digest(os.path.join(output_dir, 'tmp', SPECTRUM_FILE))
+    if library.manifest['spectrum_digest'] not in (None, spectrum_digest):
+        raise ValueError('The library was simulated with another spectrum than ' + voltage + ' of ' + protocol)
+    run_files = os.path.join(library_dir, RUN_FILES)
+    for name in os.listdir(run_files):
+        link_or_copy(os.path.join(run_files, name), os.path.join(output_dir, name))
+    for name in [SPECTRUM_FILE, CALIBRATION_FILE]:
+        os.replace(os.path.join(output_dir, 'tmp', name), os.path.join(output_dir, name))
+    os.rmdir(os.path.join(output_dir, 'tmp'))
+
+    # the run file documents the composed protocol and names the dose output, angle sets are in composition.json
+    parameters = TopasParameterFile.from_file(os.path.join(output_dir, RUN_FILE))
+    if arc:
+        parameters.set('i:Tf/NumberOfSequentialTimes', str(runs), 'i')
+        parameters.set('d:Tf/TimelineEnd', timeend, 'd')
+        parameters.set('d:Tf/Rotate/Rate', rotrate, 'd')
+        parameters.set('d:Tf/Rotate/StartValue', start_angle, 'd')
+        output_name = protocol.replace(' ', '') + '_' + format(_number(start_angle), 'g') + 'deg_COMPOSED_DOSE'
+    else:
+        output_name = protocol.replace(' ', '') + '_' + '_'.join(format(float(angle), 'g') for angle in angles) \
+                      + 'deg_COMPOSED_DOSE'
+    parameters.set('i:So/beam/NumberOfHistoriesInRun', str(histories), 'i')
+    parameters.set('s:Sc/' + library.manifest['dose_scorer'] + '/OutputFile', '"' + output_name + '"', 's')
+    parameters.write(os.path.join(output_dir, RUN_FILE))
+
+    result = library.compose(angles, os.path.join(output_dir, output_name + '.dcm'), histories, chunk_slices)
+    result.update({'library': os.path.abspath(library_dir), 'protocol': protocol,
+                   'start_angle': start_angle if arc else None,
+                   'exposure': exposure or protocol_exposure, 'angles': [float(angle) for angle in angles],
+                   'seconds': round(time.time() - start_time, 2)})
+    with open(os.path.join(output_dir, COMPOSITION_RECORD), 'w') as f:
+        json.dump(result, f, indent=2)
+    return result
+
+
+def check_composition(composed_dir: str, simulated_dir: str, relative_threshold: float = 0.5, tolerance: float = 0.05,
+                      chunk_slices: int = DEFAULT_CHUNK_SLICES) -> Dict[str, object]:
+    """Compares the calibrated dose of a composed folder with a simulated run of the same arc and exposure.
+
+    Both doses are read like run folders (DoseGrid.from_run), so a wrong calibration factor of either shows up as a
+    constant ratio. The result is added to composition.json.
+
+    Args:
+        composed_dir (str): Folder written by compose_protocol.
+        simulated_dir (str): Run folder of the same protocol, start angle and exposure simulated with TOPAS.
+        relative_threshold (float): Voxels at or above this fraction of the maximum simulated dose are compared.
+        tolerance (float): Largest accepted relative difference of the mean dose over the compared voxels.
+
+    Returns:
+        Dict[str, object]: 'mean_dose_ratio' (composed / simulated), 'mean_absolute_difference' and
+        'max_absolute_difference' (relative to the maximum simulated dose), 'voxels_compared' and 'agrees'.
+
+    Raises:
+        ValueError: If the two dose grids differ in shape.
+    """
+    composed, simulated = DoseGrid.from_run(composed_dir), DoseGrid.from_run(simulated_dir)
+    if composed.shape != simulated.shape:
+        raise ValueError('Composed dose grid ' + str(composed.shape) + ' differs from the simulated '
+                         + str(simulated.shape))
+    maximum = simulated.max(chunk_slices) or 1.
+    composed_sum, simulated_sum, absolute_sum, absolute_max, voxels = 0., 0., 0., 0., 0
+    for start, simulated_dose in simulated.chunks(chunk_slices):
+        composed_dose = composed.slices(start, start + simulated_dose.shape[0])
+        region = simulated_dose >= relative_threshold * maximum
+        if not region.any():
+            continue
+        difference = np.abs(composed_dose[region] - simulated_dose[region]) / maximum
+        composed_sum += float(composed_dose[region].sum())
+        simulated_sum += float(simulated_dose[region].sum())
+        absolute_sum += float(difference.sum())
+        absolute_max = max(absolute_max, float(difference.max()))
+        voxels += int(region.sum())
+    ratio = composed_sum / simulated_sum if simulated_sum > 0 else float('nan')
+    check = {'simulated_dir': os.path.abspath(simulated_dir), 'mean_dose_ratio': ratio,
+             'mean_absolute_difference': absolute_sum / max(voxels, 1), 'max_absolute_difference': absolute_max,
+             'voxels_compared': voxels, 'agrees': bool(abs(ratio - 1.) <= tolerance)}
+    record_path = os.path.join(composed_dir, COMPOSITION_RECORD)
+    if os.path.isfile(record_path):
+        with open(record_path, 'r') as f:
+            record = json.load(f)
+        record['simulation_check'] = check
+        with open(record_path, 'w') as f:
+            json.dump(record, f, indent=2)
+    return check
@@ -0,0 +1,268 @@
+# Gantry arc splitting: the sequential times of one TOPAS run (eg. the 501 or 900 gantry angles of a CBCT protocol) are
+# split into N contiguous sub-arcs that run as independent TOPAS jobs. Sub-arc k covering the runs a .. a + n - 1 of the
+# timeline gets Tf/NumberOfSequentialTimes = n and Tf/TimelineEnd = TimelineStart + n * step, step being the time
+# between two sequential times, and the StartValue of every linear time feature (Tf/Rotate) is moved on by Rate * a *
+# step, so its runs see the same times as the runs of the full arc. i:So/beam/NumberOfHistoriesInRun is per run, so the
+# histories of a sub-arc are its share of the runs. Every sub-arc has its own i:Ts/Seed from a SeedStream and writes its
+# scorer outputs under an _arcNN suffix, the outputs are then merged into the output names of the original run: CSV
+# outputs with the pooled statistics of all histories (as the full arc reports them) and DICOM doses summed as parts.
+# As with shards, a manifest next to the sub-arc files records every sub-arc, so failed sub-arcs are rerun on their own.
+# The segments of a history allocation (history_allocation.py) are sub-arcs with their own histories per run, and their
+# outputs are scaled by the segment weights when merged.
+import os
+import re
+import json
+from concurrent.futures import Future
+from typing import Dict, List, Optional, Tuple
+
+from src.dose_summation import sum_dose_grids, uncertainty_file
+from src.job_scheduler import JobScheduler, get_scheduler, parameter_file_job, wait_for_jobs
+from src.sharding import SeedStream, histories_per_run_count, render_seeded_copy, run_sharded, split_histories
+from src.topas_outputs import merge_topas_csv, scorer_output_files
+from src.topas_parameters import TopasParameterFile, chain_value, find_scorers, load_parameter_chain
+
+ARC_SUFFIX = '_arc'
+_TIME_FEATURE_FUNCTION = re.compile(r'^Tf/(?P<feature>[^/]+)/Function$', re.IGNORECASE)
+_TIME_UNITS = {'ns': 1e-9, 'us': 1e-6, 'ms': 1e-3, 's': 1., 'min': 60., 'h': 3600.}
+
+
+def _quantity(value: str) -> Tuple[float, str]:
+    # '501 s' -> (501., 's'), '0.4 deg/s' -> (0.4, 'deg/s')
+    parts = value.split()
+    return float(parts[0]), ' '.join(parts[1:])
+
+
+def _seconds(value: str) -> float:
+    number, unit = _quantity(value)
+    if unit not in _TIME_UNITS:
+        raise ValueError('Unsupported time unit in ' + value)
+    return number * _TIME_UNITS[unit]
+
+
+def linear_time_features(chain: List[TopasParameterFile]) -> Dict[str, Dict[str, object]]:
+    """Time features of a parameter chain with their start value, rate and unit, eg. {'Rotate': {...}}.
+
+    Raises:
+        ValueError: If a time feature is not linear, its values could not be shifted to a sub-arc.
+    """
+    features = {}
+    for parameters in chain:
+        for name in parameters.names():
+            match = _TIME_FEATURE_FUNCTION.match(name)
+            if match is None or match.group('feature') in features:
+                continue
+            feature = match.group('feature')
+            function = chain_value(chain, name).strip('"').split()
+            if function[0].lower() != 'linear':
+                raise ValueError('Time feature Tf/' + feature + ' is ' + function[0] + ', only linear time features '
+                                 'can be split into sub-arcs')
+            unit = function[1] if len(function) > 1 else ''
+            start, _ = _quantity(chain_value(chain, 'Tf/' + feature + '/StartValue', '0 ' + unit))
+            rate, rate_unit = _quantity(chain_value(chain, 'Tf/' + feature + '/Rate', '0 ' + unit + '/s'))
+            rate_per_second = rate / _TIME_UNITS[rate_unit.split('/')[-1]] if '/' in rate_unit else rate
+            features[feature] = {'start_value': start, 'rate': rate_per_second, 'unit': unit}
+    return features
+
+
+def sequential_times(chain: List[TopasParameterFile]) -> List[float]:
+    """Time in s of every run of a parameter chain, TimelineStart + run * step as the runs of a sub-arc see them."""
+    _, runs = histories_per_run_count(chain)
+    timeline_start = _seconds(chain_value(chain, 'Tf/TimelineStart', '0 s'))
+    step = (_seconds(chain_value(chain, 'Tf/TimelineEnd', '1 s')) - timeline_start) / runs
+    return [timeline_start + run * step for run in range(runs)]
+
+
+def split_arc(runs: int, arcs: int) -> List[Tuple[int, int]]:
+    """Contiguous (first run, number of runs) of every sub-arc, sub-arcs that would get no run are dropped."""
+    counts = split_histories(runs, arcs)
+    firsts = [sum(counts[:index]) for index in range(len(counts))]
+    return list(zip(firsts, counts))
+
+
+def render_arcs(parameter_file: str, arcs: int, seed_stream: SeedStream, threads_per_arc: Optional[int] = None,
+                allocation: Optional[List[Dict[str, object]]] = None) -> Dict[str, object]:
+    """Writes the sub-arc parameter files next to parameter_file and returns the manifest describing them.
+
+    Args:
+        parameter_file (str): Rendered run file (eg. headsourcecode.txt or a CTDI plug file).
+        arcs (int): Number of sub-arcs, ignored with an allocation.
+        seed_stream (SeedStream): Source of the sub-arc seeds.
+        threads_per_arc (int, optional): Overrides i:Ts/NumberOfThreads of every sub-arc.
+        allocation (List[Dict[str, object]], optional): Segments of a history allocation (HistoryAllocation.segments),
+            every segment becomes a sub-arc with its first_run, runs, histories per run and weight.
+
+    Raises:
+        ValueError: If the run has a time feature that is not linear, or the allocation does not cover its runs.
+    """
+    chain = load_parameter_chain(parameter_file)
+    template = chain[0]
+    histories, runs = histories_per_run_count(chain)
+    scorers = find_scorers(chain)
+    features = linear_time_features(chain)
+    timeline_start = _seconds(chain_value(chain, 'Tf/TimelineStart', '0 s'))
+    step = (_seconds(chain_value(chain, 'Tf/TimelineEnd', '1 s')) - timeline_start) / runs
+
+    manifest = {'parameter_file': parameter_file, 'base_seed': seed_stream.base_seed, 'runs': runs,
+                'scorers': scorers, 'arcs': []}
+    if allocation is not None:
+        if sum(segment['runs'] for segment in allocation) != runs:
+            raise ValueError('History allocation does not cover the ' + str(runs) + ' runs of ' + parameter_file)
+        sub_arcs = [(segment['first_run'], segment['runs']) for segment in allocation]
+    else:
+        sub_arcs = split_arc(runs, arcs)
+    for index, ((first_run, arc_runs), seed) in enumerate(zip(sub_arcs, seed_stream.take(len(sub_arcs)))):
+        arc_histories = histories if allocation is None else allocation[index]['histories']
+        arc_template = template.copy()
+        arc_template.set('i:Tf/NumberOfSequentialTimes', str(arc_runs), 'i')
+        arc_template.set('d:Tf/TimelineEnd', format(timeline_start + arc_runs * step, '.10g') + ' s', 'd')
+        start_values = {}
+        for feature, settings in features.items():
+            start_values[feature] = settings['start_value'] + settings['rate'] * first_run * step
+            arc_template.set('d:Tf/' + feature + '/StartValue',
+                             (format(start_values[feature], '.10g') + ' ' + settings['unit']).strip(), 'd')
+        arc = render_seeded_copy(arc_template, scorers, parameter_file, ARC_SUFFIX + format(index, '02d'), seed,
+                                 arc_histories, threads_per_arc)
+        arc.update({'first_run': first_run, 'runs': arc_runs, 'histories': arc_histories * arc_runs,
+                    'start_values': start_values})
+        if allocation is not None:
+            arc['weight'] = allocation[index]['weight']
+        manifest['arcs'].append(arc)
+    manifest['seed_position'] = seed_stream.position
+    return manifest
+
+
+def manifest_path_for(parameter_file: str) -> str:
+    return os.path.splitext(parameter_file)[0] + '_arcs.json'
+
+
+def save_manifest(manifest: Dict[str, object]) -> str:
+    manifest_path = manifest_path_for(manifest['parameter_file'])
+    with open(manifest_path, 'w') as f:
+        json.dump(manifest, f, indent=2)
+    return manifest_path
+
+
+def load_manifest(manifest_path: str) -> Dict[str, object]:
+    with open(manifest_path, 'r') as f:
+        return json.load(f)
+
+
+def submit_pending_arcs(manifest: Dict[str, object], topas_application_path: str,
+                        scheduler: Optional[JobScheduler] = None, priority: int = 0) -> List[Tuple[int, Future]]:
+    """Submits every sub-arc that has not finished successfully, returns (sub-arc index, future) pairs."""
+    scheduler = scheduler or get_scheduler()
+    rundatadir = os.path.dirname(os.path.abspath(manifest['parameter_file']))
+    submitted = []
+    for index, arc in enumerate(manifest['arcs']):
+        if arc['exit_code'] == 0:
+            continue
+        job = parameter_file_job(topas_application_path, arc['file'], rundatadir, priority)
+        submitted.append((index, scheduler.submit(job)))
+    return submitted
+
+
+def record_arc_results(manifest: Dict[str, object], submitted: List[Tuple[int, Future]]) -> List[int]:
+    """Waits for submitted sub-arcs, stores their exit codes in the manifest and returns the indices of failed ones."""
+    exit_codes = wait_for_jobs([future for _, future in submitted])
+    for (index, _), exit_code in zip(submitted, exit_codes):
+        manifest['arcs'][index]['exit_code'] = exit_code
+    save_manifest(manifest)
+    return [index for index, arc in enumerate(manifest['arcs']) if arc['exit_code'] != 0]
+
+
+def merge_arcs(manifest: Dict[str, object]) -> Dict[str, str]:
+    """Merges the outputs of all sub-arcs into the output names of the original run.
+
+    CSV outputs are merged with topas_outputs.merge_topas_csv, whose pooled statistics over all histories are what the
+    full arc reports. DICOM doses are summed as parts with dose_summation.sum_dose_grids, adding the variances of the
+    sub-arcs where each has an uncertainty file (eg. sharded sub-arcs). Sub-arcs of a history allocation are scaled by
+    their weights.
+
+    Returns:
+        Dict[str, str]: Scorer name to merged output file.
+
+    Raises:
+        RuntimeError: If a sub-arc has not finished successfully, rerun it with submit_pending_arcs first.
+    """
+    failed = [arc['file'] for arc in manifest['arcs'] if arc['exit_code'] != 0]
+    if failed:
+        raise RuntimeError('Sub-arcs not finished: ' + ', '.join(failed))
+    rundatadir = os.path.dirname(os.path.abspath(manifest['parameter_file']))
+    histories = [arc['histories'] for arc in manifest['arcs']]
+    weights = [arc.get('weight', 1.) for arc in manifest['arcs']]
+    merged = {}
+    for scorer, settings in manifest['scorers'].items():
+        arc_files = [scorer_output_files(rundatadir, arc['outputs'][scorer]) for arc in manifest['arcs']]
+        if not all(arc_files):
+            continue # scorer wrote nothing, eg. a disabled component
+        extension = os.path.splitext(arc_files[0][0])[1]
+        output_filepath = os.path.join(rundatadir, settings['output_file'] + extension)
+        if extension == '.csv':
+            merge_topas_csv([files[0] for files in arc_files], histories, output_filepath, weights)
+        elif extension == '.dcm':
+            uncertainties = [uncertainty_file(files[0]) for files in arc_files]
+            sum_dose_grids([files[0] for files in arc_files], output_filepath,
+                           uncertainty_files=[path if os.path.isfile(path) else None for path in uncertainties],
+                           scales=weights)
+        else:
+            continue # binary/root outputs are left per sub-arc
+        merged[scorer] = output_filepath
+    return merged
+
+
+def run_arcs(parameter_files: List[str], topas_application_path: str, arcs: int, base_seed: Optional[int] = None,
+             threads_per_arc: Optional[int] = None, shards: int = 1, scheduler: Optional[JobScheduler] = None,
+             priority: int = 0, allocation: Optional[List[Dict[str, object]]] = None) -> Dict[str, Dict[str, str]]:
+    """Splits every parameter file into sub-arcs, runs all sub-arcs concurrently and merges the outputs of each file.
+
+    Args:
+        parameter_files (List[str]): Rendered run files in their run folder.
+        topas_application_path (str): TOPAS executable.
+        arcs (int): Number of sub-arcs per parameter file.
+        base_seed (int, optional): Start of the seed stream, defaults to the i:Ts/Seed of each file.
+        threads_per_arc (int, optional): Overrides i:Ts/NumberOfThreads of the sub-arcs.
+        shards (int): Also shards every sub-arc (see sharding.run_sharded), the shards of a sub-arc are merged before
+            the sub-arcs are.
+        scheduler (JobScheduler, optional): Defaults to the shared scheduler.
+        priority (int): Queue priority of the sub-arcs.
+        allocation (List[Dict[str, object]], optional): Segments of a history allocation, used as the sub-arcs of every
+            parameter file instead of arcs equal ones (see render_arcs).
+
+    Returns:
+        Dict[str, Dict[str, str]]: Parameter file to its merged outputs (see merge_arcs). Files with failed sub-arcs
+        are left out, their manifests can be resumed with resume_arcs.
+    """
+    manifests = []
+    for parameter_file in parameter_files:
+        seed = base_seed if base_seed is not None else int(
+            chain_value(load_parameter_chain(parameter_file), 'Ts/Seed', '1').split()[0])
+        manifest = render_arcs(parameter_file, arcs, SeedStream(seed), threads_per_arc, allocation)
+        save_manifest(manifest)
+        manifests.append(manifest)
+
+    if shards > 1:
+        arc_files = [arc['file'] for manifest in manifests for arc in manifest['arcs']]
+        sharded = run_sharded(arc_files, topas_application_path, shards, scheduler=scheduler, priority=priority)
+        for manifest in manifests:
+            for arc in manifest['arcs']:
+                arc['exit_code'] = 0 if arc['file'] in sharded else 1
+            save_manifest(manifest)
+        return {manifest['parameter_file']: merge_arcs(manifest) for manifest in manifests
+                if all(arc['exit_code'] == 0 for arc in manifest['arcs'])}
+
+    submitted = [submit_pending_arcs(manifest, topas_application_path, scheduler, priority) for manifest in manifests]
+    merged = {}
+    for manifest, manifest_jobs in zip(manifests, submitted):
+        if not record_arc_results(manifest, manifest_jobs):
+            merged[manifest['parameter_file']] = merge_arcs(manifest)
+    return merged
+
+
+def resume_arcs(manifest_path: str, topas_application_path: str, scheduler: Optional[JobScheduler] = None,
+                priority: int = 0) -> Optional[Dict[str, str]]:
+    """Reruns the unfinished sub-arcs of a manifest and merges when all are done, None if some still fail."""
+    manifest = load_manifest(manifest_path)
+    submitted = submit_pending_arcs(manifest, topas_application_path, scheduler, priority)
+    if record_arc_results(manifest, submitted):
+        return None
+    return merge_arcs(manifest)
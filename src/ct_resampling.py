@@ -0,0 +1,228 @@
+# CT resampling for the TsDicomPatient geometry. TOPAS builds one voxel per CT voxel, so a clinical 512x512xN series
+# drives the navigation cost, memory and initialisation time of a DICOM run, while a kV imaging dose estimate rarely needs
+# sub-millimetre voxels. The series is loaded into a HU volume, averaged onto a coarser grid and written as a new CT
+# series in the run folder, and Ge/Patient/DicomDirectory of the run's patientDICOM.txt is pointed at it.
+#   - Every new voxel is the overlap (partial volume) weighted mean HU of the old voxels it covers, applied separably
+#     along x, y and z, so any voxel size works and not only integer factors. HU below -1000 (padding outside the
+#     reconstruction circle) is clamped to air first so it does not pull the averages down.
+#   - Averaging HU is averaging density where the Schneider HU to density curve is linear, which holds within each of its
+#     segments. Voxels mixing segments (eg. bone and soft tissue) get the density of the mean HU.
+#   - The volume can be cropped to the bounding box of the body (HU above a threshold) plus a margin.
+import os
+import copy
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, NamedTuple, Optional, Sequence, Tuple, Union
+
+import numpy as np
+from pydicom import dcmread
+from pydicom.uid import ExplicitVRLittleEndian, generate_uid
+
+from src.dicom_index import index_directory
+from src.topas_parameters import TopasParameterFile
+
+RESAMPLED_CT_DIR = 'resampled_CT'
+AIR_HU = -1000.
+_STORED_OFFSET = 1024 # stored value = HU + 1024, unsigned 16 bit, RescaleIntercept = -1024
+_AXIAL = np.array([1., 0., 0., 0., 1., 0.])
+
+
+class CtResampling(NamedTuple):
+    voxel_size: Union[float, Tuple[float, float, float]] # mm, one value for isotropic voxels or (x, y, z)
+    crop_to_body: bool = False
+    body_threshold: float = -400. # HU, voxels above are body (couch and immobilisation above it are kept)
+    margin: float = 10. # mm of air kept around the body box
+
+
+class CtVolume(NamedTuple):
+    hu: np.ndarray # float32 HU, indexed (z, y, x)
+    origin: Tuple[float, float, float] # mm, centre of the first voxel (ImagePositionPatient of the first slice)
+    spacing: Tuple[float, float, float] # mm, (x, y, z)
+    template: object # header of the first slice, the new series copies its patient, study and frame of reference
+
+
+def load_ct_volume(dicom_directory: str, workers: int = 8) -> CtVolume:
+    """Reads the CT series of a folder (found through dicom_index) into a HU volume.
+
+    Raises:
+        ValueError: If the folder has no CT series, more than one, or a series that is not axial or evenly spaced.
+    """
+    series = index_directory(dicom_directory).series('CT')
+    if len(series) != 1:
+        raise ValueError('Expected one CT series in ' + dicom_directory + ', found ' + str(len(series)))
+    files = next(iter(series.values()))
+
+    def read_slice(filepath: str):
+        dataset = dcmread(filepath)
+        hu = dataset.pixel_array.astype(np.float32) * float(getattr(dataset, 'RescaleSlope', 1.)) \
+            + float(getattr(dataset, 'RescaleIntercept', 0.))
+        return dataset, hu
+
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        slices = list(pool.map(read_slice, files))
+    template = slices[0][0]
+    if not np.allclose(np.array(template.ImageOrientationPatient, dtype=float), _AXIAL, atol=1e-4):
+        raise ValueError('Only axial CT series can be resampled, ImageOrientationPatient is '
+                         + str(list(template.ImageOrientationPatient)))
+    z = np.array([float(dataset.ImagePositionPatient[2]) for dataset, _ in slices])
+    steps = np.diff(z)
+    if len(z) > 1 and (np.any(steps <= 0) or np.ptp(steps) > 1e-3 * max(1., abs(steps.mean()))):
+        raise ValueError('CT slices of ' + dicom_directory + ' are not evenly spaced')
+    slice_spacing = float(steps.mean()) if len(z) > 1 else float(template.SliceThickness)
+    row_spacing, column_spacing = (float(value) for value in template.PixelSpacing)
+    origin = tuple(float(value) for value in template.ImagePositionPatient)
+    hu = np.stack([slice_hu for _, slice_hu in slices])
+    return CtVolume(hu, origin, (column_spacing, row_spacing, slice_spacing), template)
+
+
+def _overlap_weights(size: int, spacing: float, new_spacing: float) -> np.ndarray:
+    """Matrix (new, old) of the fraction of every new voxel covered by every old voxel along one axis."""
+    new_size = max(1, int(np.ceil(size * spacing / new_spacing - 1e-6)))
+    old_edges = np.arange(size + 1) * spacing
+    new_edges = np.minimum(np.arange(new_size + 1) * new_spacing, old_edges[-1])
+    overlap = np.clip(np.minimum(new_edges[1:, None], old_edges[None, 1:])
+                      - np.maximum(new_edges[:-1, None], old_edges[None, :-1]), 0., None)
+    return overlap / overlap.sum(axis=1, keepdims=True) # the last voxel averages the part it covers
+
+
+def crop_to_body(volume: CtVolume, body_threshold: float = -400., margin: float = 10.) -> CtVolume:
+    """Crops the volume to the bounding box of the voxels above body_threshold plus margin mm."""
+    body = volume.hu > body_threshold
+    if not body.any():
+        return volume
+    bounds = []
+    for axis, spacing in zip((2, 1, 0), volume.spacing): # x, y, z
+        other_axes = tuple(index for index in range(3) if index != axis)
+        occupied = np.flatnonzero(body.any(axis=other_axes))
+        pad = int(np.ceil(margin / spacing))
+        bounds.append((max(0, occupied[0] - pad), min(volume.hu.shape[axis], occupied[-1] + pad + 1)))
+    (x0, x1), (y0, y1), (z0, z1) = bounds
+    origin = tuple(value + start * spacing for value, start, spacing in zip(volume.origin, (x0, y0, z0), volume.spacing))
+    return volume._replace(hu=volume.hu[z0:z1, y0:y1, x0:x1], origin=origin)
+
+
+def average_grid(values: np.ndarray, spacing: Sequence[float], new_spacing: Sequence[float]) -> np.ndarray:
+    """Overlap weighted average of a (z, y, x) grid with (x, y, z) spacing onto a grid starting at the same corner."""
+    for axis, old, new in zip((2, 1, 0), spacing, new_spacing):
+        weights = _overlap_weights(values.shape[axis], old, new).astype(np.float32)
+        values = np.moveaxis(np.tensordot(weights, np.moveaxis(values, axis, 0), axes=(1, 0)), 0, axis)
+    return values
+
+
+def resample_ct(volume: CtVolume, voxel_size: Union[float, Sequence[float]]) -> CtVolume:
+    """Partial volume weighted HU average of the volume on a grid of voxel_size mm (see the module comment)."""
+    new_spacing = tuple(float(value) for value in (voxel_size if np.ndim(voxel_size) else [voxel_size] * 3))
+    hu = average_grid(np.maximum(volume.hu, AIR_HU), volume.spacing, new_spacing)
+    # the new first voxel starts at the edge of the old first voxel
+    origin = tuple(value - spacing / 2. + new / 2. for value, spacing, new in zip(volume.origin, volume.spacing,
+                                                                                 new_spacing))
+    return volume._replace(hu=hu.astype(np.float32), origin=origin, spacing=new_spacing)
+
+
+def write_ct_series(volume: CtVolume, output_directory: str, description: str = 'resampled') -> List[str]:
+    """Writes the volume as an uncompressed CT series with consistent geometry tags.
+
+    The patient, study and frame of reference are those of the source series. The series and instance UIDs are derived
+    from the source series UID, the grid and the slice number, so the same resampling always writes identical files.
+
+    Returns:
+        List[str]: Paths of the slices, in z order.
+    """
+    os.makedirs(output_directory, exist_ok=True)
+    template = copy.deepcopy(volume.template)
+    if 'PixelData' in template:
+        del template.PixelData
+    series_description = (str(getattr(template, 'SeriesDescription', '')) + ' ' + description).strip()[:64]
+    columns_spacing, rows_spacing, slice_spacing = volume.spacing
+    entropy = [str(template.SeriesInstanceUID), repr(volume.origin), repr(volume.spacing), repr(volume.hu.shape)]
+    series_uid = generate_uid(entropy_srcs=entropy + ['series'])
+    stored = np.clip(np.rint(volume.hu) + _STORED_OFFSET, 0, np.iinfo(np.uint16).max).astype(np.uint16)
+    filepaths = []
+    for index in range(stored.shape[0]):
+        dataset = copy.deepcopy(template) # pydicom sets values on the shared elements of a shallow copy
+        instance_uid = generate_uid(entropy_srcs=entropy + [str(index)])
+        dataset.file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+        dataset.file_meta.MediaStorageSOPInstanceUID = instance_uid
+        dataset.SOPInstanceUID = instance_uid
+        dataset.SeriesInstanceUID = series_uid
+        dataset.SeriesDescription = series_description
+        dataset.InstanceNumber = index + 1
+        z = volume.origin[2] + index * slice_spacing
+        dataset.ImagePositionPatient = [volume.origin[0], volume.origin[1], z]
+        dataset.SliceLocation = z
+        dataset.SliceThickness = slice_spacing
+        dataset.SpacingBetweenSlices = slice_spacing
+        dataset.PixelSpacing = [rows_spacing, columns_spacing]
+        dataset.Rows, dataset.Columns = stored.shape[1], stored.shape[2]
+        dataset.SamplesPerPixel = 1
+        dataset.PhotometricInterpretation = 'MONOCHROME2'
+        dataset.BitsAllocated, dataset.BitsStored, dataset.HighBit = 16, 16, 15
+        dataset.PixelRepresentation = 0
+        dataset.RescaleSlope, dataset.RescaleIntercept = 1, -_STORED_OFFSET
+        for keyword in ('SmallestImagePixelValue', 'LargestImagePixelValue', 'NumberOfFrames'):
+            if keyword in dataset:
+                delattr(dataset, keyword)
+        dataset.PixelData = stored[index].tobytes()
+        dataset['PixelData'].VR = 'OW'
+        filepath = os.path.join(output_directory, 'CT' + format(index + 1, '04d') + '.dcm')
+        dataset.save_as(filepath, enforce_file_format=True)
+        filepaths.append(filepath)
+    return filepaths
+
+
+def prepare_resampled_patient(dicom_directory: str, rundatadir: str, resampling: CtResampling,
+                              patient_file: Optional[str] = None) -> str:
+    """Resamples the CT series of dicom_directory into rundatadir/resampled_CT and points the patient file at it.
+
+    Args:
+        dicom_directory (str): Clinical CT folder.
+        rundatadir (str): Run folder, TOPAS runs in it so the new series is referenced relative to it.
+        resampling (CtResampling): Voxel size and crop.
+        patient_file (str, optional): Parameter file with Ge/Patient/DicomDirectory, defaults to the run's
+            patientDICOM.txt.
+
+    Returns:
+        str: Folder of the new series.
+    """
+    volume = load_ct_volume(dicom_directory)
+    if resampling.crop_to_body:
+        volume = crop_to_body(volume, resampling.body_threshold, resampling.margin)
+    volume = resample_ct(volume, resampling.voxel_size)
+    output_directory = os.path.join(rundatadir, RESAMPLED_CT_DIR)
+    write_ct_series(volume, output_directory)
+    patient_file = patient_file or os.path.join(rundatadir, 'patientDICOM.txt')
+    parameters = TopasParameterFile.from_file(patient_file)
+    parameters.set('s:Ge/Patient/DicomDirectory', '"' + RESAMPLED_CT_DIR + '/"')
+    parameters.write(patient_file)
+    return output_directory
+
+
+def dose_difference(reference: np.ndarray, reference_spacing: Sequence[float], test: np.ndarray,
+                    test_spacing: Sequence[float], offset: Sequence[float] = (0., 0., 0.),
+                    relative_threshold: float = 0.1) -> Dict[str, float]:
+    """Compares a dose grid with a coarser one by averaging the reference onto the coarse grid.
+
+    Args:
+        reference (np.ndarray): Reference dose (z, y, x), eg. of the run on the clinical CT.
+        reference_spacing (Sequence[float]): Its voxel size (x, y, z) in mm.
+        test (np.ndarray): Dose on the resampled CT.
+        test_spacing (Sequence[float]): Its voxel size (x, y, z) in mm.
+        offset (Sequence[float]): Corner of the test grid relative to the corner of the reference grid (x, y, z) in mm,
+            non zero for cropped series. Crops start at reference voxel edges.
+        relative_threshold (float): Voxels at or above this fraction of the maximum reference dose are compared.
+
+    Returns:
+        Dict[str, float]: Relative difference of the mean dose in the region, and the mean and maximum absolute voxel
+        differences relative to the maximum reference dose.
+    """
+    start = [int(round(value / spacing)) for value, spacing in zip(offset, reference_spacing)]
+    reference = reference[start[2]:, start[1]:, start[0]:].astype(np.float32)
+    averaged = average_grid(reference, reference_spacing, test_spacing)
+    shape = tuple(min(a, b) for a, b in zip(averaged.shape, test.shape))
+    averaged = averaged[:shape[0], :shape[1], :shape[2]]
+    test = test[:shape[0], :shape[1], :shape[2]]
+    maximum = float(averaged.max()) or 1.
+    region = averaged >= relative_threshold * maximum
+    difference = (test - averaged)[region] / maximum
+    return {'mean_dose_difference': float((test[region].mean() - averaged[region].mean()) / averaged[region].mean()),
+            'mean_absolute_difference': float(np.abs(difference).mean()),
+            'max_absolute_difference': float(np.abs(difference).max()), 'voxels_compared': int(region.sum())}
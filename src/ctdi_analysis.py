@@ -0,0 +1,187 @@
+# Post-processing of a CTDI run: the Z-binned plug scorers of CTDIphantom_16/32.txt are turned into dose_results.csv and
+# dose_results.json. Every plug position file writes <position>_tle, <position>_dtm and <position>_dtw, each scorer bins
+# the 100 mm plug into ZBins along its axis. The dose profile is integrated over the chamber length, scaled to absolute
+# dose with the factor in head_calibration_factor.txt, and combined into CTDI100 per position, CTDIw and CTDIvol.
+#
+# CTDI100 = integral of D(z) over the 100 mm chamber / nominal beam width. Without a beam width the chamber length is used,
+# which is the mean dose over the chamber as read by a 100 mm pencil chamber (the usual convention for CBCT).
+# Uncertainties are 1 standard error from the per history Standard_Deviation of each bin, taking the bins as independent.
+import os
+import re
+import csv
+import json
+from typing import Dict, List, Optional
+
+import numpy as np
+
+from src.topas_outputs import read_topas_csv, report_column
+from src.topas_parameters import UNIT_MM
+
+CTDI_QUANTITIES = {'tle': 'TrackLengthEstimator', 'dtm': 'DoseToMaterial', 'dtw': 'DoseToWater'}
+CENTRE_POSITION = 'ChamberPlugCentre'
+PERIPHERAL_POSITIONS = ['ChamberPlugTop', 'ChamberPlugBottom', 'ChamberPlugLeft', 'ChamberPlugRight']
+CHAMBER_LENGTH = 100. # mm, 2 * Ge/ChamberPlug*/HL
+RESULTS_CSV = 'dose_results.csv'
+RESULTS_JSON = 'dose_results.json'
+PLUG_MATERIAL = 'Air' # scored plug of the per-position layout, the other four holes are PMMA
+FILLER_MATERIAL = 'PMMA'
+
+_Z_BINNING = re.compile(r'#\s*Z in\s+(?P<bins>\d+)\s+bins?\s+of\s+(?P<width>[\d.eE+-]+)\s*(?P<unit>[a-zA-Z]+)')
+
+
+def read_calibration_factor(filepath: str) -> float:
+    """Absolute dose factor on the first line of head_calibration_factor.txt (number of particles / histories)."""
+    with open(filepath, 'r') as f:
+        return float(f.readline().split()[0])
+
+
+def z_bin_width(scorer: Dict[str, object], chamber_length: float = CHAMBER_LENGTH) -> float:
+    """Width of the Z bins in mm, from the '# Z in N bins of W mm' header line or the chamber length over the bins."""
+    for line in scorer['header']:
+        match = _Z_BINNING.search(line)
+        if match is not None and match.group('unit').lower() in UNIT_MM:
+            return float(match.group('width')) * UNIT_MM[match.group('unit').lower()]
+    return chamber_length / len(np.unique(scorer['bins'][:, 2]))
+
+
+def integrate_profile(scorer: Dict[str, object], calibration_factor: float = 1.,
+                      chamber_length: float = CHAMBER_LENGTH) -> Dict[str, float]:
+    """Integrates the Z dose profile of one scorer over the chamber.
+
+    Returns:
+        Dict[str, float]: 'integral' (mGy mm), 'mean_dose' (mGy, integral over the chamber length), 'uncertainty' (1 SE
+        of the integral, NaN without a Standard_Deviation report) and 'histories' (NaN when it can not be derived).
+    """
+    width = z_bin_width(scorer, chamber_length)
+    total = report_column(scorer, 'Sum')
+    mean = report_column(scorer, 'Mean')
+    deviation = report_column(scorer, 'Standard_Deviation')
+    histories = np.nan
+    if total is not None and mean is not None and np.any(mean > 0):
+        # Sum = Mean * histories in every scored bin
+        histories = float(np.round(np.median(total[mean > 0] / mean[mean > 0])))
+    if total is None and mean is not None and np.isfinite(histories):
+        total = mean * histories
+    if total is None:
+        raise ValueError('Scorer ' + scorer['quantity'] + ' has no Sum report')
+
+    scale = 1000. * calibration_factor * width # Gy per bin -> mGy mm
+    integral = float(total.sum() * scale)
+    uncertainty = np.nan
+    if deviation is not None and np.isfinite(histories):
+        # the Sum of N histories has a standard error of sqrt(N) * per history standard deviation
+        uncertainty = float(np.sqrt(np.sum(deviation ** 2) * histories) * scale)
+    return {'integral': integral, 'mean_dose': integral / chamber_length, 'uncertainty': uncertainty,
+            'histories': histories}
+
+
+def weighted_ctdi(centre: float, peripheral: List[float], centre_error: float = np.nan,
+                  peripheral_errors: Optional[List[float]] = None) -> Dict[str, float]:
+    """CTDIw = 1/3 CTDI100(centre) + 2/3 mean CTDI100(periphery), with its propagated standard error."""
+    peripheral_errors = peripheral_errors if peripheral_errors is not None else [np.nan] * len(peripheral)
+    value = centre / 3. + 2. / 3. * float(np.mean(peripheral))
+    error = float(np.sqrt((centre_error / 3.) ** 2
+                          + np.sum((2. / 3. / len(peripheral) * np.asarray(peripheral_errors)) ** 2)))
+    return {'value': value, 'uncertainty': error}
+
+
+def analyse_ctdi_run(rundatadir: str, calibration_file: Optional[str] = None, beam_width: Optional[float] = None,
+                     pitch: float = 1., chamber_length: float = CHAMBER_LENGTH,
+                     single_process_material: Optional[str] = None) -> Dict[str, object]:
+    """Computes CTDI100 per position and scorer, CTDIw and CTDIvol for a finished CTDI run folder.
+
+    Args:
+        rundatadir (str): Run folder holding the <position>_<tle|dtm|dtw>.csv outputs.
+        calibration_file (str, optional): Defaults to head_calibration_factor.txt in the run folder. Without a
+            calibration file the doses are per simulated history sum (factor 1).
+        beam_width (float, optional): Nominal beam width nT at isocentre in mm, defaults to the chamber length.
+        pitch (float): CTDIvol = CTDIw / pitch, 1 for a single axial rotation.
+        chamber_length (float): Integration length in mm.
+        single_process_material (str, optional): Material of every plug when all positions were scored in one TOPAS
+            process ('Air' or 'PMMA'), None for one process per position.
+
+    Returns:
+        Dict[str, object]: 'calibration_factor', 'beam_width', 'pitch', 'plugs' (layout and plug materials, single
+        process runs are flagged as an approximation), 'positions' (position -> quantity -> profile integral results
+        plus 'ctdi100' and 'ctdi100_uncertainty'), 'ctdi_w' and 'ctdi_vol' (quantity -> value and uncertainty, only for
+        quantities scored at all 5 positions).
+    """
+    calibration_file = calibration_file or os.path.join(rundatadir, 'head_calibration_factor.txt')
+    calibration_factor = read_calibration_factor(calibration_file) if os.path.isfile(calibration_file) else 1.
+    beam_width = beam_width or chamber_length
+
+    positions = {}
+    for position in [CENTRE_POSITION] + PERIPHERAL_POSITIONS:
+        for tag in CTDI_QUANTITIES:
+            filepath = os.path.join(rundatadir, position + '_' + tag + '.csv')
+            if not os.path.isfile(filepath):
+                continue
+            result = integrate_profile(read_topas_csv(filepath), calibration_factor, chamber_length)
+            result['ctdi100'] = result['integral'] / beam_width
+            result['ctdi100_uncertainty'] = result['uncertainty'] / beam_width
+            positions.setdefault(position, {})[tag] = result
+
+    ctdi_w, ctdi_vol = {}, {}
+    for tag in CTDI_QUANTITIES:
+        if not all(tag in positions.get(position, {}) for position in [CENTRE_POSITION] + PERIPHERAL_POSITIONS):
+            continue
+        centre = positions[CENTRE_POSITION][tag]
+        peripheral = [positions[position][tag] for position in PERIPHERAL_POSITIONS]
+        ctdi_w[tag] = weighted_ctdi(centre['ctdi100'], [p['ctdi100'] for p in peripheral],
+                                    centre['ctdi100_uncertainty'], [p['ctdi100_uncertainty'] for p in peripheral])
+        ctdi_vol[tag] = {key: value / pitch for key, value in ctdi_w[tag].items()}
+
+    return {'calibration_factor': calibration_factor, 'beam_width': beam_width, 'pitch': pitch,
+            'plugs': plug_layout(single_process_material), 'positions': positions, 'ctdi_w': ctdi_w, 'ctdi_vol': ctdi_vol}
+
+
+def plug_layout(single_process_material: Optional[str] = None) -> Dict[str, object]:
+    """Plug materials of a CTDI run. The single process layout fills every hole with one material and is not the
+    same quantity as the per-position layout, its results are marked as an approximation."""
+    if single_process_material is None:
+        return {'layout': 'per_position', 'scored_plug_material': PLUG_MATERIAL,
+                'other_plug_material': FILLER_MATERIAL, 'approximation': False}
+    return {'layout': 'single_process', 'scored_plug_material': single_process_material,
+            'other_plug_material': single_process_material, 'approximation': True}
+
+
+def write_ctdi_results(results: Dict[str, object], rundatadir: str) -> List[str]:
+    """Writes dose_results.csv (one row per position and scorer, then CTDIw and CTDIvol) and dose_results.json."""
+    csv_path = os.path.join(rundatadir, RESULTS_CSV)
+    with open(csv_path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['position', 'scorer', 'quantity', 'integral_mGy_mm', 'CTDI100_mGy', 'uncertainty_mGy',
+                         'relative_uncertainty'])
+        rows = [(position, tag, results['positions'][position][tag]['ctdi100'],
+                 results['positions'][position][tag]['ctdi100_uncertainty'],
+                 results['positions'][position][tag]['integral'])
+                for position in results['positions'] for tag in results['positions'][position]]
+        rows += [(label, tag, values[tag]['value'], values[tag]['uncertainty'], '')
+                 for label, values in (('CTDIw', results['ctdi_w']), ('CTDIvol', results['ctdi_vol'])) for tag in values]
+        for label, tag, value, uncertainty, integral in rows:
+            relative = uncertainty / value if value else np.nan
+            writer.writerow([label, tag, CTDI_QUANTITIES[tag], integral if integral == '' else format(integral, '.6g'),
+                             format(value, '.6g'), format(uncertainty, '.3g'), format(relative, '.3g')])
+
+    json_path = os.path.join(rundatadir, RESULTS_JSON)
+    with open(json_path, 'w') as f:
+        # NaN is not valid JSON, unknown uncertainties are written as null
+        json.dump(json_safe(results), f, indent=2)
+    return [csv_path, json_path]
+
+
+def json_safe(value):
+    if isinstance(value, dict):
+        return {key: json_safe(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [json_safe(item) for item in value]
+    if isinstance(value, float) and not np.isfinite(value):
+        return None
+    return value
+
+
+def process_ctdi_run(rundatadir: str, **kwargs) -> Dict[str, object]:
+    """analyse_ctdi_run followed by write_ctdi_results, returns the results."""
+    results = analyse_ctdi_run(rundatadir, **kwargs)
+    write_ctdi_results(results, rundatadir)
+    return results
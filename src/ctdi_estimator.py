@@ -0,0 +1,298 @@
+# Deterministic estimate of the CTDI of a rendered CTDI configuration, computed in a fraction of a second before any
+# Monte Carlo run. For every gantry angle of the timeline and every point along the 5 chambers, the ray from the focal
+# spot is traced through the titanium filter, the bowtie, the couch and the PMMA of the phantom, and the spectrum of
+# ConvertedTopasFile.txt is attenuated with the mu/rho of Muen.dat (materialdata.py). The dose of a plug is the kerma of
+# the attenuated primary fluence in air (tle, dtm) or water (dtw), the medium each plug scorer reports. Scatter is not
+# modelled, so the Monte Carlo doses are expected to be higher, most of all at the centre plug.
+#
+# The source emits like So/beam: the photons of head_calibration_factor.txt (factor * histories per run) with the
+# Gaussian angular spread of the beam, and every sequential time gets all of them, as the calibration of the Monte Carlo
+# doses assumes. The estimate is therefore on the scale of dose_results.json and is written next to it as
+# ctdi_estimate.json, with the Monte Carlo / estimate ratios once the run has finished.
+#
+# Geometry: the phantom axis is Z, the focal spot of gantry angle a is at D (sin a, -cos a) (a = 0 on the Top plug side,
+# Ge/BeamPosition/TransY = -D) and the fan coordinate u runs along (cos a, sin a), X1 of the field being +u.
+import os
+import json
+import time
+from typing import Dict, NamedTuple, Optional
+
+import numpy as np
+
+from src.arc_splitting import linear_time_features, sequential_times
+from src.ctdi_analysis import (CENTRE_POSITION, CHAMBER_LENGTH, CTDI_QUANTITIES, PERIPHERAL_POSITIONS, RESULTS_JSON,
+                               json_safe, read_calibration_factor, weighted_ctdi)
+from src.Energyspectrum import parse_topas_file
+from src.fieldtobladeopening import bladetofieldopening
+from src.materialdata import (AIR, ALUMINUM, ALUMINUM_DENSITY, PMMA, PMMA_DENSITY, TITANIUM, TITANIUM_DENSITY, WATER,
+                              mass_coefficients)
+from src.topas_parameters import TopasParameterFile, chain_value, length_mm, load_parameter_chain
+
+ESTIMATE_JSON = 'ctdi_estimate.json'
+SCORER_MEDIA = {'tle': AIR, 'dtm': AIR, 'dtw': WATER} # the scored plug is Air in the position files
+KEV_PER_GRAM_TO_MGY = 1.602176634e-16 * 1e3 * 1e3 # keV/g -> J/kg -> mGy
+
+# Aluminium of the bowtie beside its flat centre, (width, thickness at the outer edge) in mm at the bowtie plane: the
+# wedges DemoLTrap - DemoLTrap4 (LY, LX, each rising from the LX of the one before) and the side box (2 HLY, 2 HLX) of
+# fullfan.txt / halffan.txt
+BOWTIE_STEPS = ((3., 2.3), (3., 4.), (5.4, 12.), (2.8, 19.), (4.8, 24.), (50., 24.))
+BOWTIE_FLAT = 2. # mm, 2 * Ge/DemoFlat/HLX
+BOWTIE_DISTANCE = 172.5 # mm from the focal spot, CollimatorsVertical 117 mm + CollimatorsHorizontal 17 mm + BowtieFilter 38.5 mm
+
+
+class Bowtie(NamedTuple):
+    flat_half_width: float # mm, Ge/DemoFlat/HLY
+    offset: float # mm, Ge/BowtieFilter/TransX, towards X1
+    one_sided: bool # the half fan bowtie only has the steps on its X1 side
+
+    def thickness(self, u: np.ndarray) -> np.ndarray:
+        """Aluminium thickness in mm along the central axis at the fan coordinate u (mm at the bowtie plane)."""
+        widths, edges = zip(*BOWTIE_STEPS)
+        knots = self.flat_half_width + np.concatenate(([-self.flat_half_width, 0.], np.cumsum(widths)))
+        thicknesses = np.concatenate(([BOWTIE_FLAT, BOWTIE_FLAT], edges))
+        distance = np.asarray(u, dtype=float) - self.offset
+        if not self.one_sided:
+            return np.interp(np.abs(distance), knots, thicknesses, right=0.)
+        # nothing beyond the flat centre on the X2 side
+        return np.where(distance < -self.flat_half_width, 0.,
+                        np.interp(np.maximum(distance, 0.), knots, thicknesses, right=0.))
+
+
+BOWTIES = {'Full Fan': Bowtie(0.5, 0., False), 'Half Fan': Bowtie(50., 46., True)}
+
+
+def read_phantom(phantom_file: str) -> Dict[str, object]:
+    """Phantom radius, plug centres and couch slab of a CTDIphantom_16/32.txt file, all in mm.
+
+    Returns:
+        Dict[str, object]: 'radius', 'plugs' (position -> (x, y)) and 'couch' ((top y, thickness, half width) of the
+        aluminium couch below the phantom, None when the couch was removed).
+
+    Raises:
+        ValueError: If a plug position is missing from the file.
+    """
+    parameters = TopasParameterFile.from_file(phantom_file)
+    radius = length_mm(parameters.value('Ge/CTDI/RMax'))
+    plugs = {}
+    for position in [CENTRE_POSITION] + PERIPHERAL_POSITIONS:
+        if 'Ge/' + position + '/TransX' not in parameters:
+            raise ValueError('No ' + position + ' in ' + phantom_file)
+        plugs[position] = (length_mm(parameters.value('Ge/' + position + '/TransX')),
+                           length_mm(parameters.value('Ge/' + position + '/TransY')))
+    couch = None
+    if 'Ge/couch/Parent' in parameters: # removed by editor() when the couch is off
+        # Ge/couch/TransY = Ge/CTDI/RMax + Ge/couch/HLY, the couch touches the phantom
+        couch = (radius, 2. * length_mm(parameters.value('Ge/couch/HLY')), length_mm(parameters.value('Ge/couch/HLX')))
+    return {'radius': radius, 'plugs': plugs, 'couch': couch}
+
+
+def read_beam_setup(head_file: str, spectrum_file: Optional[str] = None,
+                    calibration_file: Optional[str] = None) -> Dict[str, object]:
+    """Source, spectrum, collimation and gantry angles of an edited headsourcecode.txt.
+
+    Args:
+        head_file (str): Edited headsourcecode.txt (or a rendered plug file).
+        spectrum_file (str, optional): Defaults to ConvertedTopasFile.txt next to head_file.
+        calibration_file (str, optional): Defaults to head_calibration_factor.txt next to head_file.
+
+    Returns:
+        Dict[str, object]: 'energies' (keV), 'weights' (normalised), 'particles' (photons per sequential time),
+        'angles' (deg), 'fan', 'field' (X1, X2, Y1, Y2 in mm at isocentre), 'source_distance' (mm), 'angular_spread'
+        (fan and longitudinal sigma in rad) and 'titanium' (mm).
+
+    Raises:
+        ValueError: If the Rotate time feature is not linear.
+    """
+    directory = os.path.dirname(os.path.abspath(head_file))
+    chain = load_parameter_chain(head_file)
+    energies, weights = parse_topas_file(spectrum_file or os.path.join(directory, 'ConvertedTopasFile.txt'))
+    histories = int(chain_value(chain, 'So/beam/NumberOfHistoriesInRun', '0').split()[0])
+    factor = read_calibration_factor(calibration_file or os.path.join(directory, 'head_calibration_factor.txt'))
+
+    rotate = linear_time_features(chain).get('Rotate', {'start_value': 0., 'rate': 0.})
+    angles = rotate['start_value'] + rotate['rate'] * np.asarray(sequential_times(chain))
+    blades = [chain_value(chain, name) for name in
+              ('Ge/Coll1/TransY', 'Ge/Coll2/TransY', 'Ge/Coll3/TransX', 'Ge/Coll4/TransX')]
+    spread = [np.radians(float(chain_value(chain, 'So/beam/BeamAngularSpread' + axis).split()[0])) for axis in 'XY']
+    return {
+        'energies': np.asarray(energies, dtype=float),
+        'weights': np.asarray(weights, dtype=float) / np.sum(weights),
+        'particles': factor * histories,
+        'angles': angles,
+        'fan': 'Half Fan' if 'halffan.txt' in chain[0].include_files() else 'Full Fan',
+        'field': tuple(10. * field for field in bladetofieldopening(blades)),
+        'source_distance': abs(length_mm(chain_value(chain, 'Ge/BeamPosition/TransY', '-1000. mm'))),
+        'angular_spread': tuple(spread),
+        'titanium': 2. * length_mm(chain_value(chain, 'Ge/BeamHardeningFilter/HLZ', '0.7 mm')),
+    }
+
+
+def merge_energy_bins(energies: np.ndarray, weights: np.ndarray, width: float):
+    # Fluence weighted energy of each width keV group, 0.2 keV spekpy bins are finer than the attenuation needs
+    populated = weights > 0
+    energies, weights = energies[populated], weights[populated]
+    groups = np.floor(energies / width)
+    starts = np.flatnonzero(np.diff(groups, prepend=groups[0] - 1))
+    merged_weights = np.add.reduceat(weights, starts)
+    return np.add.reduceat(weights * energies, starts) / merged_weights, merged_weights
+
+
+def primary_plug_doses(setup: Dict[str, object], phantom: Dict[str, object], bowtie: Bowtie, z_samples: int = 11,
+                       chamber_length: float = CHAMBER_LENGTH, energy_bin: float = 1.,
+                       chunk: int = 8192) -> Dict[str, Dict[str, float]]:
+    """Primary dose of every plug scorer, the mean over the chamber length summed over all gantry angles.
+
+    The geometry is evaluated for all angles, plugs and chamber points at once, the attenuation of the rays inside the
+    field as one (rays, energies) array per chunk of rays.
+
+    Args:
+        setup (Dict[str, object]): See read_beam_setup.
+        phantom (Dict[str, object]): See read_phantom.
+        bowtie (Bowtie): Bowtie of the fan mode.
+        z_samples (int): Points along every chamber.
+        chamber_length (float): Chamber length in mm, the mean dose over it is CTDI100 for a beam width of the chamber
+            length (the default of ctdi_analysis.analyse_ctdi_run).
+        energy_bin (float): Width in keV the spectrum is merged to.
+        chunk (int): Rays attenuated per array.
+
+    Returns:
+        Dict[str, Dict[str, float]]: Plug position to scorer tag to dose in mGy.
+    """
+    energies, weights = merge_energy_bins(setup['energies'], setup['weights'], energy_bin)
+    mu_pmma = mass_coefficients(PMMA, energies)[0] * PMMA_DENSITY / 10. # 1/mm
+    mu_aluminium = mass_coefficients(ALUMINUM, energies)[0] * ALUMINUM_DENSITY / 10.
+    mu_titanium = mass_coefficients(TITANIUM, energies)[0] * TITANIUM_DENSITY / 10.
+    tags = list(CTDI_QUANTITIES)
+    # energy absorbed per g of each scored medium per photon cm-2, after the titanium filter
+    response = np.stack([weights * energies * mass_coefficients(SCORER_MEDIA[tag], energies)[1] for tag in tags], axis=1)
+    response *= np.exp(-mu_titanium * setup['titanium'])[:, None]
+
+    positions = list(phantom['plugs'])
+    plugs = np.array([phantom['plugs'][position] for position in positions])
+    angles = np.radians(setup['angles'])[:, None, None]
+    x, y = plugs[None, :, 0, None], plugs[None, :, 1, None]
+    z = ((np.arange(z_samples) + 0.5) / z_samples - 0.5)[None, None, :] * chamber_length
+    sid = setup['source_distance']
+    source_x, source_y = sid * np.sin(angles), -sid * np.cos(angles)
+    along = sid - (x * np.sin(angles) - y * np.cos(angles)) # from the focal spot along the central axis
+    fan = x * np.cos(angles) + y * np.sin(angles)
+    along, fan, z = np.broadcast_arrays(along, fan, z)
+    distance = np.sqrt(along ** 2 + fan ** 2 + z ** 2)
+
+    field_x1, field_x2, field_y1, field_y2 = setup['field']
+    fan_iso, z_iso = fan * sid / along, z * sid / along
+    inside = (fan_iso >= -field_x2) & (fan_iso <= field_x1) & (z_iso >= -field_y2) & (z_iso <= field_y1)
+
+    # Gaussian angular distribution of So/beam per steradian, inverse square in cm
+    spread_fan, spread_z = setup['angular_spread']
+    density = np.exp(-0.5 * ((np.arctan2(fan, along) / spread_fan) ** 2 + (np.arctan2(z, along) / spread_z) ** 2)) \
+        / (2. * np.pi * spread_fan * spread_z)
+    fluence = setup['particles'] * density / (distance / 10.) ** 2
+
+    # the ray S + t (P - S) enters the phantom at the smaller root of |S + t (P - S)| = R, P is inside it
+    step_x, step_y = x - source_x, y - source_y
+    a = step_x ** 2 + step_y ** 2
+    b = 2. * (source_x * step_x + source_y * step_y)
+    c = source_x ** 2 + source_y ** 2 - phantom['radius'] ** 2
+    entry = (-b - np.sqrt(b ** 2 - 4. * a * c)) / (2. * a)
+    pmma = (1. - entry) * distance
+
+    obliquity = distance / along
+    aluminium = bowtie.thickness(fan_iso * BOWTIE_DISTANCE / sid) * obliquity
+    if phantom['couch'] is not None:
+        top, thickness, half_width = phantom['couch']
+        crossing = source_x + (top - source_y) / (y - source_y) * (x - source_x)
+        under = (source_y > top + thickness) & (np.abs(crossing) <= half_width)
+        aluminium = aluminium + np.where(under, thickness * distance / np.abs(source_y - y), 0.)
+
+    plug_index = np.broadcast_to(np.arange(len(positions))[None, :, None], distance.shape)[inside]
+    pmma, aluminium, fluence = pmma[inside], aluminium[inside], fluence[inside]
+    totals = np.zeros((len(positions), len(tags)))
+    for start in range(0, pmma.size, chunk):
+        rays = slice(start, start + chunk)
+        attenuation = np.exp(-(np.multiply.outer(pmma[rays], mu_pmma) + np.multiply.outer(aluminium[rays], mu_aluminium)))
+        doses = (attenuation @ response) * fluence[rays, None]
+        for column in range(len(tags)):
+            totals[:, column] += np.bincount(plug_index[rays], weights=doses[:, column], minlength=len(positions))
+    totals *= KEV_PER_GRAM_TO_MGY / z_samples
+    return {position: {tag: float(totals[row, column]) for column, tag in enumerate(tags)}
+            for row, position in enumerate(positions)}
+
+
+def estimate_ctdi(head_file: str, phantom_file: str, spectrum_file: Optional[str] = None,
+                  calibration_file: Optional[str] = None, pitch: float = 1., **dose_options) -> Dict[str, object]:
+    """Deterministic CTDI100 per plug, CTDIw and CTDIvol of an edited headsourcecode.txt and CTDI phantom file.
+
+    Args:
+        head_file (str): Edited headsourcecode.txt, the beam files are read next to it unless given.
+        phantom_file (str): Edited CTDIphantom_16.txt or CTDIphantom_32.txt.
+        spectrum_file (str, optional): ConvertedTopasFile.txt.
+        calibration_file (str, optional): head_calibration_factor.txt.
+        pitch (float): CTDIvol = CTDIw / pitch.
+        dose_options: Passed to primary_plug_doses (z_samples, energy_bin ...).
+
+    Returns:
+        Dict[str, object]: 'positions', 'ctdi_w' and 'ctdi_vol' in the layout of ctdi_analysis.analyse_ctdi_run
+        (uncertainties NaN), the 'fan', 'field', number of 'angles', 'particles' and the 'elapsed' seconds.
+    """
+    started = time.perf_counter()
+    setup = read_beam_setup(head_file, spectrum_file, calibration_file)
+    doses = primary_plug_doses(setup, read_phantom(phantom_file), BOWTIES[setup['fan']], **dose_options)
+    positions = {position: {tag: {'ctdi100': dose} for tag, dose in tag_doses.items()}
+                 for position, tag_doses in doses.items()}
+    ctdi_w, ctdi_vol = {}, {}
+    for tag in CTDI_QUANTITIES:
+        ctdi_w[tag] = weighted_ctdi(positions[CENTRE_POSITION][tag]['ctdi100'],
+                                    [positions[position][tag]['ctdi100'] for position in PERIPHERAL_POSITIONS])
+        ctdi_vol[tag] = {key: value / pitch for key, value in ctdi_w[tag].items()}
+    return {'model': 'primary', 'fan': setup['fan'], 'field': list(setup['field']), 'angles': int(setup['angles'].size),
+            'particles': float(setup['particles']), 'pitch': pitch, 'positions': positions, 'ctdi_w': ctdi_w,
+            'ctdi_vol': ctdi_vol, 'elapsed': time.perf_counter() - started}
+
+
+def compare_with_monte_carlo(estimate: Dict[str, object], results: Dict[str, object]) -> Dict[str, Dict[str, object]]:
+    """Monte Carlo / estimate of CTDIw and of every CTDI100 found in both, per plug scorer.
+
+    The ratios are above 1 by the scatter the estimate leaves out. Runs of a sweep with a ratio far from the others of
+    the same phantom and fan are worth checking.
+    """
+    pairs = {'CTDIw': (results.get('ctdi_w', {}), estimate['ctdi_w'])}
+    for position, tag_results in results.get('positions', {}).items():
+        if position in estimate['positions']:
+            pairs[position] = ({tag: {'value': values['ctdi100']} for tag, values in tag_results.items()},
+                               {tag: {'value': values['ctdi100']} for tag, values in estimate['positions'][position].items()})
+    comparison = {}
+    for label, (monte_carlo, estimated) in pairs.items():
+        for tag in monte_carlo:
+            if tag not in estimated or monte_carlo[tag]['value'] is None:
+                continue
+            value, prediction = monte_carlo[tag]['value'], estimated[tag]['value']
+            comparison.setdefault(label, {})[tag] = {'monte_carlo': value, 'estimate': prediction,
+                                                     'ratio': value / prediction if prediction else np.nan}
+    return comparison
+
+
+def write_estimate(estimate: Dict[str, object], rundatadir: str) -> str:
+    """Writes ctdi_estimate.json, adding the comparison with dose_results.json when the run folder has one."""
+    results_path = os.path.join(rundatadir, RESULTS_JSON)
+    if os.path.isfile(results_path):
+        with open(results_path, 'r') as f:
+            estimate = dict(estimate, comparison=compare_with_monte_carlo(estimate, json.load(f)))
+    estimate_path = os.path.join(rundatadir, ESTIMATE_JSON)
+    with open(estimate_path, 'w') as f:
+        json.dump(json_safe(estimate), f, indent=2)
+    return estimate_path
+
+
+def format_estimate(estimate: Dict[str, object]) -> str:
+    """Text table of an estimate, CTDI100 per plug then CTDIw and CTDIvol, one column per plug scorer."""
+    tags = list(CTDI_QUANTITIES)
+    rows = [(position, estimate['positions'][position]) for position in estimate['positions']]
+    rows += [(label, {tag: {'ctdi100': estimate[key][tag]['value']} for tag in tags})
+             for label, key in (('CTDIw', 'ctdi_w'), ('CTDIvol', 'ctdi_vol'))]
+    lines = ['Primary dose estimate (' + estimate['fan'] + ', ' + str(estimate['angles']) + ' angles, '
+             + format(estimate['elapsed'], '.2f') + ' s), mGy',
+             ''.ljust(20) + ''.join(tag.rjust(12) for tag in tags)]
+    for label, values in rows:
+        lines.append(label.ljust(20) + ''.join(format(values[tag]['ctdi100'], '.4g').rjust(12) for tag in tags))
+    return '\n'.join(lines)
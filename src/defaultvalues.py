@@ -20,6 +20,9 @@ default_DICOM_ROT_Z = '0. deg'
 default_DICOM_ISOCENTER_X = '0. mm'
 default_DICOM_ISOCENTER_Y = '0. mm'
 default_DICOM_ISOCENTER_Z = '0. mm'
+default_DICOM_VOXEL_SIZE = '' # empty simulates the CT at its own resolution, eg. '2 mm' resamples it (see ct_resampling.py)
+default_DICOM_CROP = False
+default_DICOM_COMPACT = False # merges HU values into fewer materials (see material_compaction.py)
 
 
 
@@ -52,3 +55,23 @@ default_BLADE_Y2 = '-5.814471115800571 cm'
 default_IMAGE_START_ANGLE = '0 deg'
 default_IMAGE_VOLTAGE = '125 kV'
 default_EXPOSURE = '100 mAs'
+
+# Spectrum cache, relative to the working directory like tmp/ and runfolder/
+default_SPECTRUM_CACHE_DIR = 'cache/spectra'
+default_SPECTRUM_CACHE_SIZE = 64
+# Run cache of finished simulations (see run_cache.py), entries unused for the age or beyond the size are evicted
+default_RUN_CACHE_DIR = 'cache/runs'
+default_RUN_CACHE_MAX_AGE_DAYS = 90
+default_RUN_CACHE_MAX_BYTES = 50 * 1024 ** 3
+# Content-addressed store of the static include files that are hardlinked into run folders (see include_staging.py)
+default_INCLUDE_STORE_DIR = 'cache/includes'
+# Saved header indexes of DICOM folders and the threads reading the headers (see dicom_index.py)
+default_DICOM_INDEX_DIR = 'cache/dicom_index'
+default_DICOM_INDEX_WORKERS = 16
+# Library of head-only phase spaces scored below the bowtie, reused as the source of patient and CTDI runs (see phase_space.py)
+default_PHASE_SPACE = False
+default_PHASE_SPACE_DIR = 'cache/phasespace'
+default_PHASE_SPACE_HISTORIES = 10 ** 7
+# Per-angle dose library of a patient, simulated once over 360 deg and composed into any protocol (see angular_library.py)
+default_ANGULAR_BINS = 36
+default_ANGULAR_RUNS_PER_BIN = 4
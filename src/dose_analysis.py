@@ -0,0 +1,334 @@
+# Reader and organ dose analysis of the TOPAS DICOM dose output (Sc/DoseOnRTGrid100kz17 of patientDICOM.txt, an RTDOSE
+# with 32 bit pixels). The pixel data of an uncompressed RTDOSE is memory-mapped instead of decoded, so opening a full
+# body grid costs nothing and only the slices being processed are read from disk.
+#   - Stored values are scaled by DoseGridScaling (Gy per simulated history sum) and the factor of
+#     head_calibration_factor.txt when a chunk is read, the calibrated grid is never held in memory.
+#   - RTSTRUCT contours (CLOSED_PLANAR) are rasterised per dose plane with an even-odd fill of the voxel centres, every
+#     plane takes the contours of the nearest contour plane within half the contour spacing. Several contours on one
+#     plane combine as even-odd too, so holes and islands come out right.
+#   - Organ statistics (mean, min, max, volume, DVH) are accumulated over chunks of slices, peak memory is a few chunks
+#     of the grid whatever the grid size.
+import os
+import csv
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple
+
+import numpy as np
+from pydicom import dcmread
+
+from src.ctdi_analysis import read_calibration_factor
+from src.dicom_index import index_directory
+from src.topas_parameters import find_scorers, load_parameter_chain
+
+ORGAN_DOSES_CSV = 'organ_doses.csv'
+ORGAN_DVH_CSV = 'organ_dvh.csv'
+DEFAULT_CHUNK_SLICES = 16
+DVH_BINS = 1000
+DOSE_LEVELS = (2, 50, 98) # D2%, D50% and D98% of the reports
+_UNCOMPRESSED_LITTLE_ENDIAN = {'1.2.840.10008.1.2', '1.2.840.10008.1.2.1'}
+_AXIAL = np.array([1., 0., 0., 0., 1., 0.])
+
+
+class DoseGrid:
+    """Memory-mapped RTDOSE file.
+
+    Args:
+        filepath (str): RTDOSE file.
+        calibration_factor (float): Factor applied with DoseGridScaling when slices are read, eg. the head calibration
+            factor (number of particles / histories) to get absolute dose.
+
+    Attributes:
+        pixels (np.ndarray): Stored values (z, y, x), a np.memmap for uncompressed little endian files.
+        origin (Tuple[float, float, float]): Centre of the first voxel (x, y, z) in mm.
+        spacing (Tuple[float, float, float]): Voxel size (x, y, z) in mm, z is the mean plane spacing.
+        z (np.ndarray): Position of every plane in mm.
+
+    Raises:
+        ValueError: If the grid is not axial.
+    """
+
+    def __init__(self, filepath: str, calibration_factor: float = 1.):
+        dataset = dcmread(filepath, defer_size=1024)
+        if not np.allclose(np.array(getattr(dataset, 'ImageOrientationPatient', _AXIAL), dtype=float), _AXIAL,
+                           atol=1e-4):
+            raise ValueError('Only axial dose grids are supported, ImageOrientationPatient is '
+                             + str(list(dataset.ImageOrientationPatient)))
+        self.filepath = filepath
+        self.calibration_factor = float(calibration_factor)
+        self.scaling = float(getattr(dataset, 'DoseGridScaling', 1.))
+        self.units = str(getattr(dataset, 'DoseUnits', 'GY'))
+        frames, rows, columns = int(getattr(dataset, 'NumberOfFrames', 1)), int(dataset.Rows), int(dataset.Columns)
+        self.pixels = self._map_pixels(dataset, (frames, rows, columns))
+        row_spacing, column_spacing = (float(value) for value in dataset.PixelSpacing)
+        position = [float(value) for value in dataset.ImagePositionPatient]
+        offsets = np.array([float(value) for value in getattr(dataset, 'GridFrameOffsetVector', None) or [0.]])
+        self.z = position[2] + offsets
+        slice_spacing = float(np.diff(self.z).mean()) if frames > 1 else float(getattr(dataset, 'SliceThickness', 1.))
+        self.origin = (position[0], position[1], float(self.z[0]))
+        self.spacing = (column_spacing, row_spacing, slice_spacing)
+
+    @staticmethod
+    def _map_pixels(dataset, shape: Tuple[int, int, int]) -> np.ndarray:
+        # Pixel Data of an uncompressed file is the raw (frames, rows, columns) array at a known file offset
+        element = dataset.get_item('PixelData', keep_deferred=True)
+        bits, signed = int(dataset.BitsAllocated), int(getattr(dataset, 'PixelRepresentation', 0))
+        if (str(dataset.file_meta.TransferSyntaxUID) in _UNCOMPRESSED_LITTLE_ENDIAN and bits in (16, 32)
+                and getattr(element, 'value_tell', None) is not None
+                and element.length == int(np.prod(shape)) * bits // 8):
+            dtype = np.dtype(('<i' if signed else '<u') + str(bits // 8))
+            return np.memmap(dataset.filename, dtype=dtype, mode='r', offset=element.value_tell, shape=shape)
+        return dcmread(dataset.filename).pixel_array.reshape(shape)
+
+    @classmethod
+    def from_run(cls, rundatadir: str, calibration_file: Optional[str] = None) -> 'DoseGrid':
+        """Dose of the first DICOM scorer of a run folder, calibrated with its head_calibration_factor.txt (factor 1
+        when the run has none)."""
+        calibration_file = calibration_file or os.path.join(rundatadir, 'head_calibration_factor.txt')
+        factor = read_calibration_factor(calibration_file) if os.path.isfile(calibration_file) else 1.
+        return cls(run_dose_file(rundatadir), factor)
+
+    @property
+    def shape(self) -> Tuple[int, int, int]:
+        return tuple(self.pixels.shape)
+
+    @property
+    def scale(self) -> float:
+        """Dose per stored value."""
+        return self.scaling * self.calibration_factor
+
+    @property
+    def voxel_volume(self) -> float:
+        """Voxel volume in cm3."""
+        return float(np.prod(self.spacing)) / 1000.
+
+    def x(self) -> np.ndarray:
+        return self.origin[0] + np.arange(self.shape[2]) * self.spacing[0]
+
+    def y(self) -> np.ndarray:
+        return self.origin[1] + np.arange(self.shape[1]) * self.spacing[1]
+
+    def slices(self, start: int, stop: int) -> np.ndarray:
+        """Calibrated float32 dose of planes start to stop."""
+        return self.pixels[start:stop].astype(np.float32) * np.float32(self.scale)
+
+    def chunks(self, chunk_slices: int = DEFAULT_CHUNK_SLICES) -> Iterator[Tuple[int, np.ndarray]]:
+        """(first plane, calibrated dose) of consecutive chunks of planes."""
+        for start in range(0, self.shape[0], chunk_slices):
+            yield start, self.slices(start, min(start + chunk_slices, self.shape[0]))
+
+    def max(self, chunk_slices: int = DEFAULT_CHUNK_SLICES) -> float:
+        maximum = max((int(self.pixels[start:start + chunk_slices].max())
+                       for start in range(0, self.shape[0], chunk_slices)), default=0)
+        return maximum * self.scale
+
+
+def run_dose_file(rundatadir: str) -> str:
+    """Output file of the first DICOM scorer of the run's headsourcecode.txt."""
+    scorers = find_scorers(load_parameter_chain(os.path.join(rundatadir, 'headsourcecode.txt')))
+    for scorer in scorers.values():
+        if scorer['output_type'] == 'dicom':
+            return os.path.join(rundatadir, scorer['output_file'] + '.dcm')
+    raise ValueError('No DICOM scorer in ' + rundatadir)
+
+
+def find_structure_set(dicom_directory: str) -> str:
+    """RTSTRUCT file of a DICOM folder, found through dicom_index.
+
+    Raises:
+        ValueError: If the folder has no RTSTRUCT or more than one.
+    """
+    files = [filepath for filepaths in index_directory(dicom_directory).series('RTSTRUCT').values()
+             for filepath in filepaths]
+    if len(files) != 1:
+        raise ValueError('Expected one RTSTRUCT in ' + dicom_directory + ', found ' + str(len(files)))
+    return files[0]
+
+
+def read_structures(filepath: str, names: Optional[Sequence[str]] = None) -> Dict[str, Dict[float, List[np.ndarray]]]:
+    """Closed planar contours of an RTSTRUCT.
+
+    Args:
+        filepath (str): RTSTRUCT file.
+        names (Sequence[str], optional): ROI names to read (case insensitive), all by default.
+
+    Returns:
+        Dict[str, Dict[float, List[np.ndarray]]]: ROI name -> contour plane z (mm) -> contours, each an (n, 2) array of
+        x, y points in mm. ROIs without closed planar contours are left out.
+    """
+    dataset = dcmread(filepath)
+    wanted = None if names is None else {name.lower() for name in names}
+    roi_names = {int(roi.ROINumber): str(roi.ROIName) for roi in getattr(dataset, 'StructureSetROISequence', [])}
+    structures = {}
+    for roi in getattr(dataset, 'ROIContourSequence', []):
+        name = roi_names.get(int(roi.ReferencedROINumber), str(roi.ReferencedROINumber))
+        if wanted is not None and name.lower() not in wanted:
+            continue
+        planes: Dict[float, List[np.ndarray]] = {}
+        for contour in getattr(roi, 'ContourSequence', []):
+            if str(getattr(contour, 'ContourGeometricType', '')) != 'CLOSED_PLANAR':
+                continue
+            points = np.array(contour.ContourData, dtype=float).reshape(-1, 3)
+            planes.setdefault(round(float(points[0, 2]), 3), []).append(points[:, :2])
+        if planes:
+            structures[name] = planes
+    return structures
+
+
+def _fill_contours(contours: List[np.ndarray], x: np.ndarray, y: np.ndarray) -> np.ndarray:
+    """Even-odd fill of the voxel centres (y, x) inside the contours of one plane."""
+    mask = np.zeros((len(y), len(x)), dtype=bool)
+    start = np.concatenate(contours)
+    end = np.concatenate([np.roll(contour, -1, axis=0) for contour in contours])
+    rows = np.flatnonzero((y >= start[:, 1].min()) & (y <= start[:, 1].max()))
+    if len(rows) == 0:
+        return mask
+    row_y = y[rows][:, None]
+    # an edge crosses a row when its end points are on different sides, half open so vertices count once
+    crossing = (start[:, 1] <= row_y) != (end[:, 1] <= row_y)
+    row_index, edge_index = np.nonzero(crossing)
+    y0, y1 = start[edge_index, 1], end[edge_index, 1]
+    x0, x1 = start[edge_index, 0], end[edge_index, 0]
+    crossing_x = x0 + (y[rows][row_index] - y0) * (x1 - x0) / (y1 - y0)
+    # toggle at the first voxel centre right of every crossing, the running parity is the inside
+    toggles = np.zeros((len(rows), len(x) + 1), dtype=np.int32)
+    np.add.at(toggles, (row_index, np.searchsorted(x, crossing_x)), 1)
+    mask[rows] = (np.cumsum(toggles[:, :-1], axis=1) % 2).astype(bool)
+    return mask
+
+
+def structure_mask(planes: Dict[float, List[np.ndarray]], grid: DoseGrid, start: int = 0,
+                   stop: Optional[int] = None) -> np.ndarray:
+    """Voxels of dose planes start to stop inside a structure, as a (planes, rows, columns) boolean array."""
+    stop = grid.shape[0] if stop is None else stop
+    mask = np.zeros((stop - start,) + grid.shape[1:], dtype=bool)
+    contour_z = np.array(sorted(planes))
+    tolerance = (np.median(np.diff(contour_z)) if len(contour_z) > 1 else grid.spacing[2]) / 2. + 1e-3
+    x, y = grid.x(), grid.y()
+    for index, z in enumerate(grid.z[start:stop]):
+        nearest = contour_z[np.abs(contour_z - z).argmin()]
+        if abs(nearest - z) <= tolerance:
+            mask[index] = _fill_contours(planes[nearest], x, y)
+    return mask
+
+
+def _z_range(planes: Dict[float, List[np.ndarray]], grid: DoseGrid) -> Tuple[int, int]:
+    # dose planes that can touch the structure
+    contour_z = sorted(planes)
+    margin = (np.median(np.diff(contour_z)) if len(contour_z) > 1 else grid.spacing[2]) / 2. + 1e-3
+    inside = np.flatnonzero((grid.z >= contour_z[0] - margin) & (grid.z <= contour_z[-1] + margin))
+    return (int(inside[0]), int(inside[-1]) + 1) if len(inside) else (0, 0)
+
+
+def organ_doses(grid: DoseGrid, structures: Dict[str, Dict[float, List[np.ndarray]]],
+                chunk_slices: int = DEFAULT_CHUNK_SLICES, dvh_bins: int = DVH_BINS,
+                max_dose: Optional[float] = None) -> Dict[str, Dict[str, object]]:
+    """Mean, min and max dose, volume and cumulative DVH of every structure, accumulated over chunks of planes.
+
+    Args:
+        grid (DoseGrid): Dose, in the unit of its calibration (Gy with the head calibration factor).
+        structures (Dict): As returned by read_structures.
+        chunk_slices (int): Planes read at a time.
+        dvh_bins (int): DVH bins between 0 and max_dose.
+        max_dose (float, optional): Upper edge of the DVH, the grid maximum by default.
+
+    Returns:
+        Dict[str, Dict[str, object]]: ROI name -> 'voxels', 'volume_cc', 'mean', 'min', 'max', 'D2', 'D50', 'D98'
+        (dose to the hottest 2, 50, 98 % of the volume, to the bin width) and 'dvh' ({'dose': lower bin edges,
+        'volume': fraction of the volume receiving at least that dose}). Structures outside the grid have 0 voxels and
+        NaN doses.
+    """
+    max_dose = grid.max(chunk_slices) if max_dose is None else max_dose
+    bin_width = (max_dose or 1.) / dvh_bins
+    ranges = {name: _z_range(planes, grid) for name, planes in structures.items()}
+    totals = {name: {'voxels': 0, 'sum': 0., 'min': np.inf, 'max': -np.inf,
+                     'histogram': np.zeros(dvh_bins, dtype=np.int64)} for name in structures}
+    for start, dose in grid.chunks(chunk_slices):
+        stop = start + dose.shape[0]
+        for name, planes in structures.items():
+            first, last = ranges[name]
+            if last <= start or first >= stop:
+                continue
+            values = dose[structure_mask(planes, grid, start, stop)]
+            if values.size == 0:
+                continue
+            total = totals[name]
+            total['voxels'] += values.size
+            total['sum'] += float(values.sum(dtype=np.float64))
+            total['min'] = min(total['min'], float(values.min()))
+            total['max'] = max(total['max'], float(values.max()))
+            bins = np.minimum((values / bin_width).astype(np.int64), dvh_bins - 1)
+            total['histogram'] += np.bincount(bins, minlength=dvh_bins)
+
+    results = {}
+    for name, total in totals.items():
+        voxels = total['voxels']
+        result = {'voxels': voxels, 'volume_cc': voxels * grid.voxel_volume}
+        if voxels == 0:
+            result.update({'mean': np.nan, 'min': np.nan, 'max': np.nan, 'dvh': {'dose': [], 'volume': []}})
+            result.update({'D' + str(level): np.nan for level in DOSE_LEVELS})
+            results[name] = result
+            continue
+        cumulative = total['histogram'][::-1].cumsum()[::-1] / voxels
+        result.update({'mean': total['sum'] / voxels, 'min': total['min'], 'max': total['max'],
+                       'dvh': {'dose': (np.arange(dvh_bins) * bin_width).tolist(), 'volume': cumulative.tolist()}})
+        for level in DOSE_LEVELS:
+            # highest bin still covering the volume fraction
+            covered = np.flatnonzero(cumulative >= level / 100.)
+            result['D' + str(level)] = float(covered[-1] * bin_width) if len(covered) else 0.
+        results[name] = result
+    return results
+
+
+def _case_doses(dose_source: str, structure_source: str, roi_names: Optional[Sequence[str]],
+                chunk_slices: int, dvh_bins: int) -> Dict[str, Dict[str, object]]:
+    grid = DoseGrid.from_run(dose_source) if os.path.isdir(dose_source) else DoseGrid(dose_source)
+    structure_file = find_structure_set(structure_source) if os.path.isdir(structure_source) else structure_source
+    return organ_doses(grid, read_structures(structure_file, roi_names), chunk_slices, dvh_bins)
+
+
+def cohort_report(cases: Sequence[Tuple[str, str]], output_dir: str, roi_names: Optional[Sequence[str]] = None,
+                  workers: int = 4, chunk_slices: int = DEFAULT_CHUNK_SLICES,
+                  dvh_bins: int = DVH_BINS) -> Dict[str, Dict[str, Dict[str, object]]]:
+    """Organ doses of several patients, written to organ_doses.csv and organ_dvh.csv in output_dir (doses in mGy).
+
+    Args:
+        cases (Sequence[Tuple[str, str]]): (dose, structures) of every patient. The dose is a run folder (calibrated
+            with its head_calibration_factor.txt) or an RTDOSE file, the structures an RTSTRUCT file or a DICOM folder
+            holding one.
+        output_dir (str): Report folder.
+        roi_names (Sequence[str], optional): ROIs to report, all by default.
+        workers (int): Patients processed at the same time, the memory of a patient is bounded by chunk_slices.
+
+    Returns:
+        Dict: Case (the dose path) -> organ_doses result, in Gy. Cases that fail have an 'error' entry instead.
+    """
+    def run_case(case):
+        try:
+            return _case_doses(case[0], case[1], roi_names, chunk_slices, dvh_bins)
+        except (OSError, ValueError, AttributeError) as error:
+            return {'error': str(error)}
+
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        results = dict(zip((case[0] for case in cases), pool.map(run_case, cases)))
+
+    os.makedirs(output_dir, exist_ok=True)
+    columns = ['case', 'roi', 'voxels', 'volume_cc', 'mean_mGy', 'min_mGy', 'max_mGy'] \
+        + ['D' + str(level) + '_mGy' for level in DOSE_LEVELS] + ['error']
+    with open(os.path.join(output_dir, ORGAN_DOSES_CSV), 'w', newline='') as summary, \
+            open(os.path.join(output_dir, ORGAN_DVH_CSV), 'w', newline='') as dvh:
+        writer = csv.DictWriter(summary, fieldnames=columns)
+        writer.writeheader()
+        dvh_writer = csv.writer(dvh)
+        dvh_writer.writerow(['case', 'roi', 'dose_mGy', 'volume_fraction'])
+        for case, organs in results.items():
+            if 'error' in organs:
+                writer.writerow({'case': case, 'error': organs['error']})
+                continue
+            for roi, result in organs.items():
+                row = {'case': case, 'roi': roi, 'voxels': result['voxels'], 'volume_cc': result['volume_cc']}
+                for key in ['mean', 'min', 'max'] + ['D' + str(level) for level in DOSE_LEVELS]:
+                    row[key + '_mGy'] = 1000. * result[key]
+                writer.writerow(row)
+                for dose, volume in zip(result['dvh']['dose'], result['dvh']['volume']):
+                    dvh_writer.writerow([case, roi, format(1000. * dose, '.6g'), format(volume, '.6g')])
+    return results
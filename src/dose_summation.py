@@ -0,0 +1,194 @@
+# Out-of-core summation of TOPAS DICOM dose grids (the DoseOnRTGrid100kz17 scorer of patientDICOM.txt), for runs split
+# into pieces: seed shards and adaptive batches of one run, gantry sub-arcs, or kV-kV angles. Every input is opened as a
+# dose_analysis.DoseGrid memory map and the grids are walked slab by slab (chunks of planes), so only one slab per input
+# is in memory at a time whatever the number of inputs.
+#   - Replicates (shards, batches): the pieces are independent estimates of the same dose. With x_k = D_k / N_k the dose
+#     per history of piece k, the history weighted mean and M2 = sum(N_k (x_k - m)^2) are accumulated per voxel with the
+#     weighted Welford update (West 1979). The standard error of the summed dose is N sqrt(M2 / ((K - 1) N)), N being the
+#     total histories, as in adaptive_runs.DicomRoiMetric.
+#   - Parts (sub-arcs, angles): the pieces add up to the dose, their variances add when each has an uncertainty file.
+# The summed dose is written as a 32 bit RTDOSE with the header of the first input, and the standard error as an RTDOSE
+# with DoseType ERROR next to it (<output>_uncertainty.dcm). Both are streamed into the files, the pixel data is written
+# slab by slab through a memory map of the output.
+import os
+import struct
+from typing import Dict, List, Optional, Sequence
+
+import numpy as np
+from pydicom import dcmread
+from pydicom.uid import ExplicitVRLittleEndian, generate_uid
+
+from src.dose_analysis import DEFAULT_CHUNK_SLICES, DoseGrid
+
+UNCERTAINTY_SUFFIX = '_uncertainty'
+_UINT32_MAX = 2 ** 32 - 1
+_PIXEL_DATA = 0x7FE00010
+
+
+def uncertainty_file(dose_filepath: str) -> str:
+    """Uncertainty file written next to a summed dose file."""
+    stem, extension = os.path.splitext(dose_filepath)
+    return stem + UNCERTAINTY_SUFFIX + extension
+
+
+def _check_geometry(grids: List[DoseGrid]) -> None:
+    first = grids[0]
+    for grid in grids[1:]:
+        if grid.shape != first.shape or not np.allclose(grid.origin, first.origin, atol=1e-3) \
+                or not np.allclose(grid.spacing, first.spacing, atol=1e-4):
+            raise ValueError(grid.filepath + ' is not on the same dose grid as ' + first.filepath)
+
+
+def _open_dose_output(template_filepath: str, filepath: str, shape: Sequence[int], scaling: float,
+                      dose_type: Optional[str] = None, entropy: Sequence[str] = ()) -> np.memmap:
+    """Writes the header of template_filepath with 32 bit pixels and returns a writable memory map of the pixel data.
+
+    The Pixel Data element header is appended after the header elements and the file is extended to its final size, the
+    values are then written through the memory map without holding the grid in memory.
+    """
+    header = dcmread(template_filepath, stop_before_pixels=True)
+    for tag in [tag for tag in header.keys() if int(tag) >= _PIXEL_DATA]:
+        del header[tag]
+    instance_uid = generate_uid(entropy_srcs=list(entropy) + [str(dose_type)])
+    header.file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+    header.file_meta.MediaStorageSOPInstanceUID = instance_uid
+    header.SOPInstanceUID = instance_uid
+    header.BitsAllocated, header.BitsStored, header.HighBit, header.PixelRepresentation = 32, 32, 31, 0
+    header.DoseGridScaling = format(scaling, '.10g')
+    if dose_type is not None:
+        header.DoseType = dose_type
+    header.save_as(filepath, enforce_file_format=True)
+    pixel_bytes = int(np.prod(shape)) * 4
+    with open(filepath, 'ab') as f:
+        # explicit VR little endian: tag, 'OW', 2 reserved bytes, 4 byte length
+        f.write(struct.pack('<HH2sHI', 0x7FE0, 0x0010, b'OW', 0, pixel_bytes))
+        offset = f.tell()
+        f.truncate(offset + pixel_bytes)
+    return np.memmap(filepath, dtype='<u4', mode='r+', offset=offset, shape=tuple(shape))
+
+
+def _quantise(source: np.memmap, template_filepath: str, filepath: str, maximum: float, chunk_slices: int,
+              dose_type: Optional[str], entropy: Sequence[str]) -> None:
+    # the scaling needs the maximum of the whole grid, so the float grid is kept on disk until it is known
+    scaling = maximum / _UINT32_MAX if maximum > 0 else 1.
+    temporary = filepath + '.tmp' + str(os.getpid())
+    output = _open_dose_output(template_filepath, temporary, source.shape, scaling, dose_type, entropy)
+    scaling = float(format(scaling, '.10g')) # as written in DoseGridScaling
+    for start in range(0, source.shape[0], chunk_slices):
+        slab = np.rint(source[start:start + chunk_slices].astype(np.float64) / scaling)
+        output[start:start + chunk_slices] = np.clip(slab, 0, _UINT32_MAX).astype(np.uint32)
+    output.flush()
+    del output
+    os.replace(temporary, filepath)
+
+
+def write_dose_grid(dose: np.ndarray, template_filepath: str, output_filepath: str,
+                    chunk_slices: int = DEFAULT_CHUNK_SLICES, dose_type: Optional[str] = None,
+                    entropy: Sequence[str] = ()) -> float:
+    """Writes a (z, y, x) float dose, eg. a memory map, as a 32 bit RTDOSE with the header of template_filepath.
+
+    The template only needs the header elements, the pixel data is written slab by slab.
+
+    Returns:
+        float: Maximum dose of the grid.
+    """
+    maximum = max((float(dose[start:start + chunk_slices].max()) for start in range(0, dose.shape[0], chunk_slices)),
+                  default=0.)
+    _quantise(dose, template_filepath, output_filepath, maximum, chunk_slices, dose_type,
+              list(entropy) + [os.path.abspath(output_filepath)])
+    return maximum
+
+
+def sum_dose_grids(filepaths: Sequence[str], output_filepath: str, histories: Optional[Sequence[int]] = None,
+                   replicates: bool = False, uncertainty_files: Optional[Sequence[Optional[str]]] = None,
+                   chunk_slices: int = DEFAULT_CHUNK_SLICES,
+                   scales: Optional[Sequence[float]] = None) -> Dict[str, object]:
+    """Sums DICOM dose grids slab by slab into one RTDOSE file, with a standard error map when it can be derived.
+
+    Args:
+        filepaths (Sequence[str]): RTDOSE files on the same grid. The output may be one of them.
+        output_filepath (str): Summed RTDOSE file.
+        histories (Sequence[int], optional): Histories of every input, the Welford weights of replicates (equal
+            weights when not given).
+        replicates (bool): The inputs are independent estimates of the same dose (shards, batches), their spread gives
+            the uncertainty. Needs at least two inputs.
+        uncertainty_files (Sequence[str], optional): Standard error file of every input (None where an input has none).
+            Used for parts, their variances are added when every input has one.
+        chunk_slices (int): Planes per slab.
+        scales (Sequence[float], optional): Factor of every input and its standard error, eg. the weights of the
+            sub-arcs of a history allocation (see history_allocation.py).
+
+    Returns:
+        Dict[str, object]: 'output', 'uncertainty' (the written uncertainty file or None), 'max_dose' and
+        'max_relative_uncertainty' (of the voxels above 50 % of the maximum dose, NaN without uncertainty).
+
+    Raises:
+        ValueError: If the grids differ in shape, origin or spacing.
+    """
+    grids = [DoseGrid(filepath) for filepath in filepaths]
+    _check_geometry(grids)
+    errors = None
+    if uncertainty_files is not None and all(uncertainty_files):
+        errors = [DoseGrid(filepath) for filepath in uncertainty_files]
+        _check_geometry(grids[:1] + errors)
+    weights = np.asarray(histories if histories is not None else [1] * len(grids), dtype=np.float64)
+    scales = np.asarray(scales if scales is not None else [1.] * len(grids), dtype=np.float64)
+    with_uncertainty = (replicates and len(grids) > 1) or errors is not None
+
+    shape = grids[0].shape
+    directory = os.path.dirname(os.path.abspath(output_filepath))
+    scratch = os.path.join(directory, '.' + os.path.basename(output_filepath) + '.sum' + str(os.getpid()))
+    total = np.memmap(scratch, dtype=np.float32, mode='w+', shape=shape)
+    error = np.memmap(scratch + 'e', dtype=np.float32, mode='w+', shape=shape) if with_uncertainty else None
+    try:
+        for start in range(0, shape[0], chunk_slices):
+            stop = min(start + chunk_slices, shape[0])
+            slab_sum = np.zeros((stop - start,) + shape[1:], dtype=np.float64)
+            if replicates:
+                mean = np.zeros_like(slab_sum)
+                m2 = np.zeros_like(slab_sum)
+                weight_sum = 0.
+            for index, grid in enumerate(grids):
+                dose = grid.pixels[start:stop].astype(np.float64) * (grid.scale * scales[index])
+                slab_sum += dose
+                if replicates:
+                    # weighted Welford update with x = dose per history and weight = histories
+                    weight = weights[index]
+                    weight_sum += weight
+                    delta = dose / weight - mean
+                    mean += delta * (weight / weight_sum)
+                    m2 += weight * delta * (dose / weight - mean)
+            total[start:stop] = slab_sum
+            if error is None:
+                continue
+            if replicates and len(grids) > 1:
+                error[start:stop] = weight_sum * np.sqrt(m2 / ((len(grids) - 1) * weight_sum))
+            else:
+                variance = np.zeros_like(slab_sum)
+                for grid, scale in zip(errors, scales):
+                    variance += (grid.pixels[start:stop].astype(np.float64) * (grid.scale * scale)) ** 2
+                error[start:stop] = np.sqrt(variance)
+
+        max_dose = max(float(total[start:start + chunk_slices].max()) for start in range(0, shape[0], chunk_slices))
+        entropy = [os.path.abspath(filepath) for filepath in filepaths] + [str(os.path.getmtime(filepaths[0]))]
+        del grids # the output may replace one of the inputs
+        _quantise(total, filepaths[0], output_filepath, max_dose, chunk_slices, None, entropy)
+        result = {'output': output_filepath, 'uncertainty': None, 'max_dose': max_dose,
+                  'max_relative_uncertainty': np.nan}
+        if error is not None:
+            max_error, max_relative = 0., 0.
+            for start in range(0, shape[0], chunk_slices):
+                slab_error, slab_total = error[start:start + chunk_slices], total[start:start + chunk_slices]
+                max_error = max(max_error, float(slab_error.max()))
+                high = slab_total >= 0.5 * max_dose
+                if high.any():
+                    max_relative = max(max_relative, float((slab_error[high] / slab_total[high]).max()))
+            result['uncertainty'] = uncertainty_file(output_filepath)
+            result['max_relative_uncertainty'] = max_relative
+            _quantise(error, filepaths[0], result['uncertainty'], max_error, chunk_slices, 'ERROR', entropy)
+        return result
+    finally:
+        del total, error
+        for path in (scratch, scratch + 'e'):
+            if os.path.isfile(path):
+                os.remove(path)
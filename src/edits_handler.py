@@ -1,149 +1,112 @@
 # This script is used to handle all the edits that must be made to the .batch and python files.
 from src.fieldtobladeopening import fieldtobladeopening
-
-def stringindexreplacement(
-    SearchString: str, 
-    TargetList: list, 
-    ReplacementString: str = None
-) -> None:
-    '''
-    Targeted string replacement for a list. 
-
-    Function looks for the line that starts with SearchString in the list and
-    replaces it with Replacement String. Function will replace the entire line and
-    any information trailing the SearchString and replacement string will be lost
-    in this process.
-
-    Untested, but should be faster
-
-    If no replacement string is given in the arguments, the entire line is removed
-
-    :param SearchString: The string to search for in the list. 
-    :type SearchString: str
-    :param TargetList: The list of strings to search and replace in
-    :type TargetList: list[str]
-    :param ReplacementString: The string to replace the SearchString with. Defaults to None
-    :type ReplacementString: str, optional
-    :return: None
-    :rtype: None
-    '''
-    for lineIndex in range(len(TargetList)):
-        if TargetList[lineIndex].startswith(SearchString):
-            if ReplacementString is None:
-                TargetList[lineIndex] = '' 
-                break #exits after the first instance of match. Saves compute. 
-            else:
-                TargetList[lineIndex] = SearchString + " = " + ReplacementString + '\n' 
-                break #exits after the first instance of match. Saves compute. 
-
-
+from src.topas_parameters import TopasParameterFile
 
 def editor(change_dictionary: dict,  TargetFile: str, filetype:str):
     '''
     Main function that handles the editting and changing of parameter files. 
     As the user inputs are saved in the values dictionary, this is passed in as change_dictionary and we can use the associated key to reference it and pull the data. 
-    The function opens the Targetfile and saves it as a list on memory to be editted before rewriting after all edits are done on the list. 
+    The function parses the Targetfile once into a TopasParameterFile, applies all edits by parameter name and writes it back once.
+    Lines that are not edited are written back unchanged and edited lines keep their trailing comments.
     All edits must be hardcoded here. 
     
     :filetype str: either "main" or "sub" ; "main" is for the mainheadscript and "sub" is for includefiles
     '''
-    with open(TargetFile, 'r') as Rread_file:
-        filecontent = Rread_file.readlines()
+    parameters = TopasParameterFile.from_file(TargetFile)
 
     if filetype == 'main':
         # Edits for mainheadsource
-        stringindexreplacement('s:Ts/G4DataDirectory', filecontent , '\"'+change_dictionary['-G4FOLDERNAME-']+'\"') 
-        stringindexreplacement('i:Tf/NumberOfSequentialTimes', filecontent , change_dictionary['-TIMESEQ-']) 
-        stringindexreplacement('d:Tf/TimelineEnd', filecontent , change_dictionary['-TIMELINEEND-']) 
-        stringindexreplacement('d:Tf/Rotate/Rate', filecontent , change_dictionary['-TIMEROTRATE-']) 
-        stringindexreplacement('d:Tf/Rotate/StartValue', filecontent , change_dictionary['-STARTANGLEROT-']) 
-        stringindexreplacement('i:Ts/Seed', filecontent , change_dictionary['-SEED-']) 
-        stringindexreplacement('i:Ts/NumberOfThreads', filecontent , change_dictionary['-THREAD-']) 
-        stringindexreplacement('i:So/beam/NumberOfHistoriesInRun', filecontent , change_dictionary['-HIST-']) 
+        parameters.set('s:Ts/G4DataDirectory', '\"'+change_dictionary['-G4FOLDERNAME-']+'\"') 
+        parameters.set('i:Tf/NumberOfSequentialTimes', change_dictionary['-TIMESEQ-']) 
+        parameters.set('d:Tf/TimelineEnd', change_dictionary['-TIMELINEEND-']) 
+        parameters.set('d:Tf/Rotate/Rate', change_dictionary['-TIMEROTRATE-']) 
+        parameters.set('d:Tf/Rotate/StartValue', change_dictionary['-STARTANGLEROT-']) 
+        parameters.set('i:Ts/Seed', change_dictionary['-SEED-']) 
+        parameters.set('i:Ts/NumberOfThreads', change_dictionary['-THREAD-']) 
+        parameters.set('i:So/beam/NumberOfHistoriesInRun', change_dictionary['-HIST-']) 
 
         # For blade openings 
-        stringindexreplacement('dc:Ge/Coll1/TransY', filecontent , change_dictionary['-BLADE_X1-']) 
-        stringindexreplacement('dc:Ge/Coll2/TransY', filecontent , change_dictionary['-BLADE_X2-']) 
-        stringindexreplacement('dc:Ge/Coll3/TransX', filecontent , change_dictionary['-BLADE_Y1-']) 
-        stringindexreplacement('dc:Ge/Coll4/TransX', filecontent , change_dictionary['-BLADE_Y2-']) 
+        parameters.set('dc:Ge/Coll1/TransY', change_dictionary['-BLADE_X1-']) 
+        parameters.set('dc:Ge/Coll2/TransY', change_dictionary['-BLADE_X2-']) 
+        parameters.set('dc:Ge/Coll3/TransX', change_dictionary['-BLADE_Y1-']) 
+        parameters.set('dc:Ge/Coll4/TransX', change_dictionary['-BLADE_Y2-']) 
 
 
         if change_dictionary['-FAN-'] == 'Full Fan':
             ### Removes the includeFile line for half bowtie
-            stringindexreplacement('includeFile = halffan.txt', filecontent , ) 
+            parameters.remove_include('halffan.txt')
             # ADD EDITS TO THE BOWTIE GEOMETRY 
         elif change_dictionary['-FAN-'] == 'Half Fan':
             ### Removes the includeFile line for full bowtie
-            stringindexreplacement('includeFile = fullfan.txt', filecontent , )
+            parameters.remove_include('fullfan.txt')
 
         if change_dictionary['-FUNCTION_CHECK-'] == 'DICOM':
             ### Removes both CTDI phantom includeFile
-            stringindexreplacement('includeFile = CTDIphantom_16.txt', filecontent , )
-            stringindexreplacement('includeFile = CTDIphantom_32.txt', filecontent , )
-            stringindexreplacement('sv:Ph/Default/LayeredMassGeometryWorlds', filecontent , )
+            parameters.remove_include('CTDIphantom_16.txt')
+            parameters.remove_include('CTDIphantom_32.txt')
+            parameters.delete('sv:Ph/Default/LayeredMassGeometryWorlds')
             if change_dictionary['-DICOM_GRAPHICS-'] ==False: 
                 ### Removes graphics 
-                stringindexreplacement('Ts/UseQt', filecontent , ) 
-                stringindexreplacement('s:Gr/ViewA/Type', filecontent , ) 
-                stringindexreplacement('b:Gr/Enable', filecontent , ) 
+                parameters.delete('Ts/UseQt') 
+                parameters.delete('s:Gr/ViewA/Type') 
+                parameters.delete('b:Gr/Enable') 
 
         elif change_dictionary['-FUNCTION_CHECK-'] == 'CTDI validation':
             ### Removes DICOM includeFile and the other phantom file
-            stringindexreplacement('includeFile = patientDICOM.txt', filecontent , )
+            parameters.remove_include('patientDICOM.txt')
             if change_dictionary['-CTDI_GRAPHICS-'] ==False: 
                 ### Removes graphics 
-                stringindexreplacement('Ts/UseQt', filecontent , ) 
-                stringindexreplacement('s:Gr/ViewA/Type', filecontent , ) 
-                stringindexreplacement('b:Gr/Enable', filecontent , ) 
+                parameters.delete('Ts/UseQt') 
+                parameters.delete('s:Gr/ViewA/Type') 
+                parameters.delete('b:Gr/Enable') 
 
             if change_dictionary['-CTDI_BLADE_TOG-'] == True:
                 calculated_blade_positions = fieldtobladeopening([change_dictionary['-CTDI_FIELD_X1-'],change_dictionary['-CTDI_FIELD_X2-'],change_dictionary['-CTDI_FIELD_Y1-'],change_dictionary['-CTDI_FIELD_Y2-']])
 
-                stringindexreplacement('dc:Ge/Coll1/TransY', filecontent , calculated_blade_positions[0]) 
-                stringindexreplacement('dc:Ge/Coll2/TransY', filecontent , calculated_blade_positions[1]) 
-                stringindexreplacement('dc:Ge/Coll3/TransX', filecontent , calculated_blade_positions[2]) 
-                stringindexreplacement('dc:Ge/Coll4/TransX', filecontent , calculated_blade_positions[3]) 
+                parameters.set('dc:Ge/Coll1/TransY', calculated_blade_positions[0]) 
+                parameters.set('dc:Ge/Coll2/TransY', calculated_blade_positions[1]) 
+                parameters.set('dc:Ge/Coll3/TransX', calculated_blade_positions[2]) 
+                parameters.set('dc:Ge/Coll4/TransX', calculated_blade_positions[3]) 
                 
 
             if change_dictionary['-CTDI_PHANTOM-'] == '16 cm': 
-                stringindexreplacement('includeFile = CTDIphantom_32.txt', filecontent , )
+                parameters.remove_include('CTDIphantom_32.txt')
             elif change_dictionary['-CTDI_PHANTOM-'] == '32 cm': 
-                stringindexreplacement('includeFile = CTDIphantom_16.txt', filecontent , )
+                parameters.remove_include('CTDIphantom_16.txt')
 
 
     if filetype == 'sub':
         # Edits related to includeFiles 
         if change_dictionary['-FUNCTION_CHECK-'] == 'DICOM':
-            stringindexreplacement('d:Ge/patrotation/yaw', filecontent , change_dictionary['-DICOM_YAW-']) 
-            stringindexreplacement('s:Ge/Patient/DicomDirectory', filecontent , '\"'+change_dictionary['-DICOM-']+'\"') 
+            if 'd:Ge/patrotation/yaw' in parameters:
+                # yaw is defined in the headsource boilerplate, only edited here if the include file defines it
+                parameters.set('d:Ge/patrotation/yaw', change_dictionary['-DICOM_YAW-']) 
+            parameters.set('s:Ge/Patient/DicomDirectory', '\"'+change_dictionary['-DICOM-']+'\"') 
 
-            stringindexreplacement('dc:Ge/IsocenterX', filecontent , change_dictionary['-DICOM_ISOX-'])  
-            stringindexreplacement('dc:Ge/IsocenterY', filecontent , change_dictionary['-DICOM_ISOY-'])  
-            stringindexreplacement('dc:Ge/IsocenterZ', filecontent , change_dictionary['-DICOM_ISOZ-'])  
+            parameters.set('dc:Ge/IsocenterX', change_dictionary['-DICOM_ISOX-'])  
+            parameters.set('dc:Ge/IsocenterY', change_dictionary['-DICOM_ISOY-'])  
+            parameters.set('dc:Ge/IsocenterZ', change_dictionary['-DICOM_ISOZ-'])  
 
-            stringindexreplacement('dc:Ge/Patient/UserTransX', filecontent , change_dictionary['-DICOM_TX-'])
-            stringindexreplacement('dc:Ge/Patient/UserTransY', filecontent , change_dictionary['-DICOM_TY-'])
-            stringindexreplacement('dc:Ge/Patient/UserTransZ', filecontent , change_dictionary['-DICOM_TZ-'])
+            parameters.set('dc:Ge/Patient/UserTransX', change_dictionary['-DICOM_TX-'])
+            parameters.set('dc:Ge/Patient/UserTransY', change_dictionary['-DICOM_TY-'])
+            parameters.set('dc:Ge/Patient/UserTransZ', change_dictionary['-DICOM_TZ-'])
 
-            stringindexreplacement('s:Sc/DoseOnRTGrid100kz17/OutputFile', filecontent , '\"' +change_dictionary['-PATID-'] +'_'+ change_dictionary['-DIRECTROT-'] +'_'+ change_dictionary['-IMAGEMODE-'] +'_'+change_dictionary['-STARTANGLEROT-'] + '_DOSE_PTV' +'\"') 
+            parameters.set('s:Sc/DoseOnRTGrid100kz17/OutputFile', '\"' +change_dictionary['-PATID-'] +'_'+ change_dictionary['-DIRECTROT-'] +'_'+ change_dictionary['-IMAGEMODE-'] +'_'+change_dictionary['-STARTANGLEROT-'] + '_DOSE_PTV' +'\"') 
 
         elif change_dictionary['-FUNCTION_CHECK-'] == 'CTDI validation':
             if change_dictionary['-COUCH_TOG-'] == False: 
                 # by removing the parent group link, the component is removed
-                stringindexreplacement( 's:Ge/couch/Parent="couchgroup"', filecontent,  )
-            stringindexreplacement( 'd:Ge/couch/HLX', filecontent, change_dictionary['-COUCHHLX-'] )
-            stringindexreplacement( 'd:Ge/couch/HLY', filecontent, change_dictionary['-COUCHHLY-'] )
-            stringindexreplacement( 'd:Ge/couch/HLZ', filecontent, change_dictionary['-COUCHHLZ-'] )
-            stringindexreplacement( 'i:Sc/ChamberPlugDose_dtm/ZBins', filecontent , change_dictionary['-DTMZB-']) 
-            stringindexreplacement( 'i:Sc/ChamberPlugDose_tle/ZBins', filecontent , change_dictionary['-TLEZB-']) 
-            stringindexreplacement( 'i:Sc/ChamberPlugDose_dtw/ZBins', filecontent , change_dictionary['-DTWZB-']) 
-
+                parameters.delete('s:Ge/couch/Parent')
+            parameters.set('d:Ge/couch/HLX', change_dictionary['-COUCHHLX-'])
+            parameters.set('d:Ge/couch/HLY', change_dictionary['-COUCHHLY-'])
+            parameters.set('d:Ge/couch/HLZ', change_dictionary['-COUCHHLZ-'])
+            parameters.set('i:Sc/ChamberPlugDose_dtm/ZBins', change_dictionary['-DTMZB-']) 
+            parameters.set('i:Sc/ChamberPlugDose_tle/ZBins', change_dictionary['-TLEZB-']) 
+            parameters.set('i:Sc/ChamberPlugDose_dtw/ZBins', change_dictionary['-DTWZB-']) 
 
 
-    with open(TargetFile, 'w') as Write_file:
-        Write_file.writelines( filecontent )
 
-    pass 
+    parameters.write(TargetFile)
 
 if __name__== '__main__':
     editor()
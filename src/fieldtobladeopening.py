@@ -36,6 +36,23 @@ def fieldtobladeopening(field_size_list):
         
     return blade_position_list
 
+def bladetofieldopening(blade_position_list):
+    '''
+    Inverse of fieldtobladeopening, reads the field sizes at isocentre back from the blade positions of a rendered file
+    Input is to be given as a list of 4 strings of blade positions (Ge/Coll1/TransY, Ge/Coll2/TransY, Ge/Coll3/TransX, Ge/Coll4/TransX)
+    [Blade_x1, Blade_x2, Blade_y1, Blade_y2] in cm or mm
+    Returns [Field_x1, Field_x2, Field_y1, Field_y2] as floats in cm, blade 2s are mirrored back before the fit is applied
+    '''
+    yfieldopening = lambda blade : 17.3699885452463 * blade - 90.2972966781214
+    xfieldopening = lambda blade : 13.9904761904762 * blade - 72.3986904761904
+    to_cm = {'mm': 0.1, 'cm': 1., 'm': 100.}
+
+    blades = []
+    for blade in blade_position_list:
+        number, unit = (blade.split() + ['cm'])[:2]
+        blades.append(float(number) * to_cm[unit])
+    return [xfieldopening(blades[0]), xfieldopening(-blades[1]), yfieldopening(blades[2]), yfieldopening(-blades[3])]
+
 if __name__ == '__main__':
     print(fieldtobladeopening(['2 cm', '2 cm' ,'16 cm', '16 cm']) )
     print(fieldtobladeopening(['10 cm', '10 cm' ,'10 cm', '10 cm']) )
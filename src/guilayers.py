@@ -62,6 +62,7 @@ History_layer = sg.Frame("Simulation settings",
                     sg.In(default_text=default_TIME_SEQ_TIME,key='-TIMESEQ-',size=(10,1),  enable_events=True)],
                   [sg.Text('Histories',size = (10,1),text_color='black'),
                    sg.In(default_text=default_Histories,key='-HIST-',size=(10,1),enable_events=True)],
+                  [sg.Checkbox('Reuse head phase space', default=default_PHASE_SPACE, key='-PHASE_SPACE-', tooltip='Simulates the imaging head once per protocol and blade setting, runs start from the phase space below the bowtie (see phase_space.py)')],
                 ], vertical_alignment='top')
 
 imaging_protocol_layer = sg.Frame('Imaging protocol',
@@ -109,6 +110,11 @@ dicom_file_layer = sg.Frame("DICOM inputs",
                                 [sg.Text('DICOM RP file',size =(17,1),text_color='black'),
                                  sg.In(default_text=default_DICOM_RP_file,key='-DICOMRP-',size=(50,1),enable_events=True),sg.FileBrowse(button_text= "Browse", key= 'Browse2' ,file_types= (("DICOM File",'*.dcm'),) )
                                 ],
+                                [sg.Text('CT voxel size',size =(17,1),text_color='black'),
+                                 sg.In(default_text=default_DICOM_VOXEL_SIZE,key='-DICOM_VOXEL-',size=(10,1),enable_events=True, tooltip='Leave empty to simulate the CT at its own resolution'),
+                                 sg.Checkbox('Crop to body', default=default_DICOM_CROP, key='-DICOM_CROP-'),
+                                 sg.Checkbox('Compact materials', default=default_DICOM_COMPACT, key='-DICOM_COMPACT-', tooltip='Maps the CT onto fewer materials for a faster start, see material_compaction.json in the run folder')
+                                ],
                                 [sg.Button("Run set up imaging dose simulation",enable_events=True, key='-DICOM_RUN-',size=(35,1))],
                               ])
 
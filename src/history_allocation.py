@@ -0,0 +1,341 @@
+# Allocation of the histories of a run over its sequential times (gantry angles), written as the NbParticlesInTime.txt
+# time-feature table ("time_ms histories" per sequential time) with the matching per-step weights in
+# NbParticlesWeights.txt. The allocation is piecewise constant over contiguous segments of the arc, and every segment
+# runs as one sub-arc of arc_splitting with its own i:So/beam/NumberOfHistoriesInRun. Its outputs are scaled by its
+# weight when the sub-arcs are merged, so the merged dose is the dose of the reference histories per run H of the
+# rendered file at every sequential time, and the calibration factor no_particles / H of head_calibration_factor.txt
+# stays valid.
+#
+# With c_g the relative tube current of segment g (mean 1 over the arc) and n_g its histories per run, the weight is
+# w_g = H c_g / n_g:
+#   - uniform:          n_g = H, w_g = 1.
+#   - modulated:        n_g = H c_g, w_g = 1 (analog, the histories follow the tube current).
+#   - variance_optimal: minimises the variance of the summed dose. A history of sequential time t scores the primary
+#                       transmitted through the patient with probability T_t, an absolute per-history spread
+#                       s_t = sqrt(T_t (1 - T_t)). The weighted sum over the arc has the variance
+#                       H^2 sum_t c_t^2 s_t^2 / n_t, which for a fixed total is smallest with n_g proportional to c_g s_g
+#                       (Neyman allocation), s_g the RMS of c_t s_t / c_g over the segment. Angles whose primary carries
+#                       little of the summed dose (T near 0) or none of its noise (T near 1) get fewer histories.
+#                       A floor keeps a share of the uniform allocation everywhere.
+# The total histories stay H x sequential times. The transmissions T come from a cheap attenuation pre-pass: rays across
+# the fan of every gantry angle through a water-equivalent density map of the patient (the CT slab inside the field, or
+# the CTDI phantom and couch), attenuated with the spectrum of the run and the mu/rho of Muen.dat.
+import os
+import json
+from typing import Dict, List, NamedTuple, Optional, Sequence, Tuple
+
+import numpy as np
+
+from src.arc_splitting import sequential_times, split_arc
+from src.ct_resampling import AIR_HU, load_ct_volume
+from src.ctdi_estimator import merge_energy_bins, read_beam_setup, read_phantom
+from src.materialdata import ALUMINUM, ALUMINUM_DENSITY, PMMA, PMMA_DENSITY, TITANIUM, TITANIUM_DENSITY, WATER, \
+    mass_coefficients
+from src.sharding import histories_per_run_count
+from src.topas_parameters import TopasParameterFile, length_mm, load_parameter_chain
+
+ALLOCATION_TABLE = 'NbParticlesInTime.txt'
+WEIGHTS_TABLE = 'NbParticlesWeights.txt'
+ALLOCATION_JSON = 'history_allocation.json'
+MODES = ('uniform', 'modulated', 'variance_optimal')
+
+
+class HistoryAllocationSettings(NamedTuple):
+    mode: str = 'variance_optimal' # one of MODES
+    segments: int = 18 # sub-arcs the allocation is constant over, 20 deg each for a 360 deg arc
+    currents: Optional[Tuple[float, ...]] = None # relative tube current over the arc, resampled to the sequential times
+    floor: float = 0.25 # share of the uniform (or modulated) allocation every segment keeps
+
+
+class HistoryAllocation(NamedTuple):
+    mode: str
+    reference_histories: int # H, histories per run of the rendered file
+    times: Tuple[float, ...] # s, every sequential time
+    segments: Tuple[Dict[str, object], ...] # first_run, runs, histories (per run), weight, current, transmission
+
+    def step_histories(self) -> np.ndarray:
+        """Histories per run at every sequential time."""
+        return np.repeat([segment['histories'] for segment in self.segments],
+                         [segment['runs'] for segment in self.segments])
+
+    def step_weights(self) -> np.ndarray:
+        """Statistical weight of the histories of every sequential time."""
+        return np.repeat([segment['weight'] for segment in self.segments],
+                         [segment['runs'] for segment in self.segments])
+
+
+def resample_currents(currents: Optional[Sequence[float]], runs: int) -> np.ndarray:
+    """Relative tube current at every sequential time, mean 1. A profile of another length is interpolated linearly
+    over the arc, None is a constant current.
+
+    Raises:
+        ValueError: If a current is negative or all are zero.
+    """
+    if currents is None:
+        return np.ones(runs)
+    profile = np.asarray(currents, dtype=float)
+    if profile.size == 0 or np.any(profile < 0) or not profile.any():
+        raise ValueError('Tube currents must be non-negative and not all zero')
+    if profile.size != runs:
+        profile = np.interp(np.linspace(0., 1., runs), np.linspace(0., 1., profile.size), profile)
+    return profile / profile.mean()
+
+
+def primary_spread(transmissions: Sequence[float]) -> np.ndarray:
+    """Absolute per-history spread sqrt(T (1 - T)) of the primary score at every sequential time."""
+    step_transmissions = np.clip(np.asarray(transmissions, dtype=float), 0., 1.)
+    return np.sqrt(step_transmissions * (1. - step_transmissions))
+
+
+def _segment_means(values: np.ndarray, sub_arcs: List[Tuple[int, int]], power: int = 1) -> np.ndarray:
+    # mean (power 1) or RMS (power 2) of per-step values over every segment
+    means = np.array([np.mean(values[first:first + runs] ** power) for first, runs in sub_arcs])
+    return means ** (1. / power)
+
+
+def allocate_histories(times: Sequence[float], reference_histories: int, settings: HistoryAllocationSettings,
+                       transmissions: Optional[Sequence[float]] = None) -> HistoryAllocation:
+    """Histories per run and weight of every segment of the arc.
+
+    Args:
+        times (Sequence[float]): Time in s of every sequential time (arc_splitting.sequential_times).
+        reference_histories (int): H, histories per run of the rendered file, the calibration factor is per H.
+        settings (HistoryAllocationSettings): Mode, segments, tube currents and floor.
+        transmissions (Sequence[float], optional): Primary transmission at every sequential time, needed by
+            variance_optimal (see attenuation_prepass).
+
+    Returns:
+        HistoryAllocation: The allocation, the histories of all segments add up to about H x sequential times.
+
+    Raises:
+        ValueError: For an unknown mode, or variance_optimal without transmissions.
+    """
+    if settings.mode not in MODES:
+        raise ValueError('Unknown history allocation ' + settings.mode + ', use one of ' + ', '.join(MODES))
+    runs = len(times)
+    sub_arcs = split_arc(runs, max(1, min(settings.segments, runs)))
+    lengths = np.array([arc_runs for _, arc_runs in sub_arcs], dtype=float)
+    step_currents = resample_currents(settings.currents, runs)
+    currents = _segment_means(step_currents, sub_arcs)
+    segment_transmissions = np.full(len(sub_arcs), np.nan)
+
+    if settings.mode == 'uniform':
+        # the tube current only scales the weights, the histories stay flat
+        shares = np.ones(len(sub_arcs))
+    elif settings.mode == 'modulated':
+        shares = currents
+    else:
+        if transmissions is None:
+            raise ValueError('variance_optimal allocation needs the transmissions of the attenuation pre-pass')
+        segment_transmissions = _segment_means(np.clip(np.asarray(transmissions, dtype=float), 0., 1.), sub_arcs)
+        # RMS of c_t s_t over a segment: the histories of a segment are shared by its steps
+        spread = _segment_means(step_currents * primary_spread(transmissions), sub_arcs, 2)
+        if not spread.any():
+            spread = currents # nothing attenuates, fall back to the modulated allocation
+        # both parts have a run weighted mean of 1, so the total histories stay H x runs
+        shares = settings.floor * currents + (1. - settings.floor) * spread * lengths.sum() / (spread * lengths).sum()
+
+    segments = []
+    for (first_run, arc_runs), share, current, transmission in zip(sub_arcs, shares, currents, segment_transmissions):
+        histories = max(1, int(round(reference_histories * share)))
+        segments.append({'first_run': first_run, 'runs': arc_runs, 'histories': histories,
+                         'weight': reference_histories * float(current) / histories, 'current': float(current),
+                         'transmission': None if np.isnan(transmission) else float(transmission)})
+    return HistoryAllocation(settings.mode, int(reference_histories), tuple(float(time) for time in times),
+                             tuple(segments))
+
+
+def efficiency_gain(allocation: HistoryAllocation, transmissions: Sequence[float]) -> float:
+    """Predicted variance of the summed dose with the uniform allocation over its variance with this one, for the same
+    total histories.
+
+    The variance of the weighted dose sum over the sequential times is H^2 sum(c^2 s^2 / n), s the absolute spread
+    sqrt(T (1 - T)) of the module header, so values above 1 are the factor of histories (time) saved to reach the same
+    uncertainty of the summed primary dose.
+    """
+    histories = allocation.step_histories().astype(float)
+    currents = allocation.step_weights() * histories / allocation.reference_histories
+    spread = currents ** 2 * primary_spread(transmissions) ** 2
+    uniform = spread.sum() / (histories.sum() / histories.size)
+    allocated = (spread / histories).sum()
+    return float(uniform / allocated) if allocated > 0 else 1.
+
+
+def water_equivalent_phantom(phantom: Dict[str, object], energy: float,
+                             pixel: float = 1.) -> Tuple[np.ndarray, Tuple[float, float], float]:
+    """Water-equivalent density map (g/cm3) of a CTDI phantom and its couch at the energy, for path_transmissions.
+
+    Returns:
+        Tuple[np.ndarray, Tuple[float, float], float]: Map indexed (y, x), centre of its first pixel (x, y) in mm from
+        the isocentre and the pixel size in mm.
+    """
+    water = mass_coefficients(WATER, np.array([energy]))[0][0]
+    pmma = PMMA_DENSITY * mass_coefficients(PMMA, np.array([energy]))[0][0] / water
+    aluminium = ALUMINUM_DENSITY * mass_coefficients(ALUMINUM, np.array([energy]))[0][0] / water
+    extent = phantom['radius'] + 2. * pixel
+    if phantom['couch'] is not None:
+        top, thickness, half_width = phantom['couch']
+        extent = max(extent, top + thickness + pixel, half_width + pixel)
+    axis = np.arange(-extent, extent + pixel, pixel)
+    x, y = np.meshgrid(axis, axis)
+    density = np.where(x ** 2 + y ** 2 <= phantom['radius'] ** 2, pmma, 0.)
+    if phantom['couch'] is not None:
+        couch = (y >= top) & (y <= top + thickness) & (np.abs(x) <= half_width)
+        # a slab thinner than a pixel keeps its mass per area
+        density = np.where(couch, aluminium * thickness / max(thickness, pixel), density)
+    return density, (float(axis[0]), float(axis[0])), pixel
+
+
+def water_equivalent_ct(dicom_directory: str, isocentre: Tuple[float, float, float],
+                        slab: Tuple[float, float]) -> Tuple[np.ndarray, Tuple[float, float], float]:
+    """Water-equivalent density map (1 + HU / 1000, g/cm3) of the CT, averaged over the slices of the slab.
+
+    Args:
+        dicom_directory (str): Folder of the CT series (Ge/Patient/DicomDirectory).
+        isocentre (Tuple[float, float, float]): Isocentre in patient coordinates in mm (Ge/Patient/InterX, Y, Z).
+        slab (Tuple[float, float]): Longitudinal extent of the field at the isocentre in mm, relative to it.
+
+    Returns:
+        Tuple[np.ndarray, Tuple[float, float], float]: As water_equivalent_phantom, the pixel size being the smaller
+        in-plane spacing of the CT.
+    """
+    volume = load_ct_volume(dicom_directory)
+    z = volume.origin[2] + np.arange(volume.hu.shape[0]) * volume.spacing[2] - isocentre[2]
+    inside = (z >= slab[0]) & (z <= slab[1])
+    if not inside.any():
+        inside = np.abs(z) == np.abs(z).min() # field between two slices, use the nearest
+    density = np.clip(1. + np.maximum(volume.hu[inside], AIR_HU) / 1000., 0., None).mean(axis=0)
+    if volume.spacing[0] != volume.spacing[1]:
+        # resample to square pixels by nearest neighbour, the pre-pass does not need more
+        pixel = min(volume.spacing[:2])
+        rows = np.minimum((np.arange(int(density.shape[0] * volume.spacing[1] / pixel)) * pixel / volume.spacing[1])
+                          .astype(int), density.shape[0] - 1)
+        columns = np.minimum((np.arange(int(density.shape[1] * volume.spacing[0] / pixel)) * pixel / volume.spacing[0])
+                             .astype(int), density.shape[1] - 1)
+        density = density[np.ix_(rows, columns)]
+    origin = (volume.origin[0] - isocentre[0], volume.origin[1] - isocentre[1])
+    return density, origin, float(min(volume.spacing[:2]))
+
+
+def path_transmissions(setup: Dict[str, object], density: np.ndarray, origin: Tuple[float, float], pixel: float,
+                       rays: int = 9, energy_bin: float = 1., chunk: int = 64) -> np.ndarray:
+    """Mean primary transmission across the fan at every gantry angle of the setup.
+
+    Rays from the focal spot to rays points across the field at the isocentre plane are sampled every pixel through
+    the density map, their water-equivalent path (g/cm2) attenuates the spectrum after the titanium filter.
+
+    Args:
+        setup (Dict[str, object]): See ctdi_estimator.read_beam_setup.
+        density (np.ndarray): Water-equivalent density in g/cm3, indexed (y, x).
+        origin (Tuple[float, float]): Centre of the first pixel (x, y) in mm from the isocentre.
+        pixel (float): Pixel size in mm.
+        rays (int): Rays across the fan.
+        energy_bin (float): Width in keV the spectrum is merged to.
+        chunk (int): Gantry angles traced per array.
+
+    Returns:
+        np.ndarray: Transmission at every gantry angle.
+    """
+    field_x1, field_x2, _, _ = setup['field']
+    sid = setup['source_distance']
+    corners = np.array([origin, (origin[0] + density.shape[1] * pixel, origin[1] + density.shape[0] * pixel)])
+    reach = float(np.sqrt((np.abs(corners).max(axis=0) ** 2).sum()))
+    all_angles = np.radians(np.asarray(setup['angles'], dtype=float))
+    fan = np.linspace(-field_x2, field_x1, rays)[None, :, None]
+    along = np.arange(max(0., sid - reach), sid + reach, pixel)[None, None, :]
+    norm = np.sqrt(sid ** 2 + fan ** 2)
+    path = np.empty((all_angles.size, rays))
+    for start in range(0, all_angles.size, chunk):
+        angles = all_angles[start:start + chunk, None, None]
+        # point at distance along from the focal spot on the ray through the fan coordinate at the isocentre plane
+        x = sid * np.sin(angles) + along / norm * (fan * np.cos(angles) - sid * np.sin(angles))
+        y = -sid * np.cos(angles) + along / norm * (fan * np.sin(angles) + sid * np.cos(angles))
+        columns = np.rint((x - origin[0]) / pixel).astype(int)
+        rows = np.rint((y - origin[1]) / pixel).astype(int)
+        inside = (columns >= 0) & (columns < density.shape[1]) & (rows >= 0) & (rows < density.shape[0])
+        values = density[np.clip(rows, 0, density.shape[0] - 1), np.clip(columns, 0, density.shape[1] - 1)]
+        path[start:start + chunk] = np.where(inside, values, 0.).sum(axis=2) * pixel / 10. # g/cm2
+
+    energies, weights = merge_energy_bins(setup['energies'], setup['weights'], energy_bin)
+    weights = weights * np.exp(-mass_coefficients(TITANIUM, energies)[0] * TITANIUM_DENSITY * setup['titanium'] / 10.)
+    weights = weights / weights.sum()
+    mu_water = mass_coefficients(WATER, energies)[0]
+    return (np.exp(-np.multiply.outer(path, mu_water)) @ weights).mean(axis=1)
+
+
+def attenuation_prepass(head_file: str, phantom_file: Optional[str] = None, patient_file: Optional[str] = None,
+                        rays: int = 9) -> np.ndarray:
+    """Primary transmission at every sequential time of a rendered run, for variance_optimal allocations.
+
+    Args:
+        head_file (str): Edited headsourcecode.txt, with ConvertedTopasFile.txt and head_calibration_factor.txt next
+            to it.
+        phantom_file (str, optional): CTDIphantom_16/32.txt of a CTDI run.
+        patient_file (str, optional): patientDICOM.txt of a DICOM run, its CT (or resampled CT) is read.
+        rays (int): Rays across the fan.
+
+    Raises:
+        ValueError: If neither a phantom nor a patient file is given.
+    """
+    setup = read_beam_setup(head_file)
+    energy = float((setup['energies'] * setup['weights']).sum() / setup['weights'].sum())
+    if phantom_file is not None:
+        density, origin, pixel = water_equivalent_phantom(read_phantom(phantom_file), energy)
+    elif patient_file is not None:
+        patient = TopasParameterFile.from_file(patient_file)
+        isocentre = tuple(length_mm(patient.value('Ge/Isocenter' + axis))
+                          + length_mm(patient.value('Ge/Patient/UserTrans' + axis)) for axis in 'XYZ')
+        _, _, field_y1, field_y2 = setup['field']
+        density, origin, pixel = water_equivalent_ct(patient.value('Ge/Patient/DicomDirectory').strip('"'), isocentre,
+                                                     (-field_y2, field_y1))
+    else:
+        raise ValueError('The attenuation pre-pass needs a phantom or a patient file')
+    return path_transmissions(setup, density, origin, pixel, rays)
+
+
+def write_allocation(allocation: HistoryAllocation, rundatadir: str,
+                     transmissions: Optional[Sequence[float]] = None) -> str:
+    """Writes NbParticlesInTime.txt, NbParticlesWeights.txt and history_allocation.json into the run folder.
+
+    The tables have one "time_ms value" line per sequential time, as the static NbParticlesInTime.txt. The JSON
+    records the segments and, with the transmissions, the predicted efficiency gain. Returns the JSON path.
+    """
+    times_ms = [int(round(time * 1000.)) for time in allocation.times]
+    with open(os.path.join(rundatadir, ALLOCATION_TABLE), 'w') as f:
+        f.writelines(str(time) + ' ' + str(int(histories)) + '\n'
+                     for time, histories in zip(times_ms, allocation.step_histories()))
+    with open(os.path.join(rundatadir, WEIGHTS_TABLE), 'w') as f:
+        f.writelines(str(time) + ' ' + format(weight, '.10g') + '\n'
+                     for time, weight in zip(times_ms, allocation.step_weights()))
+    record = {'mode': allocation.mode, 'reference_histories': allocation.reference_histories,
+              'sequential_times': len(allocation.times), 'total_histories': int(allocation.step_histories().sum()),
+              'segments': list(allocation.segments)}
+    if transmissions is not None:
+        record['efficiency_gain'] = efficiency_gain(allocation, transmissions)
+    json_path = os.path.join(rundatadir, ALLOCATION_JSON)
+    with open(json_path, 'w') as f:
+        json.dump(record, f, indent=2)
+    return json_path
+
+
+def prepare_history_allocation(head_file: str, rundatadir: str, settings: HistoryAllocationSettings,
+                               phantom_file: Optional[str] = None,
+                               patient_file: Optional[str] = None) -> HistoryAllocation:
+    """Allocates the histories of a rendered run, running the attenuation pre-pass for variance_optimal, and writes
+    the tables into the run folder (see write_allocation).
+
+    Args:
+        head_file (str): Edited headsourcecode.txt, its histories per run are the reference H.
+        rundatadir (str): Run folder.
+        settings (HistoryAllocationSettings): Mode, segments, tube currents and floor.
+        phantom_file (str, optional): CTDIphantom_16/32.txt of a CTDI run.
+        patient_file (str, optional): patientDICOM.txt of a DICOM run.
+    """
+    chain = load_parameter_chain(head_file)
+    histories, _ = histories_per_run_count(chain)
+    transmissions = None
+    if settings.mode == 'variance_optimal':
+        transmissions = attenuation_prepass(head_file, phantom_file, patient_file)
+    allocation = allocate_histories(sequential_times(chain), histories, settings, transmissions)
+    write_allocation(allocation, rundatadir, transmissions)
+    return allocation
@@ -0,0 +1,106 @@
+# Staging of the static TOPAS include files (Muen.dat, NbParticlesInTime.txt, the Schneider HU table and the fan files)
+# into run folders. Every version of a static file is kept once in a content-addressed store (cache/includes/<sha256>/)
+# as a read-only, checksummed copy, and run folders get hardlinks to it (copies when the store is on another filesystem).
+# A hardlink is a full file of the run folder, so runs stay self-contained for archiving and re-running, but tens of
+# thousands of run folders share the bytes of one copy. Code that edits a staged file in a run folder must call
+# materialise() first, which swaps the link for a private copy so the store and the other runs are untouched.
+import os
+import shutil
+import threading
+from typing import Dict, List, Tuple
+
+from src.defaultvalues import default_INCLUDE_STORE_DIR
+from src.run_cache import file_digest, link_or_copy
+
+INCLUDE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'boilerplates', 'TOPAS_includeFiles')
+STATIC_INCLUDE_FILES = ['Muen.dat', 'NbParticlesInTime.txt', 'HUtoMaterialSchneider.txt', 'fullfan.txt', 'halffan.txt']
+_READ_ONLY = 0o444
+
+_digests: Dict[Tuple[str, int, int], str] = {}
+_store_lock = threading.Lock()
+
+
+def _source_digest(source: str) -> str:
+    # sources are hashed once per version, the boilerplates only change when they are edited
+    stat = os.stat(source)
+    key = (os.path.abspath(source), stat.st_size, stat.st_mtime_ns)
+    if key not in _digests:
+        _digests[key] = file_digest(source)
+    return _digests[key]
+
+
+def store_file(source: str, store_dir: str = default_INCLUDE_STORE_DIR) -> str:
+    """Puts a read-only copy of source into the store under its sha256, if it is not there yet.
+
+    Returns:
+        str: Path of the stored copy.
+
+    Raises:
+        IOError: If source changed while it was copied.
+    """
+    with _store_lock:
+        digest = _source_digest(source)
+        stored = os.path.join(store_dir, digest, os.path.basename(source))
+        if os.path.isfile(stored):
+            return stored
+        os.makedirs(os.path.dirname(stored), exist_ok=True)
+        temporary = stored + '.tmp' + str(os.getpid())
+        shutil.copyfile(source, temporary)
+        if file_digest(temporary) != digest:
+            os.remove(temporary)
+            raise IOError(source + ' changed while it was copied into the include store')
+        os.chmod(temporary, _READ_ONLY)
+        os.replace(temporary, stored)
+        return stored
+
+
+def stage_file(source: str, rundatadir: str, store_dir: str = default_INCLUDE_STORE_DIR) -> str:
+    """Places the stored copy of source in rundatadir under the same name, as a hardlink or a copy.
+
+    Returns:
+        str: Path of the staged file.
+    """
+    destination = os.path.join(rundatadir, os.path.basename(source))
+    link_or_copy(store_file(source, store_dir), destination)
+    return destination
+
+
+def stage_static_files(names: List[str], rundatadir: str, source_dir: str = INCLUDE_DIR,
+                       store_dir: str = default_INCLUDE_STORE_DIR) -> List[str]:
+    """Stages the named include files of source_dir (the boilerplate include files by default) into rundatadir."""
+    return [stage_file(os.path.join(source_dir, name), rundatadir, store_dir) for name in names]
+
+
+def materialise(filepath: str) -> str:
+    """Replaces a staged (hardlinked or read-only) file by a private writable copy before it is edited."""
+    stat = os.stat(filepath)
+    if stat.st_nlink > 1 or not stat.st_mode & 0o200:
+        temporary = filepath + '.tmp' + str(os.getpid())
+        shutil.copyfile(filepath, temporary)
+        os.replace(temporary, filepath)
+    return filepath
+
+
+def verify_store(store_dir: str = default_INCLUDE_STORE_DIR, remove: bool = False) -> List[str]:
+    """Re-hashes every stored file against the checksum it is stored under.
+
+    Args:
+        store_dir (str): Include store.
+        remove (bool): Deletes damaged copies so the next stage_file stores them again. Run folders linking a damaged
+            copy are not repaired.
+
+    Returns:
+        List[str]: Paths of the stored files whose content does not match their checksum.
+    """
+    damaged = []
+    if not os.path.isdir(store_dir):
+        return damaged
+    for digest in sorted(os.listdir(store_dir)):
+        folder = os.path.join(store_dir, digest)
+        for name in os.listdir(folder) if os.path.isdir(folder) else []:
+            stored = os.path.join(folder, name)
+            if file_digest(stored) != digest:
+                damaged.append(stored)
+                if remove:
+                    os.remove(stored)
+    return damaged
@@ -0,0 +1,180 @@
+# Scheduler for TOPAS processes that budgets CPU threads instead of processes.
+# Every TOPAS job asks for i:Ts/NumberOfThreads threads, a job is only started while that many threads of the budget are
+# free, so 5 CTDI plug files with 12 threads each no longer ask for 60 threads at once on a 16 core machine.
+# Jobs wait in a priority queue (lower number runs first, first come first served within a priority) and are started
+# from a thread pool in this process, the TOPAS executable is called directly without a shell and its output is streamed
+# into a log file and the progress monitor.
+import os
+import sys
+import heapq
+import itertools
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from typing import List, Optional, Tuple
+
+from src.progress_monitor import run_supervised
+from src.topas_parameters import TopasParameterFile
+
+
+class TopasJob:
+    """A TOPAS run: the command line, the folder it runs in and the number of threads it will use.
+
+    Args:
+        command (List[str]): Executable and arguments, eg. [topas_path, parameter_file].
+        cwd (str): Working directory of the process, TOPAS writes its outputs here.
+        threads (int): Threads the job uses, counted against the scheduler budget.
+        priority (int): Lower numbers are started first.
+        name (str, optional): Label used in logs, defaults to the last argument of the command.
+        log_file (str, optional): Log of the process output, defaults to <cwd>/<name without extension>.log.
+        histories_per_run (int, optional): Histories per run, for the progress percent and ETA.
+        runs (int): Number of runs (Tf/NumberOfSequentialTimes) of the job.
+    """
+
+    def __init__(self, command: List[str], cwd: str, threads: int = 1, priority: int = 0, name: Optional[str] = None,
+                 log_file: Optional[str] = None, histories_per_run: Optional[int] = None, runs: int = 1):
+        self.command = list(command)
+        self.cwd = cwd
+        self.threads = max(1, int(threads))
+        self.priority = priority
+        self.name = name if name is not None else os.path.basename(self.command[-1])
+        self.log_file = log_file or os.path.join(cwd, os.path.splitext(self.name)[0] + '.log')
+        self.histories_per_run = histories_per_run
+        self.runs = runs
+
+    def run(self) -> int:
+        """Runs the process to completion under the progress monitor and returns its exit code."""
+        return run_supervised(self.command, self.cwd, self.log_file, self.name, self.histories_per_run, self.runs,
+                              echo=sys.stdout)
+
+    def __repr__(self):
+        return 'TopasJob(' + self.name + ', threads=' + str(self.threads) + ', priority=' + str(self.priority) + ')'
+
+
+def topas_thread_request(parameter_file: str, cpu_count: Optional[int] = None) -> int:
+    """Number of threads TOPAS will start for a parameter file, from i:Ts/NumberOfThreads.
+
+    TOPAS uses 1 thread when the parameter is not set, all cores for 0 and all but n cores for -n.
+    """
+    cpu_count = cpu_count or os.cpu_count() or 1
+    value = TopasParameterFile.from_file(parameter_file).value('Ts/NumberOfThreads')
+    if value is None:
+        return 1
+    requested = int(value.split()[0])
+    if requested > 0:
+        return requested
+    return max(1, cpu_count + requested)
+
+
+def topas_history_request(parameter_file: str) -> Tuple[Optional[int], int]:
+    """Histories per run (i:So/beam/NumberOfHistoriesInRun, None when not set) and runs (Tf/NumberOfSequentialTimes)."""
+    parameters = TopasParameterFile.from_file(parameter_file)
+    histories = parameters.value('So/beam/NumberOfHistoriesInRun')
+    runs = parameters.value('Tf/NumberOfSequentialTimes', '1')
+    return (None if histories is None else int(histories.split()[0])), max(1, int(runs.split()[0]))
+
+
+def parameter_file_job(topas_application_path: str, parameter_file: str, cwd: str, priority: int = 0) -> TopasJob:
+    """Job running TOPAS on one parameter file, with its thread and history counts read from the file."""
+    histories_per_run, runs = topas_history_request(parameter_file)
+    return TopasJob([topas_application_path.strip(), parameter_file], cwd, threads=topas_thread_request(parameter_file),
+                    priority=priority, histories_per_run=histories_per_run, runs=runs)
+
+
+class JobScheduler:
+    """Priority queue of TopasJobs admitted against a thread budget.
+
+    Jobs are admitted strictly in queue order: while the job at the head of the queue does not fit in the free threads,
+    nothing behind it is started, so large jobs are not starved by a stream of small ones. A job asking for more than
+    the whole budget runs alone.
+
+    Args:
+        thread_budget (int, optional): Threads available to all running jobs, defaults to the number of CPUs.
+    """
+
+    def __init__(self, thread_budget: Optional[int] = None):
+        self.thread_budget = max(1, thread_budget or os.cpu_count() or 1)
+        self._queue = []
+        self._order = itertools.count()
+        self._threads_in_use = 0
+        self._lock = threading.Lock()
+        # every running job uses at least one thread of the budget, so this is never the limit
+        self._pool = ThreadPoolExecutor(max_workers=self.thread_budget, thread_name_prefix='topas-job')
+
+    def submit(self, job: TopasJob) -> Future:
+        """Queues a job, the returned future gives the exit code of the process."""
+        future = Future()
+        with self._lock:
+            heapq.heappush(self._queue, (job.priority, next(self._order), job, future))
+        self._dispatch()
+        return future
+
+    def queued_jobs(self) -> List[TopasJob]:
+        """Jobs waiting for threads, in the order they will be started."""
+        with self._lock:
+            return [entry[2] for entry in sorted(self._queue)]
+
+    @property
+    def threads_in_use(self) -> int:
+        return self._threads_in_use
+
+    def _dispatch(self) -> None:
+        with self._lock:
+            while self._queue:
+                _, _, job, future = self._queue[0]
+                if future.cancelled():
+                    heapq.heappop(self._queue)
+                    continue
+                threads = min(job.threads, self.thread_budget)
+                if self._threads_in_use + threads > self.thread_budget:
+                    break
+                heapq.heappop(self._queue)
+                future.set_running_or_notify_cancel()
+                self._threads_in_use += threads
+                self._pool.submit(self._run, job, threads, future)
+
+    def _run(self, job: TopasJob, threads: int, future: Future) -> None:
+        try:
+            future.set_result(job.run())
+        except BaseException as error:
+            future.set_exception(error)
+        finally:
+            with self._lock:
+                self._threads_in_use -= threads
+            self._dispatch()
+
+    def shutdown(self, wait_for_jobs: bool = True) -> None:
+        """Cancels the queued jobs that have not started and stops the pool."""
+        with self._lock:
+            while self._queue:
+                heapq.heappop(self._queue)[3].cancel()
+        self._pool.shutdown(wait=wait_for_jobs)
+
+
+def wait_for_jobs(futures: List[Future]) -> List[int]:
+    """Blocks until all jobs are done, returns their exit codes (None for cancelled jobs, -1 for jobs that raised)."""
+    wait(futures)
+    exit_codes = []
+    for future in futures:
+        if future.cancelled():
+            exit_codes.append(None)
+        elif future.exception() is not None:
+            exit_codes.append(-1)
+        else:
+            exit_codes.append(future.result())
+    return exit_codes
+
+
+_shared_scheduler = None
+_shared_scheduler_lock = threading.Lock()
+
+
+def get_scheduler(thread_budget: Optional[int] = None) -> JobScheduler:
+    """Scheduler shared by every run started from this process, so concurrent runs share one thread budget.
+
+    thread_budget only applies when the shared scheduler is created by this call (eg. from a command line option).
+    """
+    global _shared_scheduler
+    with _shared_scheduler_lock:
+        if _shared_scheduler is None:
+            _shared_scheduler = JobScheduler(thread_budget)
+        return _shared_scheduler
@@ -0,0 +1,234 @@
+# HU to material compaction for DICOM runs. With the Schneider converter TOPAS makes a material for every HU value the CT
+# uses: the composition comes from the SchneiderHUToMaterialSections the HU falls in, the density from the
+# SchneiderHounsfieldUnitSections formula times the DensityCorrection of that HU. A clinical CT uses thousands of HU
+# values, and creating that many materials dominates the initialisation of a patient run. Compaction works on the HU
+# histogram of the series that is simulated:
+#   - adjacent composition sections whose element weights differ by at most composition_tolerance (absolute mass
+#     fraction) are merged, the merged weights are the voxel count weighted mean of the sections
+#   - within one composition and density section, consecutive HU values whose density stays within density_tolerance
+#     (relative) of the first are grouped and all mapped to the HU whose density is nearest the voxel weighted mean
+#     density of the group, so the mass of the group is kept
+# The CT is rewritten with the mapped HU into the run folder, a compacted copy of the conversion table is included
+# instead of HUtoMaterialSchneider.txt, and material_compaction.json reports the material counts, the density changes
+# and the predicted dose impact. For kV photons the dose in and behind a voxel follows its attenuation, which is
+# proportional to density for a fixed composition, so the predicted dose impact is the voxel weighted mean absolute
+# relative density change.
+import os
+import json
+import shutil
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+import numpy as np
+
+from src.ct_resampling import load_ct_volume, write_ct_series
+from src.ctdi_analysis import json_safe
+from src.progress_monitor import get_monitor
+from src.topas_parameters import TopasParameterFile
+
+COMPACTED_CT_DIR = 'compacted_CT'
+COMPACTED_TABLE = 'HUtoMaterialCompacted.txt'
+COMPACTION_REPORT = 'material_compaction.json'
+SCHNEIDER_TABLE = 'HUtoMaterialSchneider.txt'
+MIN_HU = -1000
+MAX_HU = 2995
+
+
+class MaterialCompaction(NamedTuple):
+    density_tolerance: float = 0.01 # relative density spread allowed within one merged HU group
+    composition_tolerance: float = 0.005 # largest element mass fraction difference of merged composition sections
+
+
+def _vector(parameters: TopasParameterFile, name: str) -> List[str]:
+    # TOPAS vectors are written as count followed by the values
+    values = parameters.value(name).split()
+    return values[1:int(values[0]) + 1]
+
+
+class SchneiderTable:
+    """The Schneider conversion parameters of a TOPAS include file.
+
+    Args:
+        filepath (str): HUtoMaterialSchneider.txt or a compacted copy of it.
+    """
+
+    def __init__(self, filepath: str):
+        self.filepath = filepath
+        self.parameters = TopasParameterFile.from_file(filepath)
+        parameters = self.parameters
+        self.density_sections = [int(value) for value in _vector(parameters, 'Ge/Patient/SchneiderHounsfieldUnitSections')]
+        self.density_offset = np.array(_vector(parameters, 'Ge/Patient/SchneiderDensityOffset'), dtype=float)
+        self.density_factor = np.array(_vector(parameters, 'Ge/Patient/SchneiderDensityFactor'), dtype=float)
+        self.factor_offset = np.array(_vector(parameters, 'Ge/Patient/SchneiderDensityFactorOffset'), dtype=float)
+        self.density_correction = np.array(_vector(parameters, 'Ge/Patient/DensityCorrection'), dtype=float)
+        self.material_sections = [int(value) for value in _vector(parameters, 'Ge/Patient/SchneiderHUToMaterialSections')]
+        self.weights = np.array([_vector(parameters, 'Ge/Patient/SchneiderMaterialsWeight' + str(index + 1))
+                                 for index in range(len(self.material_sections) - 1)], dtype=float)
+
+    def _section(self, boundaries: List[int], hu: np.ndarray) -> np.ndarray:
+        return np.clip(np.searchsorted(boundaries, hu, side='right') - 1, 0, len(boundaries) - 2)
+
+    def density(self, hu: np.ndarray) -> np.ndarray:
+        """Density (g/cm3) of integer HU values in [MIN_HU, MAX_HU]."""
+        hu = np.asarray(hu)
+        section = self._section(self.density_sections, hu)
+        correction = self.density_correction[np.clip(hu - MIN_HU, 0, len(self.density_correction) - 1)]
+        return (self.density_offset[section] + self.density_factor[section] * (self.factor_offset[section] + hu)) \
+            * correction
+
+    def material_section(self, hu: np.ndarray) -> np.ndarray:
+        return self._section(self.material_sections, np.asarray(hu))
+
+    def density_section(self, hu: np.ndarray) -> np.ndarray:
+        return self._section(self.density_sections, np.asarray(hu))
+
+
+def hu_histogram(hu: np.ndarray) -> np.ndarray:
+    """Voxel counts of the integer HU values MIN_HU..MAX_HU (values outside are clamped like TOPAS does)."""
+    values = np.clip(np.rint(hu), MIN_HU, MAX_HU).astype(np.int64) - MIN_HU
+    return np.bincount(values.ravel(), minlength=MAX_HU - MIN_HU + 1)
+
+
+def merge_composition_sections(table: SchneiderTable, counts: np.ndarray,
+                               composition_tolerance: float) -> Tuple[List[int], np.ndarray]:
+    """Merges adjacent composition sections whose weights differ by at most composition_tolerance.
+
+    Returns:
+        Tuple[List[int], np.ndarray]: New section boundaries and weights, one row per section.
+    """
+    hu = np.arange(MIN_HU, MAX_HU + 1)
+    section_counts = np.bincount(table.material_section(hu), weights=counts, minlength=len(table.weights))
+    boundaries = [table.material_sections[0]]
+    weights, merged_counts = [table.weights[0]], [section_counts[0]]
+    first = table.weights[0] # sections are compared with the first of their group, so merges cannot drift
+    for index in range(1, len(table.weights)):
+        if np.max(np.abs(table.weights[index] - first)) <= composition_tolerance:
+            total = merged_counts[-1] + section_counts[index]
+            if total > 0:
+                weights[-1] = (weights[-1] * merged_counts[-1] + table.weights[index] * section_counts[index]) / total
+            merged_counts[-1] = total
+        else:
+            boundaries.append(table.material_sections[index])
+            weights.append(table.weights[index])
+            first = table.weights[index]
+            merged_counts.append(section_counts[index])
+    boundaries.extend(table.material_sections[len(table.weights):])
+    weights = np.array(weights)
+    return boundaries, weights / weights.sum(axis=1, keepdims=True)
+
+
+def group_hu_values(table: SchneiderTable, counts: np.ndarray, material_sections: List[int],
+                    density_tolerance: float) -> np.ndarray:
+    """Lookup from HU (index HU - MIN_HU) to the representative HU of its group, see the module comment."""
+    hu = np.arange(MIN_HU, MAX_HU + 1)
+    density = table.density(hu)
+    material = np.clip(np.searchsorted(material_sections, hu, side='right') - 1, 0, len(material_sections) - 2)
+    density_section = table.density_section(hu)
+    lookup = hu.copy()
+    used = np.flatnonzero(counts)
+    start = 0
+    while start < len(used):
+        first = used[start]
+        end = start + 1
+        while (end < len(used) and material[used[end]] == material[first]
+               and density_section[used[end]] == density_section[first]
+               and abs(density[used[end]] - density[first]) <= density_tolerance * density[first]):
+            end += 1
+        group = used[start:end]
+        mean_density = np.sum(density[group] * counts[group]) / counts[group].sum()
+        lookup[group] = hu[group[np.argmin(np.abs(density[group] - mean_density))]]
+        start = end
+    return lookup
+
+
+def write_compacted_table(table: SchneiderTable, material_sections: List[int], weights: np.ndarray,
+                          filepath: str) -> None:
+    """Copy of the conversion table with the merged composition sections."""
+    parameters = table.parameters.copy()
+    parameters.set('iv:Ge/Patient/SchneiderHUToMaterialSections',
+                   str(len(material_sections)) + ' ' + ' '.join(str(value) for value in material_sections))
+    for index in range(len(table.weights)):
+        name = 'Ge/Patient/SchneiderMaterialsWeight' + str(index + 1)
+        if index < len(weights):
+            parameters.set(name, str(len(weights[index])) + ' ' + ' '.join(format(value, '.6g') for value in weights[index]))
+        else:
+            parameters.delete(name)
+    parameters.write(filepath)
+
+
+def compact_patient_materials(rundatadir: str, compaction: MaterialCompaction = MaterialCompaction(),
+                              patient_file: Optional[str] = None) -> Dict[str, object]:
+    """Compacts the HU to material conversion of a prepared DICOM run folder.
+
+    The CT of Ge/Patient/DicomDirectory is rewritten with the grouped HU into rundatadir/compacted_CT (a resampled
+    series in the run folder is replaced), the compacted table is written next to it and the patient file is pointed
+    at both.
+
+    Returns:
+        Dict[str, object]: The report, also written to material_compaction.json.
+    """
+    patient_file = patient_file or os.path.join(rundatadir, 'patientDICOM.txt')
+    patient = TopasParameterFile.from_file(patient_file)
+    dicom_directory = os.path.normpath(os.path.join(rundatadir, patient.value('Ge/Patient/DicomDirectory').strip('"')))
+    table = SchneiderTable(os.path.join(rundatadir, SCHNEIDER_TABLE))
+
+    volume = load_ct_volume(dicom_directory)
+    counts = hu_histogram(volume.hu)
+    material_sections, weights = merge_composition_sections(table, counts, compaction.composition_tolerance)
+    lookup = group_hu_values(table, counts, material_sections, compaction.density_tolerance)
+
+    hu_index = np.clip(np.rint(volume.hu), MIN_HU, MAX_HU).astype(np.int64) - MIN_HU
+    compacted_hu = lookup[hu_index].astype(np.float32)
+    write_ct_series(volume._replace(hu=compacted_hu), os.path.join(rundatadir, COMPACTED_CT_DIR), 'compacted')
+    if os.path.dirname(dicom_directory) == os.path.normpath(rundatadir):
+        shutil.rmtree(dicom_directory) # resampled series of this run
+
+    write_compacted_table(table, material_sections, weights, os.path.join(rundatadir, COMPACTED_TABLE))
+    patient.remove_include(SCHNEIDER_TABLE)
+    patient.add_include(COMPACTED_TABLE)
+    patient.set('s:Ge/Patient/DicomDirectory', '"' + COMPACTED_CT_DIR + '/"')
+    patient.write(patient_file)
+
+    hu = np.arange(MIN_HU, MAX_HU + 1)
+    density = table.density(hu)
+    used = counts > 0
+    merged_section = np.clip(np.searchsorted(material_sections, hu, side='right') - 1, 0, len(weights) - 1)
+    composition_change = np.max(np.abs(weights[merged_section] - table.weights[table.material_section(hu)]), axis=1)
+    relative_change = np.abs(density[lookup - MIN_HU] - density) / density
+    mass = np.sum(counts * density)
+    materials_before, materials_after = int(used.sum()), int(len(np.unique(lookup[used])))
+    report = {
+        'density_tolerance': compaction.density_tolerance,
+        'composition_tolerance': compaction.composition_tolerance,
+        'voxels': int(counts.sum()),
+        'materials_before': materials_before,
+        'materials_after': materials_after,
+        'composition_sections_before': len(table.weights),
+        'composition_sections_after': len(weights),
+        'max_absolute_density_change': float(relative_change[used].max()) if used.any() else 0.,
+        'max_composition_change': float(composition_change[used].max()) if used.any() else 0.,
+        'total_mass_change': float((np.sum(counts * density[lookup - MIN_HU]) - mass) / mass),
+        'predicted_dose_impact': float(np.sum(counts * relative_change) / counts.sum()),
+        'predicted_initialisation_fraction': materials_after / materials_before if materials_before else 1.,
+        'initialisation_seconds': None,
+    }
+    write_compaction_report(report, rundatadir)
+    return report
+
+
+def write_compaction_report(report: Dict[str, object], rundatadir: str) -> None:
+    with open(os.path.join(rundatadir, COMPACTION_REPORT), 'w') as f:
+        json.dump(json_safe(report), f, indent=2)
+
+
+def record_initialisation_time(rundatadir: str, log_name: str = 'headsourcecode.log') -> Optional[float]:
+    """Adds the measured TOPAS initialisation time (process start to the first run start) to the compaction report."""
+    report_path = os.path.join(rundatadir, COMPACTION_REPORT)
+    log_file = os.path.join(rundatadir, log_name)
+    jobs = [job for job in get_monitor().jobs() if job['log_file'] == log_file]
+    if not os.path.isfile(report_path) or not jobs or jobs[-1]['initialisation_seconds'] is None:
+        return None
+    with open(report_path, 'r') as f:
+        report = json.load(f)
+    report['initialisation_seconds'] = jobs[-1]['initialisation_seconds']
+    write_compaction_report(report, rundatadir)
+    return report['initialisation_seconds']
@@ -0,0 +1,79 @@
+# Photon interaction data for the materials used in the simulations.
+# Muen.dat is the elemental table (Z = 1 - 92) read by the TOPAS TrackLengthEstimator scorer, each element is stored as a
+# header line "Z number_of_rows" followed by rows of "energy (MeV)  mu/rho (cm2/g)  muen/rho (cm2/g)".
+# Compound coefficients are built with the mixture rule from the mass fractions, like TOPAS does for the scorer.
+import os
+from functools import lru_cache
+from typing import Dict, Tuple
+
+import numpy as np
+
+MUEN_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'boilerplates', 'TOPAS_includeFiles', 'Muen.dat')
+
+# Element names as used in the TOPAS material definitions of the boilerplates
+ELEMENT_Z = {
+    'Hydrogen': 1, 'Carbon': 6, 'Nitrogen': 7, 'Oxygen': 8, 'Sodium': 11, 'Magnesium': 12, 'Aluminum': 13,
+    'Phosphorus': 15, 'Sulfur': 16, 'Chlorine': 17, 'Argon': 18, 'Potassium': 19, 'Calcium': 20, 'Titanium': 22,
+    'Chromium': 24, 'Iron': 26, 'Nickel': 28, 'Tungsten': 74, 'Lead': 82,
+}
+
+# Mass fractions and densities (g/cm3)
+AIR = {'Carbon': 0.000124, 'Nitrogen': 0.755268, 'Oxygen': 0.231781, 'Argon': 0.012827}
+AIR_DENSITY = 0.00120479
+WATER = {'Hydrogen': 0.111894, 'Oxygen': 0.888106}
+WATER_DENSITY = 1.0
+PMMA = {'Carbon': 0.599848, 'Hydrogen': 0.080538, 'Oxygen': 0.319614} # same as Ma/PMMA in CTDIphantom_16/32.txt
+PMMA_DENSITY = 1.190
+ALUMINUM = {'Aluminum': 1.0}
+ALUMINUM_DENSITY = 2.699
+TITANIUM = {'Titanium': 1.0}
+TITANIUM_DENSITY = 4.54
+
+
+@lru_cache(maxsize=None)
+def load_muen_table(filepath: str = MUEN_FILE) -> Dict[int, np.ndarray]:
+    """Reads the elemental attenuation table.
+
+    The whole file is parsed as one flat array of numbers and split using the row counts in the headers.
+
+    Returns:
+        Dict[int, np.ndarray]: For every Z an array of shape (rows, 3): energy (MeV), mu/rho and muen/rho (cm2/g).
+    """
+    with open(filepath, 'r') as f:
+        numbers = np.fromstring(f.read(), sep=' ')
+    table = {}
+    index = 2 # the first header "0 0" is a placeholder
+    while index < numbers.size:
+        z, rows = int(numbers[index]), int(numbers[index + 1])
+        index += 2
+        table[z] = numbers[index:index + 3 * rows].reshape(rows, 3)
+        index += 3 * rows
+    return table
+
+
+def mass_coefficients(composition: Dict[str, float], energies: np.ndarray,
+                      filepath: str = MUEN_FILE) -> Tuple[np.ndarray, np.ndarray]:
+    """Mass attenuation and mass energy-absorption coefficients of a compound.
+
+    Args:
+        composition (Dict[str, float]): Element name to mass fraction, fractions are normalised to 1.
+        energies (np.ndarray): Photon energies in keV.
+        filepath (str): Elemental table, defaults to the Muen.dat used by the scorers.
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray]: mu/rho and muen/rho in cm2/g at each energy, log-log interpolated.
+    """
+    table = load_muen_table(filepath)
+    log_energies = np.log(np.asarray(energies, dtype=float) / 1000.)
+    total_fraction = sum(composition.values())
+    mu = np.zeros_like(log_energies)
+    muen = np.zeros_like(log_energies)
+    for element, fraction in composition.items():
+        if fraction <= 0:
+            continue
+        data = table[ELEMENT_Z[element]]
+        log_data = np.log(data)
+        # absorption edges appear as repeated energies, np.interp takes the value on the correct side of the edge
+        mu += fraction / total_fraction * np.exp(np.interp(log_energies, log_data[:, 0], log_data[:, 1]))
+        muen += fraction / total_fraction * np.exp(np.interp(log_energies, log_data[:, 0], log_data[:, 2]))
+    return mu, muen
@@ -0,0 +1,272 @@
+# Two-stage simulation through a phase space below the bowtie. Most primaries of a run stop in the imaging head (source,
+# titanium filter, lead and steel blades Coll1-4 / Coll*steel, bowtie of fullfan.txt or halffan.txt), and the head is
+# the same for every patient and phantom scanned with the same spectrum, fan and blade setting.
+#   1. Head only: the run's headsourcecode.txt without patient, phantom, graphics and gantry rotation, with a thin air
+#      box (PhaseSpacePlane) in the Rotation group 20 cm past the source, i.e. below the bowtie and far above any
+#      patient. A PhaseSpace scorer records every particle leaving its downstream face, in the frame of the plane,
+#      with the empty histories so a stage 2 history is one stage 1 primary and the head calibration factor still holds.
+#   2. Patient or CTDI run: the head components are excluded (Ge/<component>/Include = False), the fan include is
+#      dropped and So/beam becomes a PhaseSpace source on a PhaseSpacePlane group at the same place in the Rotation
+#      group, so the recorded particles turn with the gantry. The phase space is reused (recycled) as often as the
+#      histories of the run need.
+# Head-only runs are kept in a library (cache/phasespace/<key>/) keyed by the rendered head-only file and its includes
+# (spectrum, fan, blade positions, histories), the TOPAS installation and the Geant4 data. Every entry records its
+# protocol, fan and blades in phase_space_entry.json and the library index.json, so the head is simulated once per
+# protocol setting instead of once per run. Recycling a phase space does not reduce its own (latent) variance, the
+# recycling factor of every run is written to phase_space_source.json in the run folder.
+import os
+import json
+import time
+import shutil
+import hashlib
+import threading
+from typing import Dict, List, NamedTuple, Optional
+
+from src.defaultvalues import default_PHASE_SPACE_DIR, default_PHASE_SPACE_HISTORIES
+from src.job_scheduler import get_scheduler, parameter_file_job, wait_for_jobs
+from src.run_cache import file_digest, g4data_identity, link_or_copy, topas_identity
+from src.sharding import histories_per_run_count
+from src.topas_parameters import TopasParameterFile, load_parameter_chain
+
+PLANE_COMPONENT = 'PhaseSpacePlane'
+PLANE_POSITION = '-800 mm' # Ge/PhaseSpacePlane/TransY in the Rotation group, the source is at -1000 mm
+PHASE_SPACE_SCORER = 'PhaseSpaceBelowBowtie'
+PHASE_SPACE_FILE = 'head_phasespace'
+PHASE_SPACE_EXTENSIONS = ['.phsp', '.header']
+HEAD_ONLY_FILE = 'headonly.txt'
+ENTRY_MANIFEST = 'phase_space_entry.json'
+LIBRARY_INDEX = 'index.json'
+RUN_SOURCE_RECORD = 'phase_space_source.json'
+HEAD_COMPONENTS = ['Coll1', 'Coll2', 'Coll3', 'Coll4', 'Coll1steel', 'Coll2steel', 'Coll3steel', 'Coll4steel',
+                   'BeamHardeningFilter']
+FAN_FILES = {'fullfan.txt': 'Full Fan', 'halffan.txt': 'Half Fan'}
+BLADE_PARAMETERS = ['Ge/Coll1/TransY', 'Ge/Coll2/TransY', 'Ge/Coll3/TransX', 'Ge/Coll4/TransX']
+_LIBRARY_SEED = '1'
+
+_build_locks: Dict[str, threading.Lock] = {}
+_locks_guard = threading.Lock()
+
+
+class PhaseSpaceSettings(NamedTuple):
+    histories: int = default_PHASE_SPACE_HISTORIES # primaries of the head-only run
+    multiple_use: int = 0 # So/beam/PhaseSpaceMultipleUse, 0 reads the file as often as the run's histories need
+    protocol: str = '' # label recorded in the library, eg. 'CBCT Clockwise_Head'
+
+
+def _define(parameters: TopasParameterFile, name: str, value: str) -> None:
+    # sets a typed parameter ('s:Ge/PhaseSpacePlane/Type'), appending it when the file does not define it
+    parameters.set(name, value, name.split(':', 1)[0])
+
+
+def render_head_only(head_file: str, histories: int) -> TopasParameterFile:
+    """The head-only configuration of a rendered headsourcecode.txt (see the module comment)."""
+    parameters = TopasParameterFile.from_file(head_file)
+    for include in ['patientDICOM.txt', 'CTDIphantom_16.txt', 'CTDIphantom_32.txt']:
+        parameters.remove_include(include)
+    for name in parameters.names():
+        if name.lower().startswith('gr/') or name.lower() in ['ts/useqt', 'ph/default/layeredmassgeometryworlds']:
+            parameters.delete(name)
+    # the phase space is recorded in the frame of the plane, which turns with the head, so one gantry angle is enough
+    _define(parameters, 'i:Tf/NumberOfSequentialTimes', '1')
+    _define(parameters, 'd:Tf/TimelineEnd', '1 s')
+    _define(parameters, 'd:Tf/Rotate/Rate', '0 deg/s')
+    _define(parameters, 'd:Tf/Rotate/StartValue', '0 deg')
+    _define(parameters, 'i:Ts/Seed', _LIBRARY_SEED)
+    _define(parameters, 'i:So/beam/NumberOfHistoriesInRun', str(int(histories)))
+    plane = 'Ge/' + PLANE_COMPONENT + '/'
+    for name, value in [('s:' + plane + 'Type', '"TsBox"'), ('s:' + plane + 'Parent', '"Rotation"'),
+                        ('s:' + plane + 'Material', '"Air"'), ('d:' + plane + 'HLX', '200 mm'),
+                        ('d:' + plane + 'HLY', '0.5 mm'), ('d:' + plane + 'HLZ', '200 mm'),
+                        ('d:' + plane + 'TransX', '0 mm'), ('d:' + plane + 'TransY', PLANE_POSITION),
+                        ('d:' + plane + 'TransZ', '0 mm'), ('d:' + plane + 'RotX', '0 deg'),
+                        ('d:' + plane + 'RotY', '0 deg'), ('d:' + plane + 'RotZ', '0 deg')]:
+        _define(parameters, name, value)
+    scorer = 'Sc/' + PHASE_SPACE_SCORER + '/'
+    for name, value in [('s:' + scorer + 'Quantity', '"PhaseSpace"'),
+                        ('s:' + scorer + 'Surface', '"' + PLANE_COMPONENT + '/YPlusSurface"'),
+                        ('s:' + scorer + 'OnlyIncludeParticlesGoing', '"Out"'),
+                        ('s:' + scorer + 'OutputType', '"Binary"'),
+                        ('s:' + scorer + 'OutputFile', '"' + PHASE_SPACE_FILE + '"'),
+                        ('s:' + scorer + 'IfOutputFileAlreadyExists', '"Overwrite"'),
+                        ('b:' + scorer + 'IncludeEmptyHistoriesAtEndOfFile', '"True"')]:
+        _define(parameters, name, value)
+    return parameters
+
+
+def head_settings(parameters: TopasParameterFile) -> Dict[str, object]:
+    """Fan and blade positions of a head configuration, as recorded in the library."""
+    fans = [FAN_FILES[name] for name in parameters.include_files() if name in FAN_FILES]
+    return {'fan': fans[0] if len(fans) == 1 else ' + '.join(fans),
+            'blades': [parameters.value(name, '') for name in BLADE_PARAMETERS]}
+
+
+def phase_space_key(head_only: TopasParameterFile, include_dir: str, topas_application_path: str) -> str:
+    """Library key of a head-only configuration: its text without the thread count and data path, its includes, the
+    TOPAS installation and the Geant4 data."""
+    keyed = head_only.copy()
+    g4_data = (keyed.value('Ts/G4DataDirectory') or '').strip('"')
+    for name in ['Ts/NumberOfThreads', 'Ts/G4DataDirectory']:
+        keyed.delete(name)
+    digest = hashlib.sha256(keyed.to_text().encode())
+    for name in sorted(head_only.include_files()):
+        filepath = os.path.join(include_dir, name)
+        digest.update(('\0' + name + '\0' + (file_digest(filepath) if os.path.isfile(filepath) else 'missing'))
+                      .encode())
+    digest.update(('\0' + topas_identity(topas_application_path) + '\0' + g4data_identity(g4_data)).encode())
+    return digest.hexdigest()
+
+
+def _read_manifest(entry_dir: str) -> Optional[Dict[str, object]]:
+    manifest_path = os.path.join(entry_dir, ENTRY_MANIFEST)
+    if not os.path.isfile(manifest_path):
+        return None
+    with open(manifest_path, 'r') as f:
+        entry = json.load(f)
+    if not all(os.path.isfile(os.path.join(entry_dir, PHASE_SPACE_FILE + extension))
+               for extension in PHASE_SPACE_EXTENSIONS):
+        return None
+    entry['entry_dir'] = os.path.abspath(entry_dir)
+    return entry
+
+
+def library_entries(library_dir: str = default_PHASE_SPACE_DIR, protocol: Optional[str] = None,
+                    fan: Optional[str] = None, blades: Optional[List[str]] = None) -> List[Dict[str, object]]:
+    """Library entries, optionally only those of a protocol label, fan ('Full Fan'/'Half Fan') and blade positions."""
+    entries = []
+    if not os.path.isdir(library_dir):
+        return entries
+    for name in sorted(os.listdir(library_dir)):
+        entry = _read_manifest(os.path.join(library_dir, name))
+        if entry is None or (protocol is not None and entry['protocol'] != protocol) \
+                or (fan is not None and entry['fan'] != fan) or (blades is not None and entry['blades'] != blades):
+            continue
+        entries.append(entry)
+    return entries
+
+
+def write_library_index(library_dir: str = default_PHASE_SPACE_DIR) -> str:
+    """Rewrites index.json of the library: key -> protocol, fan, blades, histories and size of every entry."""
+    index = {entry['key']: {name: entry[name] for name in ['protocol', 'fan', 'blades', 'histories', 'size', 'created']}
+             for entry in library_entries(library_dir)}
+    index_path = os.path.join(library_dir, LIBRARY_INDEX)
+    temporary = index_path + '.tmp' + str(os.getpid())
+    with open(temporary, 'w') as f:
+        json.dump(index, f, indent=2)
+    os.replace(temporary, index_path)
+    return index_path
+
+
+def ensure_phase_space(head_file: str, include_dir: str, topas_application_path: str,
+                       settings: PhaseSpaceSettings = PhaseSpaceSettings(),
+                       library_dir: str = default_PHASE_SPACE_DIR, priority: int = 0) -> Dict[str, object]:
+    """The library entry of a run's head, simulating the head only when the library does not have it yet.
+
+    Args:
+        head_file (str): Rendered headsourcecode.txt of the run.
+        include_dir (str): Folder with its includeFiles (ConvertedTopasFile.txt and the fan file), eg. the run folder.
+        topas_application_path (str): TOPAS executable.
+        settings (PhaseSpaceSettings): Head-only histories and protocol label.
+        library_dir (str): Phase space library.
+        priority (int): Queue priority of the head-only job.
+
+    Returns:
+        Dict[str, object]: The entry manifest ('key', 'protocol', 'fan', 'blades', 'histories', ...) with 'entry_dir'.
+
+    Raises:
+        RuntimeError: If the head-only run fails or writes no phase space.
+    """
+    head_only = render_head_only(head_file, settings.histories)
+    key = phase_space_key(head_only, include_dir, topas_application_path)
+    entry_dir = os.path.join(os.path.abspath(library_dir), key)
+    with _locks_guard:
+        lock = _build_locks.setdefault(key, threading.Lock())
+    with lock:
+        entry = _read_manifest(entry_dir)
+        if entry is not None:
+            return entry
+        staging_dir = entry_dir + '.tmp' + str(os.getpid())
+        shutil.rmtree(staging_dir, ignore_errors=True)
+        os.makedirs(staging_dir)
+        for name in head_only.include_files():
+            if os.path.isfile(os.path.join(include_dir, name)):
+                link_or_copy(os.path.join(include_dir, name), os.path.join(staging_dir, name))
+        head_only_file = os.path.join(staging_dir, HEAD_ONLY_FILE)
+        head_only.write(head_only_file)
+        start = time.time()
+        job = parameter_file_job(topas_application_path, head_only_file, staging_dir, priority)
+        exit_code = wait_for_jobs([get_scheduler().submit(job)])[0]
+        missing = [extension for extension in PHASE_SPACE_EXTENSIONS
+                   if not os.path.isfile(os.path.join(staging_dir, PHASE_SPACE_FILE + extension))]
+        if exit_code != 0 or missing:
+            raise RuntimeError('Head-only phase space run failed (exit code ' + str(exit_code) + '), see '
+                               + staging_dir)
+        size = sum(os.path.getsize(os.path.join(staging_dir, PHASE_SPACE_FILE + extension))
+                   for extension in PHASE_SPACE_EXTENSIONS)
+        with open(os.path.join(staging_dir, ENTRY_MANIFEST), 'w') as f:
+            json.dump({'key': key, 'protocol': settings.protocol, **head_settings(head_only),
+                       'histories': int(settings.histories), 'size': size, 'seconds': time.time() - start,
+                       'created': time.time(), 'head_file': os.path.abspath(head_file)}, f, indent=2)
+        try:
+            os.rename(staging_dir, entry_dir)
+        except OSError:
+            shutil.rmtree(staging_dir, ignore_errors=True) # stored by another process meanwhile
+        write_library_index(library_dir)
+        entry = _read_manifest(entry_dir)
+        if entry is None:
+            raise RuntimeError('Phase space library entry ' + entry_dir + ' is incomplete')
+        return entry
+
+
+def use_phase_space(parameter_file: str, entry: Dict[str, object], settings: PhaseSpaceSettings = PhaseSpaceSettings()
+                    ) -> None:
+    """Turns a run file into a stage 2 run: head excluded, So/beam reading the phase space of the library entry.
+
+    The phase space files are linked into the run file's folder, so the run stays self-contained.
+    """
+    rundatadir = os.path.dirname(os.path.abspath(parameter_file))
+    for extension in PHASE_SPACE_EXTENSIONS:
+        link_or_copy(os.path.join(entry['entry_dir'], PHASE_SPACE_FILE + extension),
+                     os.path.join(rundatadir, PHASE_SPACE_FILE + extension))
+    parameters = TopasParameterFile.from_file(parameter_file)
+    for include in FAN_FILES:
+        parameters.remove_include(include)
+    for component in HEAD_COMPONENTS:
+        _define(parameters, 'b:Ge/' + component + '/Include', '"False"')
+    for name in parameters.names():
+        if name.lower().startswith('so/beam/') and name.lower() != 'so/beam/numberofhistoriesinrun':
+            parameters.delete(name)
+    plane = 'Ge/' + PLANE_COMPONENT + '/'
+    for name, value in [('s:' + plane + 'Type', '"Group"'), ('s:' + plane + 'Parent', '"Rotation"'),
+                        ('d:' + plane + 'TransX', '0 mm'), ('d:' + plane + 'TransY', PLANE_POSITION),
+                        ('d:' + plane + 'TransZ', '0 mm'), ('d:' + plane + 'RotX', '0 deg'),
+                        ('d:' + plane + 'RotY', '0 deg'), ('d:' + plane + 'RotZ', '0 deg'),
+                        ('s:So/beam/Type', '"PhaseSpace"'), ('s:So/beam/Component', '"' + PLANE_COMPONENT + '"'),
+                        ('s:So/beam/PhaseSpaceFileName', '"' + PHASE_SPACE_FILE + '"'),
+                        ('i:So/beam/PhaseSpaceMultipleUse', str(int(settings.multiple_use))),
+                        ('b:So/beam/PhaseSpaceIncludeEmptyHistories', '"True"')]:
+        _define(parameters, name, value)
+    parameters.write(parameter_file)
+
+
+def prepare_phase_space_runs(parameter_files: List[str], head_file: str, rundatadir: str, topas_application_path: str,
+                             settings: PhaseSpaceSettings = PhaseSpaceSettings(),
+                             library_dir: str = default_PHASE_SPACE_DIR, priority: int = 0) -> Dict[str, object]:
+    """Finds or simulates the head of a run and turns its parameter files into phase space runs.
+
+    Writes phase_space_source.json into the run folder with the library entry and the recycling factor (histories of
+    the run / histories of the phase space, per parameter file).
+
+    Returns:
+        Dict[str, object]: The library entry.
+    """
+    entry = ensure_phase_space(head_file, rundatadir, topas_application_path, settings, library_dir, priority)
+    recycling = {}
+    for parameter_file in parameter_files:
+        use_phase_space(parameter_file, entry, settings)
+        histories, runs = histories_per_run_count(load_parameter_chain(parameter_file))
+        recycling[os.path.basename(parameter_file)] = histories * runs / entry['histories']
+    with open(os.path.join(rundatadir, RUN_SOURCE_RECORD), 'w') as f:
+        json.dump({'key': entry['key'], 'entry_dir': entry['entry_dir'], 'protocol': entry['protocol'],
+                   'fan': entry['fan'], 'blades': entry['blades'], 'phase_space_histories': entry['histories'],
+                   'multiple_use': settings.multiple_use, 'recycling': recycling}, f, indent=2)
+    return entry
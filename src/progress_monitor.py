@@ -0,0 +1,342 @@
+# Live progress of TOPAS runs. Every TOPAS child process is supervised with asyncio: stdout and stderr are streamed line
+# by line into a log file per job (and optionally echoed to the console), and the lines are parsed for progress.
+#   - Geant4 prints "### Run N starts." at the start of every run (one run per Tf/NumberOfSequentialTimes step)
+#   - Ts/ShowHistoryCountAtInterval prints "Begin History Number: N" (or "Begin History N") every interval within a
+#     run, worker threads prefix their lines with "G4WTn > " and Ts/ShowHistoryCountOnSingleLine separates the counts
+#     with carriage returns instead of new lines
+#   - Ts/ShowCPUTime and the Geant4 run summary print "User=..s Real=..s Sys=..s" at the end of a run
+# From these the ProgressMonitor keeps histories done, histories per second, percent complete and ETA for each job and
+# over all jobs, and publishes them to subscribers (GUI or CLI callbacks). A job whose count has not moved for
+# stall_seconds is flagged as stalled, so a stuck run does not look like a healthy one. Finished jobs are dropped after
+# their last publication, their histories are kept as totals and their final progress in a short history.
+import re
+import sys
+import time
+import asyncio
+import itertools
+import threading
+from collections import deque
+from typing import Callable, Dict, List, Optional
+
+_RUN_START = re.compile(r'###\s*Run\s+(?P<run>\d+)\s+start', re.IGNORECASE)
+# only the line of Ts/ShowHistoryCountAtInterval, parameter dumps and Geant4 messages mentioning events are not counts
+_HISTORY_COUNT = re.compile(r'^\s*(?:G4WT\d+\s*>\s*)?Begin History(?: Number)?\s*:?\s*(?P<count>\d+)\b', re.IGNORECASE)
+_EVENTS_PROCESSED = re.compile(r'Number of events processed\s*:\s*(?P<count>\d+)', re.IGNORECASE)
+_CPU_TIME = re.compile(r'User=\s*(?P<user>[\d.]+)\s*s.*?Real=\s*(?P<real>[\d.]+)\s*s(?:.*?Sys=\s*(?P<sys>[\d.]+)\s*s)?',
+                       re.IGNORECASE)
+STREAM_LIMIT = 2 ** 20 # longest line read from a TOPAS stream, in bytes
+
+
+def parse_history_count(line: str) -> Optional[int]:
+    """History number of a Ts/ShowHistoryCountAtInterval line, None for other lines. On a single line output the last
+    count before the carriage return is used."""
+    counts = [match for match in map(_HISTORY_COUNT.match, line.split('\r')) if match is not None]
+    return int(counts[-1].group('count')) if counts else None
+
+
+def parse_cpu_time(line: str) -> Optional[Dict[str, float]]:
+    """User, real (wall) and system seconds of a Ts/ShowCPUTime or run summary line, None for other lines."""
+    match = _CPU_TIME.search(line)
+    if match is None:
+        return None
+    return {key: float(value) for key, value in match.groupdict().items() if value is not None}
+
+
+class JobProgress:
+    """Progress of one TOPAS job.
+
+    Args:
+        name (str): Job label.
+        histories_per_run (int, optional): i:So/beam/NumberOfHistoriesInRun of the job.
+        runs (int): Tf/NumberOfSequentialTimes of the job.
+        log_file (str, optional): Log the job output is written to.
+    """
+
+    def __init__(self, name: str, histories_per_run: Optional[int] = None, runs: int = 1,
+                 log_file: Optional[str] = None):
+        self.name = name
+        self.histories_per_run = histories_per_run
+        self.runs = max(1, runs)
+        self.log_file = log_file
+        self.key = None
+        self.status = 'running'
+        self.exit_code = None
+        self.started = time.time()
+        self.updated = self.started
+        self.run = 0
+        self.run_histories = 0
+        self.first_run_started = None # end of the TOPAS initialisation (geometry, materials, physics)
+        self.cpu_time = {'user': 0., 'real': 0., 'sys': 0.}
+        self.rate = 0.
+        self._last_sample = (self.started, 0)
+
+    @property
+    def total_histories(self) -> Optional[int]:
+        return None if self.histories_per_run is None else self.histories_per_run * self.runs
+
+    @property
+    def histories(self) -> int:
+        if self.histories_per_run is None:
+            return self.run_histories
+        return self.run * self.histories_per_run + min(self.run_histories, self.histories_per_run)
+
+    @property
+    def average_rate(self) -> float:
+        elapsed = self.updated - self.started
+        return self.histories / elapsed if elapsed > 0 else 0.
+
+    @property
+    def percent(self) -> Optional[float]:
+        if self.status == 'finished':
+            return 100.
+        if not self.total_histories:
+            return None
+        return min(100., 100. * self.histories / self.total_histories)
+
+    @property
+    def eta(self) -> Optional[float]:
+        """Seconds left at the recent rate, None while unknown."""
+        if self.status == 'finished':
+            return 0.
+        rate = self.rate or self.average_rate
+        if not self.total_histories or rate <= 0:
+            return None
+        return max(0., (self.total_histories - self.histories) / rate)
+
+    @property
+    def initialisation_seconds(self) -> Optional[float]:
+        """Seconds from the process start to the first run start, None until the first run starts."""
+        return None if self.first_run_started is None else self.first_run_started - self.started
+
+    def stalled(self, stall_seconds: float, now: Optional[float] = None) -> bool:
+        return self.status == 'running' and (now or time.time()) - self.updated > stall_seconds
+
+    def update(self, line: str) -> bool:
+        """Parses one output line, returns True when the progress changed."""
+        run_start = _RUN_START.search(line)
+        if run_start is not None:
+            if self.first_run_started is None:
+                self.first_run_started = time.time()
+            run = int(run_start.group('run'))
+            if run <= self.run:
+                return False # worker threads report the same run start
+            self.run, self.run_histories = run, 0
+        else:
+            count = parse_history_count(line)
+            if count is None:
+                processed = _EVENTS_PROCESSED.search(line)
+                cpu_time = parse_cpu_time(line)
+                if processed is not None:
+                    self.run_histories = max(self.run_histories, int(processed.group('count')))
+                elif cpu_time is not None:
+                    for key, value in cpu_time.items():
+                        self.cpu_time[key] += value
+                    return True
+                else:
+                    return False
+            elif count <= self.run_histories:
+                return False # threads print their counts slightly out of order
+            else:
+                self.run_histories = count
+        now = time.time()
+        last_time, last_histories = self._last_sample
+        if now > last_time and self.histories > last_histories:
+            self.rate = (self.histories - last_histories) / (now - last_time)
+            self._last_sample = (now, self.histories)
+        self.updated = now
+        return True
+
+    def as_dict(self, stall_seconds: Optional[float] = None) -> Dict[str, object]:
+        status = 'stalled' if stall_seconds is not None and self.stalled(stall_seconds) else self.status
+        return {'name': self.name, 'status': status, 'exit_code': self.exit_code, 'histories': self.histories,
+                'total_histories': self.total_histories, 'run': self.run, 'runs': self.runs,
+                'histories_per_second': self.rate, 'average_histories_per_second': self.average_rate,
+                'percent': self.percent, 'eta_seconds': self.eta, 'cpu_time': dict(self.cpu_time),
+                'initialisation_seconds': self.initialisation_seconds,
+                'log_file': self.log_file}
+
+
+class ProgressMonitor:
+    """Collects the progress of all supervised jobs and publishes it to subscribers.
+
+    Subscribers are called with the progress dictionary of the job that changed and the aggregate over all jobs (see
+    aggregate), at most every publish_interval seconds per job and always when a job starts or ends. They are called
+    from the thread running the job, a GUI should hand the numbers to its own event loop (eg. window.write_event_value).
+    A job is dropped once its end is published, the aggregate keeps its histories and jobs() its final progress for
+    the last finished_jobs jobs.
+
+    Args:
+        publish_interval (float): Minimum seconds between two publications of the same job.
+        stall_seconds (float): A running job without progress for this long is reported as stalled.
+        finished_jobs (int): Number of finished jobs whose final progress jobs() still returns.
+    """
+
+    def __init__(self, publish_interval: float = 1., stall_seconds: float = 300., finished_jobs: int = 256):
+        self.publish_interval = publish_interval
+        self.stall_seconds = stall_seconds
+        self._jobs: Dict[int, JobProgress] = {}
+        self._finished = deque(maxlen=finished_jobs)
+        self._retired = {'jobs': 0, 'failed': 0, 'histories': 0, 'total_histories': 0}
+        self._published: Dict[int, float] = {}
+        self._keys = itertools.count()
+        self._subscribers: List[Callable[[Dict[str, object], Dict[str, object]], None]] = []
+        self._lock = threading.Lock()
+
+    def subscribe(self, callback: Callable[[Dict[str, object], Dict[str, object]], None]) -> Callable[[], None]:
+        """Adds a subscriber, returns the function that removes it again."""
+        with self._lock:
+            self._subscribers.append(callback)
+        return lambda: self._unsubscribe(callback)
+
+    def _unsubscribe(self, callback) -> None:
+        with self._lock:
+            if callback in self._subscribers:
+                self._subscribers.remove(callback)
+
+    def start_job(self, name: str, histories_per_run: Optional[int] = None, runs: int = 1,
+                  log_file: Optional[str] = None) -> JobProgress:
+        job = JobProgress(name, histories_per_run, runs, log_file)
+        with self._lock:
+            # jobs of different runs may share a name (eg. headsourcecode.txt)
+            job.key = next(self._keys)
+            self._jobs[job.key] = job
+        self._publish(job, force=True)
+        return job
+
+    def line(self, job: JobProgress, line: str) -> None:
+        if job.update(line):
+            self._publish(job)
+
+    def finish_job(self, job: JobProgress, exit_code: int) -> None:
+        job.exit_code = exit_code
+        job.status = 'finished' if exit_code == 0 else 'failed'
+        job.updated = time.time()
+        self._publish(job, force=True)
+        final = job.as_dict()
+        with self._lock:
+            if self._jobs.pop(job.key, None) is None:
+                return
+            self._published.pop(job.key, None)
+            self._finished.append(final)
+            self._retired['jobs'] += 1
+            self._retired['failed'] += final['status'] == 'failed'
+            if final['total_histories']:
+                self._retired['histories'] += final['histories']
+                self._retired['total_histories'] += final['total_histories']
+
+    def jobs(self) -> List[Dict[str, object]]:
+        """Progress of the recently finished jobs followed by the running ones."""
+        with self._lock:
+            finished, jobs = list(self._finished), list(self._jobs.values())
+        return finished + [job.as_dict(self.stall_seconds) for job in jobs]
+
+    def aggregate(self) -> Dict[str, object]:
+        """Histories, rate, percent and ETA over all running jobs and the jobs that ended."""
+        with self._lock:
+            jobs, retired = [job.as_dict(self.stall_seconds) for job in self._jobs.values()], dict(self._retired)
+        known = [job for job in jobs if job['total_histories']]
+        running = [job for job in jobs if job['status'] in ('running', 'stalled')]
+        histories = retired['histories'] + sum(job['histories'] for job in known)
+        total = retired['total_histories'] + sum(job['total_histories'] for job in known)
+        rate = sum(job['histories_per_second'] for job in running)
+        return {'jobs': retired['jobs'] + len(jobs), 'running': len(running),
+                'stalled': sum(1 for job in jobs if job['status'] == 'stalled'),
+                'failed': retired['failed'] + sum(1 for job in jobs if job['status'] == 'failed'),
+                'histories': histories, 'total_histories': total, 'histories_per_second': rate,
+                'percent': 100. * histories / total if total else None,
+                'eta_seconds': (total - histories) / rate if rate > 0 else None}
+
+    def _publish(self, job: JobProgress, force: bool = False) -> None:
+        now = time.time()
+        with self._lock:
+            if not force and now - self._published.get(job.key, 0.) < self.publish_interval:
+                return
+            self._published[job.key] = now
+            subscribers = list(self._subscribers)
+        if not subscribers:
+            return
+        job_progress, aggregate = job.as_dict(self.stall_seconds), self.aggregate()
+        for callback in subscribers:
+            callback(job_progress, aggregate)
+
+
+def format_progress(job: Dict[str, object], aggregate: Dict[str, object]) -> str:
+    """One line summary of a job and of all jobs, for consoles and logs."""
+    def eta(seconds):
+        return '--:--' if seconds is None else '%d:%02d' % divmod(int(seconds), 60)
+
+    def percent(value):
+        return '  ?%' if value is None else format(value, '5.1f') + '%'
+
+    return (job['name'] + ' ' + job['status'] + ' ' + percent(job['percent']) + ' '
+            + format(job['histories_per_second'], '.0f') + ' hist/s ETA ' + eta(job['eta_seconds'])
+            + ' | all ' + percent(aggregate['percent']) + ' ' + format(aggregate['histories_per_second'], '.0f')
+            + ' hist/s ETA ' + eta(aggregate['eta_seconds']))
+
+
+def print_progress(job: Dict[str, object], aggregate: Dict[str, object]) -> None:
+    """Subscriber printing format_progress to stderr."""
+    print(format_progress(job, aggregate), file=sys.stderr)
+
+
+async def _pump(stream: asyncio.StreamReader, log, monitor: ProgressMonitor, job: JobProgress, echo) -> None:
+    while True:
+        data = await stream.readline()
+        if not data:
+            break
+        line = data.decode(errors='replace')
+        log.write(line)
+        if echo is not None:
+            echo.write(line)
+        monitor.line(job, line)
+
+
+async def stream_process(command: List[str], cwd: str, log_file: str, monitor: ProgressMonitor, job: JobProgress,
+                         echo=None) -> int:
+    """Runs a process, streams stdout and stderr line by line into log_file and the monitor, returns the exit code."""
+    process = await asyncio.create_subprocess_exec(*command, cwd=cwd, stdout=asyncio.subprocess.PIPE,
+                                                   stderr=asyncio.subprocess.PIPE, limit=STREAM_LIMIT)
+    with open(log_file, 'a', buffering=1, errors='replace') as log:
+        await asyncio.gather(_pump(process.stdout, log, monitor, job, echo),
+                             _pump(process.stderr, log, monitor, job, echo))
+        return await process.wait()
+
+
+def run_supervised(command: List[str], cwd: str, log_file: str, name: str, histories_per_run: Optional[int] = None,
+                   runs: int = 1, monitor: Optional[ProgressMonitor] = None, echo=sys.stdout) -> int:
+    """Runs a TOPAS process under asyncio supervision in its own event loop (one per calling thread).
+
+    Args:
+        command (List[str]): Executable and arguments.
+        cwd (str): Working directory.
+        log_file (str): Log the stdout and stderr lines are appended to.
+        name (str): Job label in the monitor.
+        histories_per_run (int, optional): Histories per run, needed for percent and ETA.
+        runs (int): Number of runs (Tf/NumberOfSequentialTimes).
+        monitor (ProgressMonitor, optional): Defaults to the shared monitor.
+        echo (file, optional): Stream the lines are also written to, None to only log them.
+
+    Returns:
+        int: Exit code of the process.
+    """
+    monitor = monitor or get_monitor()
+    job = monitor.start_job(name, histories_per_run, runs, log_file)
+    exit_code = -1
+    try:
+        exit_code = asyncio.run(stream_process(command, cwd, log_file, monitor, job, echo))
+    finally:
+        monitor.finish_job(job, exit_code)
+    return exit_code
+
+
+_shared_monitor = None
+_shared_monitor_lock = threading.Lock()
+
+
+def get_monitor() -> ProgressMonitor:
+    """Monitor shared by every job started from this process, the GUI and CLI subscribe to it."""
+    global _shared_monitor
+    with _shared_monitor_lock:
+        if _shared_monitor is None:
+            _shared_monitor = ProgressMonitor()
+        return _shared_monitor
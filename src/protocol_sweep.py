@@ -0,0 +1,299 @@
+# Headless CTDI protocol sweeps. A sweep specification lists the protocols of imaging_modes_lookup, phantom sizes, fan
+# modes, start angles, couch on/off and history counts to simulate. The Cartesian product is expanded into
+# configurations, every configuration is rendered with the same editor() edits the GUI makes (into its own folder instead
+# of the shared tmp/), and configurations whose rendered files are identical are simulated once. The unique runs go
+# through runtime_handler.log_output with a bounded number running at once, their TOPAS jobs share the thread budget of
+# the JobScheduler, and each result is appended to one summary table as soon as its run is done. Configurations that
+# differ only in exposure (mAs) are one simulation for the run cache, they run after the first of them and are answered
+# from its cached outputs with their own calibration factor. Every configuration also gets the deterministic CTDIw
+# estimate of ctdi_estimator.py when it is rendered, so a dry run already screens the sweep.
+import os
+import csv
+import json
+import shutil
+import fnmatch
+import hashlib
+import itertools
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Dict, List, NamedTuple, Optional
+
+from src.defaultvalues import *
+from src.edits_handler import editor
+from src.Energyspectrum import generate_new_topas_beam_profile
+from src.imaging_modes_lookuptable import imaging_modes_lookup
+from src.run_cache import CALIBRATION_FILE
+from src.runtime_handler import log_output
+from src.ctdi_analysis import CTDI_QUANTITIES, RESULTS_JSON
+from src.ctdi_estimator import estimate_ctdi
+
+BOILERPLATE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'boilerplates')
+PHANTOM_TAGS = {'16 cm': 'ctdi16', '32 cm': 'ctdi32'}
+PHANTOM_FILES = {'16 cm': 'CTDIphantom_16.txt', '32 cm': 'CTDIphantom_32.txt'}
+# Files whose content defines a rendered configuration
+RENDERED_FILES = ['headsourcecode.txt', 'CTDIphantom_16.txt', 'CTDIphantom_32.txt', 'ConvertedTopasFile.txt',
+                  'head_calibration_factor.txt']
+SUMMARY_FILE = 'sweep_summary.csv'
+SUMMARY_COLUMNS = ['configuration', 'protocol', 'phantom', 'fan', 'start_angle', 'couch', 'histories', 'run_key',
+                   'duplicate_of', 'status', 'rundatadir'] + [
+                      column for tag in CTDI_QUANTITIES for column in ('CTDIw_' + tag, 'CTDIw_' + tag + '_uncertainty')] + [
+                      'CTDIw_' + tag + '_estimate' for tag in CTDI_QUANTITIES]
+
+
+class SweepConfiguration(NamedTuple):
+    protocol: str # key of imaging_modes_lookup, eg. 'CBCT Clockwise_Head'
+    phantom: str # '16 cm' or '32 cm'
+    fan: Optional[str] # 'Full Fan', 'Half Fan' or None for the protocol fan
+    start_angle: str # eg. '0 deg'
+    couch: bool
+    histories: str
+
+    def label(self) -> str:
+        return ' | '.join([self.protocol, self.phantom, self.fan or 'protocol fan', self.start_angle,
+                           'couch' if self.couch else 'no couch', self.histories + ' histories'])
+
+
+def protocol_names(patterns: List[str]) -> List[str]:
+    """Protocols of imaging_modes_lookup matching the given names or shell patterns ('all' or '*' for every protocol)."""
+    protocols = [name for name in imaging_modes_lookup if name != 'selection']
+    selected = []
+    for pattern in patterns:
+        matches = protocols if pattern == 'all' else fnmatch.filter(protocols, pattern)
+        if not matches:
+            raise KeyError('No protocol in imaging_modes_lookup matches ' + repr(pattern))
+        selected.extend(name for name in matches if name not in selected)
+    return selected
+
+
+def load_sweep_spec(filepath: str) -> Dict[str, object]:
+    """Reads a JSON sweep specification, missing entries take the GUI defaults.
+
+    Keys: protocols (names or patterns, default 'all'), phantoms ('16 cm'/'32 cm'), fans (null for the protocol fan),
+    start_angles, couch (true/false), histories and settings (GUI value keys overriding the defaults, eg. "-THREAD-").
+    """
+    with open(filepath, 'r') as f:
+        spec = json.load(f)
+    unknown = set(spec) - {'protocols', 'phantoms', 'fans', 'start_angles', 'couch', 'histories', 'settings'}
+    if unknown:
+        raise KeyError('Unknown sweep specification keys: ' + ', '.join(sorted(unknown)))
+    return spec
+
+
+def expand_sweep(spec: Dict[str, object]) -> List[SweepConfiguration]:
+    """Cartesian product of the specification, in a stable order."""
+    axes = [
+        protocol_names(spec.get('protocols', ['all'])),
+        spec.get('phantoms', ['16 cm']),
+        spec.get('fans', [None]),
+        spec.get('start_angles', [default_IMAGE_START_ANGLE]),
+        spec.get('couch', [True]),
+        [str(histories) for histories in spec.get('histories', [default_Histories])],
+    ]
+    for phantom in axes[1]:
+        if phantom not in PHANTOM_TAGS:
+            raise ValueError('Unknown phantom ' + repr(phantom) + ', use one of ' + ', '.join(PHANTOM_TAGS))
+    return [SweepConfiguration(*values) for values in itertools.product(*axes)]
+
+
+def configuration_values(configuration: SweepConfiguration, settings: Optional[Dict[str, object]] = None) -> Dict[str, object]:
+    """The GUI values dictionary editor() needs for a CTDI configuration, from the defaults and the protocol."""
+    (rotrate, voltage, exposure, fan, timeend, fieldx1, fieldx2, fieldy1, fieldy2,
+     bladex1, bladex2, bladey1, bladey2) = imaging_modes_lookup[configuration.protocol]
+    direction, image_mode = configuration.protocol.split('_', 1)
+    values = {
+        '-G4FOLDERNAME-': default_G4_Directory, '-TOPAS-': default_TOPAS_Directory,
+        '-SEED-': default_Seed, '-THREAD-': default_Threads, '-HIST-': configuration.histories,
+        '-TIMESEQ-': default_TIME_SEQ_TIME, '-TIMEVERBO-': default_TIME_VERBOSITY,
+        '-TIMELINEEND-': timeend, '-TIMEROTRATE-': rotrate, '-STARTANGLEROT-': configuration.start_angle,
+        '-DIRECTROT-': direction, '-IMAGEMODE-': image_mode, '-IMAGEVOLTAGE-': voltage, '-EXPOSURE-': exposure,
+        '-FAN-': configuration.fan or fan,
+        '-FIELD_X1-': fieldx1, '-FIELD_X2-': fieldx2, '-FIELD_Y1-': fieldy1, '-FIELD_Y2-': fieldy2,
+        '-BLADE_X1-': bladex1, '-BLADE_X2-': bladex2, '-BLADE_Y1-': bladey1, '-BLADE_Y2-': bladey2,
+        '-FUNCTION_CHECK-': 'CTDI validation', '-CTDI_GRAPHICS-': False, '-CTDI_PHANTOM-': configuration.phantom,
+        '-CTDI_BLADE_TOG-': False, '-CTDI_FIELD_X1-': default_FIELD_X1, '-CTDI_FIELD_X2-': default_FIELD_X2,
+        '-CTDI_FIELD_Y1-': default_FIELD_Y1, '-CTDI_FIELD_Y2-': default_FIELD_Y2,
+        '-COUCH_TOG-': configuration.couch, '-COUCHHLX-': default_COUCH_HLX, '-COUCHHLY-': default_COUCH_HLY,
+        '-COUCHHLZ-': default_COUCH_HLZ,
+        '-DTMZB-': default_DTM_Zbins, '-TLEZB-': default_TLE_Zbins, '-DTWZB-': default_DTW_Zbins,
+    }
+    values.update(settings or {})
+    return values
+
+
+def render_configuration(values: Dict[str, object], workdir: str) -> str:
+    """Renders the edited templates and beam files of one configuration into workdir/tmp, like the GUI does in tmp/.
+
+    Returns:
+        str: sha256 of the rendered files, equal keys mean identical simulations.
+    """
+    tmp_dir = os.path.join(workdir, 'tmp')
+    os.makedirs(tmp_dir, exist_ok=True)
+    head_file = os.path.join(tmp_dir, 'headsourcecode.txt')
+    phantom_file = os.path.join(tmp_dir, PHANTOM_FILES[values['-CTDI_PHANTOM-']])
+    shutil.copy(os.path.join(BOILERPLATE_DIR, 'headsourcecode_boilerplate.txt'), head_file)
+    shutil.copy(os.path.join(BOILERPLATE_DIR, 'TOPAS_includeFiles', PHANTOM_FILES[values['-CTDI_PHANTOM-']]), phantom_file)
+    editor(values, head_file, 'main')
+    editor(values, phantom_file, 'sub')
+    anode_voltage = float(values['-IMAGEVOLTAGE-'].split()[0])
+    exposure = float(values['-EXPOSURE-'].split()[0])
+    generate_new_topas_beam_profile(anode_voltage, exposure, values['-HIST-'], workdir)
+    return _rendered_digest(tmp_dir, RENDERED_FILES)
+
+
+def _rendered_digest(tmp_dir: str, names: List[str]) -> str:
+    digest = hashlib.sha256()
+    for name in names:
+        filepath = os.path.join(tmp_dir, name)
+        if os.path.isfile(filepath):
+            with open(filepath, 'rb') as f:
+                digest.update(name.encode() + b'\0' + f.read() + b'\0')
+    return digest.hexdigest()
+
+
+def estimate_configuration(values: Dict[str, object], workdir: str) -> Optional[Dict[str, object]]:
+    """Deterministic CTDI estimate of a configuration rendered into workdir (see ctdi_estimator.estimate_ctdi), None
+    when it can not be estimated."""
+    tmp_dir = os.path.join(workdir, 'tmp')
+    try:
+        return estimate_ctdi(os.path.join(tmp_dir, 'headsourcecode.txt'),
+                             os.path.join(tmp_dir, PHANTOM_FILES[values['-CTDI_PHANTOM-']]))
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+def simulation_key(workdir: str) -> str:
+    """sha256 of the rendered files of a configuration without its calibration factor, equal keys differ at most in
+    exposure and share one simulation through the run cache."""
+    return _rendered_digest(os.path.join(workdir, 'tmp'), [name for name in RENDERED_FILES if name != CALIBRATION_FILE])
+
+
+def run_configuration(configuration: SweepConfiguration, rundatadir: str, topas_application_path: str,
+                      settings: Optional[Dict[str, object]] = None, **run_options) -> str:
+    """Renders one configuration into rundatadir/tmp and simulates it in rundatadir, returns the run status.
+
+    run_options are passed to log_output (eg. shards or adaptive).
+    """
+    values = configuration_values(configuration, settings)
+    render_configuration(values, rundatadir)
+    tmp_dir = os.path.join(rundatadir, 'tmp')
+    return log_output(os.path.join(tmp_dir, 'headsourcecode.txt'), PHANTOM_TAGS[configuration.phantom],
+                      topas_application_path, values['-FAN-'], tmp_dir=tmp_dir, rundatadir=rundatadir, **run_options)
+
+
+def _summary_row(index: int, configuration: SweepConfiguration, run_key: str, duplicate_of, status: str,
+                 rundatadir: str, estimate: Optional[Dict[str, object]] = None) -> Dict[str, object]:
+    row = {'configuration': index, 'protocol': configuration.protocol, 'phantom': configuration.phantom,
+           'fan': configuration.fan or '', 'start_angle': configuration.start_angle, 'couch': configuration.couch,
+           'histories': configuration.histories, 'run_key': run_key[:12], 'status': status, 'rundatadir': rundatadir,
+           'duplicate_of': '' if duplicate_of is None else duplicate_of}
+    results_file = os.path.join(rundatadir, RESULTS_JSON)
+    if os.path.isfile(results_file):
+        with open(results_file, 'r') as f:
+            ctdi_w = json.load(f).get('ctdi_w', {})
+        for tag, values in ctdi_w.items():
+            row['CTDIw_' + tag] = values['value']
+            row['CTDIw_' + tag + '_uncertainty'] = values['uncertainty']
+    for tag, values in (estimate or {}).get('ctdi_w', {}).items():
+        row['CTDIw_' + tag + '_estimate'] = values['value']
+    return row
+
+
+def run_sweep(spec: Dict[str, object], sweep_dir: str, topas_application_path: str, concurrency: int = 2,
+              dry_run: bool = False, on_result=None) -> List[Dict[str, object]]:
+    """Expands, dedupes and runs a sweep, writing sweep_summary.csv in sweep_dir as the runs finish.
+
+    Args:
+        spec (Dict[str, object]): Sweep specification (see load_sweep_spec).
+        sweep_dir (str): Folder for the rendered configurations, the run folders and the summary.
+        topas_application_path (str): TOPAS executable.
+        concurrency (int): Runs in flight at once, their TOPAS jobs also share the JobScheduler thread budget.
+        dry_run (bool): Only render and dedupe, nothing is simulated.
+        on_result (callable, optional): Called with every summary row when it is written.
+
+    Returns:
+        List[Dict[str, object]]: Summary rows, one per configuration in sweep order.
+    """
+    configurations = expand_sweep(spec)
+    settings = spec.get('settings', {})
+    os.makedirs(sweep_dir, exist_ok=True)
+
+    # Render every configuration, identical renders share one run and exposure variants one simulation
+    runs: Dict[str, Dict[str, object]] = {}
+    run_keys = []
+    simulations: Dict[str, List[str]] = {}
+    for index, configuration in enumerate(configurations):
+        values = configuration_values(configuration, settings)
+        workdir = os.path.join(sweep_dir, 'configurations', format(index, '04d'))
+        run_key = render_configuration(values, workdir)
+        run_keys.append(run_key)
+        if run_key not in runs:
+            runs[run_key] = {'index': index, 'values': values, 'tmp_dir': os.path.join(workdir, 'tmp'),
+                             'rundatadir': os.path.join(sweep_dir, 'runs', run_key[:12]), 'status': 'pending',
+                             'estimate': estimate_configuration(values, workdir)}
+            simulations.setdefault(simulation_key(workdir), []).append(run_key)
+
+    summary_path = os.path.join(sweep_dir, SUMMARY_FILE)
+    rows: Dict[int, Dict[str, object]] = {}
+    summary_lock = threading.Lock()
+    with open(summary_path, 'w', newline='') as summary:
+        writer = csv.DictWriter(summary, fieldnames=SUMMARY_COLUMNS)
+        writer.writeheader()
+
+        def record(run_key: str) -> None:
+            run = runs[run_key]
+            with summary_lock:
+                for index, key in enumerate(run_keys):
+                    if key != run_key:
+                        continue
+                    duplicate_of = None if index == run['index'] else run['index']
+                    rows[index] = _summary_row(index, configurations[index], run_key, duplicate_of, run['status'],
+                                               run['rundatadir'], run['estimate'])
+                    writer.writerow(rows[index])
+                    if on_result is not None:
+                        on_result(rows[index])
+                summary.flush()
+
+        if dry_run:
+            for run_key, run in runs.items():
+                run['status'] = 'not run'
+                record(run_key)
+        else:
+            def simulate(run_key: str) -> str:
+                run = runs[run_key]
+                values = run['values']
+                head_file = os.path.join(run['tmp_dir'], 'headsourcecode.txt')
+                return log_output(head_file, PHANTOM_TAGS[values['-CTDI_PHANTOM-']], topas_application_path,
+                                  values['-FAN-'], tmp_dir=run['tmp_dir'], rundatadir=run['rundatadir'])
+
+            def simulate_exposures(simulation: List[str]) -> None:
+                # the exposure variants run after the first one, whose outputs they get from the run cache
+                for run_key in simulation:
+                    try:
+                        runs[run_key]['status'] = simulate(run_key)
+                    except Exception as error:
+                        runs[run_key]['status'] = 'Error encountered: ' + str(error)
+                    record(run_key)
+
+            with ThreadPoolExecutor(max_workers=max(1, concurrency)) as pool:
+                for future in as_completed([pool.submit(simulate_exposures, simulation)
+                                            for simulation in simulations.values()]):
+                    future.result()
+    return [rows[index] for index in sorted(rows)]
+
+
+def format_summary(rows: List[Dict[str, object]], scorer_tag: str = 'dtm') -> str:
+    """Plain text table of a sweep summary with CTDIw of one plug scorer and its estimate."""
+    lines = []
+    for row in rows:
+        value = row.get('CTDIw_' + scorer_tag)
+        ctdi = '-' if value in (None, '') else format(float(value), '.4g') + ' +- ' + format(
+            float(row['CTDIw_' + scorer_tag + '_uncertainty'] or 0), '.2g') + ' mGy'
+        estimate = row.get('CTDIw_' + scorer_tag + '_estimate')
+        if estimate not in (None, ''):
+            ctdi += ' (estimate ' + format(float(estimate), '.4g') + ' mGy)'
+        duplicate = ' (same as ' + str(row['duplicate_of']) + ')' if row['duplicate_of'] != '' else ''
+        lines.append(format(row['configuration'], '4d') + '  ' + row['protocol'].ljust(32) + row['phantom'].ljust(7)
+                     + (row['fan'] or 'protocol').ljust(10) + str(row['start_angle']).ljust(10)
+                     + ('couch' if row['couch'] else 'no couch').ljust(10) + str(row['histories']).ljust(10)
+                     + ctdi + duplicate)
+    return '\n'.join(lines)
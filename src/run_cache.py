@@ -0,0 +1,336 @@
+# Content-addressed cache of finished TOPAS runs. The key of a run is a sha256 over its resolved input set:
+#   - every file in the run folder before TOPAS starts (parameter files, copied includeFiles, spectrum, calibration)
+#   - every includeFile and file/folder referenced by a string parameter that is not a file of the run folder, eg. the
+#     DICOM series of Ge/Patient/DicomDirectory (folders outside the run are hashed by their listing of names, sizes
+#     and mtimes, folders inside it by content)
+#   - the TOPAS installation (executable or wrapper script) and the dataset folders of Ts/G4DataDirectory
+#   - run options that change the result (eg. shards, adaptive targets)
+# The seed and histories are parameters so they are part of the key. A finished run stores its outputs under
+# cache/runs/<key>/ as hardlinks (copies across filesystems), a later run with the same key gets the outputs linked into
+# its own run folder and a cached_run.json pointing at the original run instead of simulating again.
+# head_calibration_factor.txt is left out of the key: TOPAS never reads it, and it is the only input that changes with
+# the exposure (mAs). The TOPAS outputs are the uncalibrated dose of the run's histories, the factor (number of
+# particles / histories) makes them absolute, so a run differing from a cached run only in mAs is answered by the
+# cached outputs with its own factor. The entry records the factor it was simulated with, results that are already
+# calibrated (dose_results.csv/json) are not restored for another exposure but recomputed by the caller, and
+# cached_run.json records the exposure scale (ratio of the factors, i.e. of the mAs).
+# A run is only stored when every scorer of its parameter files wrote an output, and an entry is only used when its
+# manifest lists an output for every scorer. The cached TOPAS outputs are hardlinks shared with the run folders, so
+# they are made read-only; the files the pipeline rewrites (calibrated results, calibration file) are copied instead.
+import os
+import json
+import stat
+import time
+import shutil
+import hashlib
+from typing import Dict, Iterable, List, Optional
+
+from src.ctdi_analysis import RESULTS_CSV, RESULTS_JSON, read_calibration_factor
+from src.defaultvalues import default_RUN_CACHE_DIR, default_RUN_CACHE_MAX_AGE_DAYS, default_RUN_CACHE_MAX_BYTES
+from src.topas_outputs import scorer_output_files
+from src.topas_parameters import TopasParameterFile, find_scorers, load_parameter_chain
+
+CACHE_MANIFEST = 'cache_entry.json'
+CACHED_RUN_POINTER = 'cached_run.json'
+CALIBRATION_FILE = 'head_calibration_factor.txt'
+# outputs holding calibrated doses, only restored for the exposure they were computed with
+CALIBRATED_OUTPUTS = [RESULTS_CSV, RESULTS_JSON]
+# outputs written again by the pipeline after a run, stored and restored as copies so the cached file is never shared
+REWRITTEN_OUTPUTS = CALIBRATED_OUTPUTS + [CALIBRATION_FILE]
+_WRITE_BITS = stat.S_IWUSR | stat.S_IWGRP | stat.S_IWOTH
+_HASH_CHUNK = 2 ** 20
+
+
+def link_or_copy(source: str, destination: str) -> str:
+    """Hardlinks source to destination, copies when a link is not possible (eg. across filesystems).
+
+    Returns:
+        str: 'link' or 'copy'.
+    """
+    if os.path.lexists(destination):
+        os.remove(destination)
+    try:
+        os.link(source, destination)
+        return 'link'
+    except OSError:
+        shutil.copy2(source, destination)
+        return 'copy'
+
+
+def _cache_file(source: str, destination: str, name: str) -> None:
+    # shared TOPAS outputs are read-only so that opening one for writing fails instead of changing the cache entry
+    if name in REWRITTEN_OUTPUTS:
+        if os.path.lexists(destination):
+            os.remove(destination)
+        shutil.copyfile(source, destination)
+        return
+    link_or_copy(source, destination)
+    os.chmod(destination, stat.S_IMODE(os.stat(destination).st_mode) & ~_WRITE_BITS)
+
+
+def file_digest(filepath: str) -> str:
+    digest = hashlib.sha256()
+    with open(filepath, 'rb') as f:
+        for chunk in iter(lambda: f.read(_HASH_CHUNK), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+_inode_digests: Dict[tuple, str] = {}
+
+
+def inode_digest(filepath: str) -> str:
+    """file_digest remembered per inode and version, hardlinked files (eg. staged include files) are hashed once."""
+    stat = os.stat(filepath)
+    key = (stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns)
+    if key not in _inode_digests:
+        _inode_digests[key] = file_digest(filepath)
+    return _inode_digests[key]
+
+
+def _folder_listing(folder: str) -> str:
+    # Cheap identity of a large folder (eg. 600 CT slices on network storage): names, sizes and modification times
+    entries = []
+    for entry in sorted(os.scandir(folder), key=lambda entry: entry.name):
+        stat = entry.stat()
+        entries.append(entry.name + ':' + str(stat.st_size) + ':' + str(int(stat.st_mtime)))
+    return '\n'.join(entries)
+
+
+def topas_identity(topas_application_path: str) -> str:
+    """Identity of the TOPAS installation: the content of the executable or wrapper script and its real path."""
+    executable = shutil.which(topas_application_path.strip()) or topas_application_path.strip()
+    if not os.path.isfile(executable):
+        return 'missing:' + executable
+    real_path = os.path.realpath(executable)
+    return real_path + ':' + file_digest(real_path)
+
+
+def g4data_identity(g4_data_directory: Optional[str]) -> str:
+    """Geant4 data sets are versioned by their folder names (eg. G4EMLOW8.5), so the listing identifies the version."""
+    if not g4_data_directory or not os.path.isdir(g4_data_directory):
+        return 'missing:' + str(g4_data_directory)
+    return '\n'.join(sorted(os.listdir(g4_data_directory)))
+
+
+def _referenced_paths(parameter_file: str, seen: set) -> Iterable[str]:
+    """includeFiles (recursively) and existing paths of quoted string parameters referenced by a parameter file."""
+    if parameter_file in seen or not os.path.isfile(parameter_file):
+        return
+    seen.add(parameter_file)
+    directory = os.path.dirname(parameter_file)
+    parameters = TopasParameterFile.from_file(parameter_file)
+    for include in parameters.include_files():
+        include_path = os.path.normpath(os.path.join(directory, include))
+        yield include_path
+        yield from _referenced_paths(include_path, seen)
+    for name in parameters.names():
+        value = parameters.value(name)
+        if not value.startswith('"') or not value.endswith('"') or len(value) < 3:
+            continue
+        path = os.path.normpath(os.path.join(directory, value.strip('"')))
+        if os.path.exists(path) and path != os.path.normpath(directory):
+            yield path
+
+
+def run_cache_key(rundatadir: str, parameter_files: List[str], topas_application_path: str,
+                  run_options: Optional[Dict[str, object]] = None) -> str:
+    """sha256 over the resolved input set of a run folder except the calibration factor, see the module comment."""
+    rundatadir = os.path.abspath(rundatadir)
+    digest = hashlib.sha256()
+    for name in sorted(os.listdir(rundatadir)):
+        filepath = os.path.join(rundatadir, name)
+        if os.path.isfile(filepath) and name != CALIBRATION_FILE:
+            digest.update(('file:' + name + ':' + inode_digest(filepath) + '\n').encode())
+    digest.update(('run:' + ','.join(sorted(os.path.basename(path) for path in parameter_files)) + '\n').encode())
+
+    seen, referenced = set(), set()
+    for parameter_file in parameter_files:
+        for path in _referenced_paths(os.path.abspath(parameter_file), seen):
+            if not (os.path.isfile(path) and os.path.dirname(path) == rundatadir):
+                referenced.add(path)
+    for path in sorted(referenced):
+        if os.path.isfile(path):
+            identity = file_digest(path)
+        elif path.startswith(rundatadir + os.sep):
+            # folders written into the run (eg. a resampled CT series) are new files every run, hash their content
+            identity = '\n'.join(name + ':' + inode_digest(os.path.join(path, name)) for name in sorted(os.listdir(path))
+                                 if os.path.isfile(os.path.join(path, name)))
+        else:
+            identity = _folder_listing(path)
+        name = os.path.relpath(path, rundatadir) if path.startswith(rundatadir + os.sep) else path
+        digest.update(('external:' + name + ':' + hashlib.sha256(identity.encode()).hexdigest() + '\n').encode())
+
+    g4_data = None
+    for parameter_file in parameter_files:
+        g4_data = TopasParameterFile.from_file(parameter_file).value('Ts/G4DataDirectory') or g4_data
+    digest.update(('topas:' + topas_identity(topas_application_path) + '\n').encode())
+    digest.update(('g4data:' + g4data_identity(g4_data.strip('"') if g4_data else None) + '\n').encode())
+    digest.update(('options:' + json.dumps(run_options or {}, sort_keys=True, default=repr) + '\n').encode())
+    return digest.hexdigest()
+
+
+def calibration_factor(rundatadir: str) -> Optional[float]:
+    """Factor of the run's head_calibration_factor.txt, None when the run has none."""
+    filepath = os.path.join(rundatadir, CALIBRATION_FILE)
+    return read_calibration_factor(filepath) if os.path.isfile(filepath) else None
+
+
+def exposure_scale(entry: Dict[str, object], factor: Optional[float]) -> float:
+    """Ratio of a run's calibration factor to the one a cache entry was simulated with, 1 when either is unknown."""
+    if factor is None or not entry.get('calibration_factor'):
+        return 1.
+    scale = factor / entry['calibration_factor']
+    return 1. if abs(scale - 1.) < 1e-9 else scale
+
+
+def snapshot_files(rundatadir: str) -> Dict[str, float]:
+    """Files of a run folder with their modification times, to tell the outputs of a run from its inputs."""
+    return {entry.name: entry.stat().st_mtime for entry in os.scandir(rundatadir) if entry.is_file()}
+
+
+def scorer_outputs(rundatadir: str, parameter_files: List[str]) -> Dict[str, List[str]]:
+    """Output file name of every scorer of the parameter files -> the files it wrote in the run folder."""
+    outputs = {}
+    for parameter_file in parameter_files:
+        for settings in find_scorers(load_parameter_chain(parameter_file)).values():
+            outputs[settings['output_file']] = [os.path.basename(path) for path in
+                                                scorer_output_files(rundatadir, settings['output_file'])]
+    return outputs
+
+
+def lookup_run(key: str, cache_dir: str = default_RUN_CACHE_DIR) -> Optional[Dict[str, object]]:
+    """The cache entry of a key, or None. A hit refreshes the entry's last use time.
+
+    Entries with a missing output, or without an output for one of their scorers, are removed and not used.
+    """
+    entry_dir = os.path.join(cache_dir, key)
+    manifest_path = os.path.join(entry_dir, CACHE_MANIFEST)
+    if not os.path.isfile(manifest_path):
+        return None
+    with open(manifest_path, 'r') as f:
+        entry = json.load(f)
+    complete = 'scorers' in entry and all(entry['scorers'].values()) and all(
+        name in entry['outputs'] for files in entry['scorers'].values() for name in files)
+    if not complete or not all(os.path.isfile(os.path.join(entry_dir, name)) for name in entry['outputs']):
+        shutil.rmtree(entry_dir, ignore_errors=True) # damaged entry, or stored before scorer outputs were checked
+        return None
+    entry['last_used'] = time.time()
+    with open(manifest_path, 'w') as f:
+        json.dump(entry, f, indent=2)
+    entry['entry_dir'] = os.path.abspath(entry_dir)
+    return entry
+
+
+def store_run(key: str, rundatadir: str, inputs: Dict[str, float], cache_dir: str = default_RUN_CACHE_DIR,
+              max_age_days: Optional[float] = default_RUN_CACHE_MAX_AGE_DAYS,
+              max_bytes: Optional[int] = default_RUN_CACHE_MAX_BYTES,
+              factor: Optional[float] = None, parameter_files: Optional[List[str]] = None) -> Optional[str]:
+    """Stores the outputs of a finished run (files that are new or changed since the inputs snapshot).
+
+    The entry is assembled in a temporary folder and renamed into place, when another process stored the same key
+    first its entry is kept. The cache is evicted afterwards. factor is the calibration factor of the run before it
+    ran (adaptive runs rewrite it), later runs with another exposure are scaled against it. A run with a scorer of
+    parameter_files that wrote no new output is not stored, even when TOPAS exited without error.
+
+    Returns:
+        Optional[str]: The entry folder, None when the key was already stored or the run is missing outputs.
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    entry_dir = os.path.join(cache_dir, key)
+    if os.path.isdir(entry_dir):
+        return None
+    outputs = [name for name, mtime in snapshot_files(rundatadir).items() if inputs.get(name) != mtime]
+    scorers = scorer_outputs(rundatadir, parameter_files or [])
+    if not all(files and all(name in outputs for name in files) for files in scorers.values()):
+        return None
+    staging_dir = entry_dir + '.tmp' + str(os.getpid())
+    os.makedirs(staging_dir, exist_ok=True)
+    size = 0
+    for name in outputs:
+        _cache_file(os.path.join(rundatadir, name), os.path.join(staging_dir, name), name)
+        size += os.path.getsize(os.path.join(staging_dir, name))
+    now = time.time()
+    with open(os.path.join(staging_dir, CACHE_MANIFEST), 'w') as f:
+        json.dump({'key': key, 'rundatadir': os.path.abspath(rundatadir), 'outputs': sorted(outputs),
+                   'scorers': scorers, 'calibration_factor': factor, 'size': size, 'created': now, 'last_used': now}, f, indent=2)
+    try:
+        os.rename(staging_dir, entry_dir)
+    except OSError:
+        shutil.rmtree(staging_dir, ignore_errors=True)
+        return None
+    evict_run_cache(cache_dir, max_age_days, max_bytes)
+    return entry_dir
+
+
+def _rescale_calibration_file(cached_filepath: str, rundatadir: str, scale: float) -> None:
+    # the cached file was rewritten by the run (adaptive histories), its factor is carried over at the new exposure
+    filepath = os.path.join(rundatadir, CALIBRATION_FILE)
+    cached_factor = read_calibration_factor(cached_filepath)
+    with open(filepath, 'r') as f:
+        lines = f.readlines()
+    lines[0] = '%d\n' % (cached_factor * scale)
+    lines.append('\nCached run: factor ' + format(cached_factor, '.0f') + ' of the cached run scaled by '
+                 + format(scale, '.6g') + ' for the exposure\n')
+    with open(filepath, 'w') as f:
+        f.writelines(lines)
+
+
+def restore_run(entry: Dict[str, object], rundatadir: str, scale: float = 1.) -> List[str]:
+    """Links the cached outputs into a run folder and writes cached_run.json pointing at the original run. The TOPAS
+    outputs are read-only links, the outputs the pipeline rewrites are copies.
+
+    With an exposure scale other than 1 (see exposure_scale) the calibrated outputs are left out, the caller recomputes
+    them with the run's own calibration factor.
+
+    Returns:
+        List[str]: The restored outputs.
+    """
+    restored = []
+    rescaled = scale != 1.
+    for name in entry['outputs']:
+        if rescaled and name in CALIBRATED_OUTPUTS:
+            continue
+        if rescaled and name == CALIBRATION_FILE:
+            _rescale_calibration_file(os.path.join(entry['entry_dir'], name), rundatadir, scale)
+            continue
+        _cache_file(os.path.join(entry['entry_dir'], name), os.path.join(rundatadir, name), name)
+        restored.append(name)
+    with open(os.path.join(rundatadir, CACHED_RUN_POINTER), 'w') as f:
+        json.dump({'key': entry['key'], 'original_rundatadir': entry['rundatadir'], 'cache_entry': entry['entry_dir'],
+                   'created': entry['created'], 'outputs': restored, 'exposure_scale': scale,
+                   'original_calibration_factor': entry.get('calibration_factor'),
+                   'calibration_factor': calibration_factor(rundatadir)}, f, indent=2)
+    return restored
+
+
+def evict_run_cache(cache_dir: str = default_RUN_CACHE_DIR, max_age_days: Optional[float] = default_RUN_CACHE_MAX_AGE_DAYS,
+                    max_bytes: Optional[int] = default_RUN_CACHE_MAX_BYTES) -> List[str]:
+    """Removes entries not used for max_age_days, then the least recently used entries until the cache fits max_bytes.
+
+    Sizes count the cached files, run folders linking the same files keep their copies when an entry is removed.
+
+    Returns:
+        List[str]: Keys of the removed entries.
+    """
+    if not os.path.isdir(cache_dir):
+        return []
+    entries = []
+    for key in os.listdir(cache_dir):
+        manifest_path = os.path.join(cache_dir, key, CACHE_MANIFEST)
+        if os.path.isfile(manifest_path):
+            with open(manifest_path, 'r') as f:
+                entries.append(json.load(f))
+    entries.sort(key=lambda entry: entry['last_used'])
+    removed = []
+    now = time.time()
+    total = sum(entry['size'] for entry in entries)
+    for entry in entries:
+        too_old = max_age_days is not None and now - entry['last_used'] > max_age_days * 86400
+        too_large = max_bytes is not None and total > max_bytes
+        if not (too_old or too_large):
+            continue
+        shutil.rmtree(os.path.join(cache_dir, entry['key']), ignore_errors=True)
+        total -= entry['size']
+        removed.append(entry['key'])
+    return removed
@@ -1,15 +1,37 @@
 # This script is used to handle all the initialisation and running of the simulations. It will set up a date and timestamped folder in /runfolder and copy all the relevant files from /tmp and /src over into it
 # The duplication of the files are intended, this will allow for users to rerun the script as it was in case of downstream changes in the future or for reevaluation. 
-# Future improvments would be to add in an logging function that logs the console output at runtime. This would allow for easier debugging and integrate a progress bar that watches the number of histories left to completion. 
+# Static include files are hardlinked from one checksummed copy instead of being copied into every run folder (include_staging.py).
+# The console output of every TOPAS run is logged to <parameter file name>.log in the run folder and its progress (histories/s, percent, ETA) is published by progress_monitor.py. 
+# A run whose resolved inputs match an earlier run is not simulated again, the outputs of the earlier run are linked into the new folder from the run cache (run_cache.py).
+# The exposure (mAs) is not part of the inputs, a run differing only in mAs reuses the cached outputs with its own calibration factor.
+# CTDI runs also get ctdi_estimate.json, the deterministic primary dose estimate of ctdi_estimator.py next to the Monte Carlo result.
+# A history allocation replaces the static NbParticlesInTime.txt with a generated table and runs its segments as weighted sub-arcs (history_allocation.py).
 import os
+import re
 from datetime import datetime
 import shutil
-import subprocess
-import multiprocessing as mp
-from typing import List
+import shlex
+from typing import Dict, List, Optional
+
+from src.job_scheduler import TopasJob, get_scheduler, parameter_file_job, wait_for_jobs
+from src.progress_monitor import run_supervised
+from src.sharding import run_sharded
+from src.arc_splitting import run_arcs
+from src.ctdi_analysis import process_ctdi_run
+from src.ctdi_estimator import estimate_ctdi, write_estimate
+from src.adaptive_runs import AdaptiveTarget, CtdiwMetric, DicomRoiMetric, run_adaptive
+from src.include_staging import stage_static_files
+from src.history_allocation import HistoryAllocation, HistoryAllocationSettings, prepare_history_allocation
+from src.ct_resampling import CtResampling, prepare_resampled_patient
+from src.material_compaction import MaterialCompaction, compact_patient_materials, record_initialisation_time
+from src.phase_space import PhaseSpaceSettings, prepare_phase_space_runs
+from src.topas_parameters import TopasParameterFile
+from src.run_cache import (calibration_factor, exposure_scale, lookup_run, restore_run, run_cache_key, snapshot_files,
+                           store_run)
 
 def run_topas(x1: List[List[str]]) -> None:
-    """This function exist so that a nested list of commands can be parsed and scheduled to be processed asyncro
+    """This function exist so that a nested list of commands can be parsed and ran one at a time. Jobs started by
+    log_output go through the thread budgeted JobScheduler instead, both stream their output through progress_monitor.
 
     Args:
         x1 (List[List[str]]): A nested list of commands to be ran with the topas executable. The outer list contains the commands and the inner list contains the arguments to the command.
@@ -17,116 +39,394 @@ def run_topas(x1: List[List[str]]) -> None:
     Returns:
         None
     """
-    command = x1[0][0]
+    command = shlex.split(x1[0][0])
     rundatadir = x1[1][0]
-    subprocess.run("cd " + rundatadir, shell=True)
-    # result = subprocess.run(command, cwd= rundatadir, shell =True, capture_output=True, text=True)
-    # print(result.stdout) #Gives console output as as text chunk, for logging 
-    result = subprocess.run(command, cwd= rundatadir, shell =True) #for instant console output 
-    print('ran')
+    name = os.path.basename(command[-1])
+    # console output is echoed and logged next to the outputs, progress goes to the shared ProgressMonitor
+    run_supervised(command, rundatadir, os.path.join(rundatadir, os.path.splitext(name)[0] + '.log'), name)
+
+
+def topas_job(topas_application_path: str, input_file: str, rundatadir: str, priority: int = 0) -> TopasJob:
+    """Builds the scheduler job for one TOPAS parameter file, the thread request is read from i:Ts/NumberOfThreads."""
+    return parameter_file_job(topas_application_path, input_file, rundatadir, priority)
+
+
+CTDI_PLUG_POSITIONS = ['ChamberPlugCentre', 'ChamberPlugTop', 'ChamberPlugBottom', 'ChamberPlugLeft', 'ChamberPlugRight']
+PLUG_PLACEHOLDER = '@@PLACEHOLDER@@'
+
+
+def render_plug_files(head_text: str, phantom_text: str, plugs_position: List[str] = CTDI_PLUG_POSITIONS) -> Dict[str, str]:
+    """Renders the parameter file of every plug position from the headsource and phantom templates in memory.
+
+    The combined template is split at the placeholders and the material line of each plug is located once, every
+    position file is then a join of the same segments with the plug name and its plug material set to Air.
+
+    Args:
+        head_text (str): Content of the edited headsourcecode.txt.
+        phantom_text (str): Content of the edited CTDI phantom file.
+        plugs_position (List[str]): Names of the plug components to render a file for.
+
+    Returns:
+        Dict[str, str]: Plug position to file content.
+
+    Raises:
+        ValueError: If the phantom has no PMMA material line for one of the plugs.
+    """
+    # The phantom file is combined into headsourcecode as TOPAS throws error due to some unknown default chaining issue. 
+    segments = (head_text + phantom_text).split(PLUG_PLACEHOLDER)
+    material_offsets = {}
+    for position in plugs_position:
+        pattern = re.compile(r's:Ge/' + re.escape(position) + r'/Material\s*=\s*"PMMA"', re.IGNORECASE)
+        for segment_index, segment in enumerate(segments):
+            match = pattern.search(segment)
+            if match is not None:
+                material_offsets[position] = (segment_index, match.start(), match.end())
+                break
+        else:
+            raise ValueError('No PMMA material line found for ' + position + ' in the phantom file')
+
+    rendered = {}
+    for position in plugs_position:
+        segment_index, start, end = material_offsets[position]
+        position_segments = list(segments)
+        segment = segments[segment_index]
+        position_segments[segment_index] = segment[:start] + 's:Ge/' + position + '/Material="Air"' + segment[end:]
+        rendered[position] = position.join(position_segments)
+    return rendered
+
+
+CTDI_COMBINED_FILE = 'ChamberPlugs'
+PLUG_SCORER_PREFIX = 'Sc/ChamberPlugDose_'
+
+
+def render_combined_plug_file(head_text: str, phantom_text: str, plugs_position: List[str] = CTDI_PLUG_POSITIONS,
+                              plug_material: str = 'Air', cpu_count: Optional[int] = None) -> str:
+    """Renders one parameter file scoring every plug position, for a single TOPAS process instead of one per plug.
+
+    The plugs are the layered parallel worlds of sv:Ph/Default/LayeredMassGeometryWorlds, so all of them are already in
+    the geometry of every position file. Here every plug gets plug_material and the 3 plug scorers are repeated per
+    position (Sc/<position>Dose_tle, ...) with the outputs of the position files (<position>_tle, ...), so
+    ctdi_analysis reads the run as before. The physics is approximated: in the position files only the scored plug is
+    Air and the other four are PMMA. With 'Air' the other four holes are also empty, with 'PMMA' the scored plug is
+    PMMA and the scorers convert to air (dtm) and water (dtw) doses as before, and the track length estimator uses
+    Muen.dat on the fluence in PMMA. The threads of the file are multiplied by the number of plugs (up to the CPU
+    count), so the single process gets the thread budget of the position files.
 
-def plugsgenerator(phantomsize: str, rundatadir: str, topas_application_path: str) -> List[List[List[str]]]:
+    Args:
+        head_text (str): Content of the edited headsourcecode.txt.
+        phantom_text (str): Content of the edited CTDI phantom file.
+        plugs_position (List[str]): Names of the plug components to score.
+        plug_material (str): Material of all plugs, 'Air' or 'PMMA'.
+        cpu_count (int, optional): Cap of the thread count, defaults to the number of CPUs.
+
+    Returns:
+        str: The file content.
+
+    Raises:
+        ValueError: If the phantom has no PMMA material line for one of the plugs.
+    """
+    text = head_text + phantom_text
+    for position in plugs_position:
+        pattern = re.compile(r's:Ge/' + re.escape(position) + r'/Material\s*=\s*"PMMA"', re.IGNORECASE)
+        if pattern.search(text) is None:
+            raise ValueError('No PMMA material line found for ' + position + ' in the phantom file')
+        text = pattern.sub('s:Ge/' + position + '/Material="' + plug_material + '"', text, count=1)
+    lines = text.splitlines(keepends=True)
+    scorer_lines = [line for line in lines if PLUG_SCORER_PREFIX in line]
+    parameters = TopasParameterFile([line for line in lines if PLUG_SCORER_PREFIX not in line])
+    threads = int(parameters.value('Ts/NumberOfThreads', '1').split()[0])
+    if threads > 0:
+        threads = min(threads * len(plugs_position), cpu_count or os.cpu_count() or 1)
+        parameters.set('i:Ts/NumberOfThreads', str(threads), 'i')
+    rendered = parameters.to_text()
+    if not rendered.endswith('\n'):
+        rendered += '\n'
+    for position in plugs_position:
+        rendered += '\n#Scorers of ' + position + '\n' + ''.join(
+            line.replace(PLUG_SCORER_PREFIX, 'Sc/' + position + 'Dose_').replace(PLUG_PLACEHOLDER, position)
+            for line in scorer_lines)
+    return rendered
+
+
+def plugsgenerator(
+        phantomsize: str,
+        rundatadir: str,
+        topas_application_path: str,
+        plugs_position: List[str] = CTDI_PLUG_POSITIONS,
+        phantom_file: Optional[str] = None,
+        priority: int = 0,
+        tmp_dir: Optional[str] = None,
+        single_process: Optional[str] = None
+    ) -> List[TopasJob]:
         '''
         This function is only used for CTDI to generate 5 files to simulation the placement of a detector on the 5 possible plug positions.
-        Returns a nested list of commands to be ran to multi process all 5 files together.
+        Both templates are read once and the position files are written straight into rundatadir from memory.
+        phantom_file overrides the phantom picked from phantomsize, plugs_position the set of plugs a file is made for.
+        tmp_dir is the folder holding the edited templates, defaults to tmp/ in the working directory.
+        single_process ('Air' or 'PMMA') writes one ChamberPlugs.txt scoring all positions with every plug of that
+        material instead, see render_combined_plug_file.
+        Returns the scheduler jobs to run all 5 files together.
         '''
-        path = os.getcwd()
-        plugs_position = ['ChamberPlugCentre', 'ChamberPlugTop', 'ChamberPlugBottom', 'ChamberPlugLeft', 'ChamberPlugRight']
-        commands = []
-        for position in plugs_position:
-                file1 = open(path + '/tmp/headsourcecode.txt', 'r')
-                if phantomsize == 'ctdi16':
-                        file2 = open(path +'/tmp/CTDIphantom_16.txt', 'r')
-                if phantomsize == 'ctdi32':
-                        file2 = open(path +'/tmp/CTDIphantom_32.txt', 'r')
+        tmp_dir = tmp_dir or os.path.join(os.getcwd(), 'tmp')
+        if phantom_file is None:
+                phantom_file = os.path.join(tmp_dir, 'CTDIphantom_16.txt' if phantomsize == 'ctdi16' else 'CTDIphantom_32.txt')
+        with open(os.path.join(tmp_dir, 'headsourcecode.txt'), 'r') as file1:
                 content1 = file1.read()
-                file1.close()
+        with open(phantom_file, 'r') as file2:
                 content2 = file2.read()
-                file2.close()
-                combinedtext= open(path +'/tmp/plugsourcecode.txt', 'w')
-                combinedtext.write(content1 +content2)
-                # The above chunk combines the CTDI phantom file into headsourcecode as TOPAS throws error due to some unknown default chaining issue. 
+
+        if single_process is not None:
+                combinedfile = os.path.join(rundatadir, CTDI_COMBINED_FILE + '.txt')
+                with open(combinedfile, 'w') as file:
+                        file.write(render_combined_plug_file(content1, content2, plugs_position, single_process))
+                return [topas_job(topas_application_path, combinedfile, rundatadir, priority)]
+
+        jobs = []
+        for position, file_data in render_plug_files(content1, content2, plugs_position).items():
                 positionfile = rundatadir + '/'+ position + '.txt'
-                shutil.copy(path + '/tmp/plugsourcecode.txt', positionfile)
-                search_text1 = '@@PLACEHOLDER@@'
-                replace_text1 = position
-                search_text2 = 's:Ge/'+ position + '/Material="PMMA"'
-                replace_text2 = 's:Ge/'+ position + '/Material="Air"'
-                with open(path +'/tmp/plugsourcecode.txt', 'r') as file:
-                        file_data = file.read()
-                        file_data = file_data.replace(search_text1, replace_text1)
-                        file_data = file_data.replace(search_text2, replace_text2)
                 with open(positionfile, 'w') as file:
                         file.write(file_data)
-                commands.append([[topas_application_path + ' ' + rundatadir + '/'+ position + '.txt'], [rundatadir]])        
-        return commands
+                jobs.append(topas_job(topas_application_path, positionfile, rundatadir, priority))
+        return jobs
 
 def log_output(
         input_file_path: str,
         tag: str,
         topas_application_path: str,
-        fan_tag: str
+        fan_tag: str,
+        priority: int = 0,
+        shards: int = 1,
+        adaptive: Optional[AdaptiveTarget] = None,
+        tmp_dir: Optional[str] = None,
+        rundatadir: Optional[str] = None,
+        use_cache: bool = True,
+        ct_resampling: Optional[CtResampling] = None,
+        material_compaction: Optional[MaterialCompaction] = None,
+        phase_space: Optional[PhaseSpaceSettings] = None,
+        ctdi_single_process: Optional[str] = None,
+        arcs: int = 1,
+        history_allocation: Optional[HistoryAllocationSettings] = None
     ) -> str:
-    """This function runs a TOPAS simulation using multiprocessing.
+    """This function runs a TOPAS simulation through the shared thread budgeted JobScheduler.
 
     Args:
         input_file_path (str): The file path of the input file.
         tag (str): A tag that determines which type of simulation is to be run.
         topas_application_path (str): The file path of the TOPAS executable.
         fan_tag (str): A tag that determines which fan type is to be used.
+        priority (int): Queue priority of the jobs of this run, lower numbers start first.
+        shards (int): Splits the histories of every TOPAS file into this many concurrent runs with their own seeds,
+            the scorer outputs are merged back under their original names (see sharding.run_sharded).
+        adaptive (AdaptiveTarget, optional): Runs batches until the relative standard error of CTDIw (CTDI) or of the
+            mean dose in the high dose region (DICOM) reaches the target, see adaptive_runs.run_adaptive.
+        tmp_dir (str, optional): Folder with the edited templates and beam files, defaults to tmp/ in the working
+            directory. Batch runs render every configuration into its own folder.
+        rundatadir (str, optional): Run folder, defaults to a new timestamped folder in runfolder/.
+        use_cache (bool): Links the outputs of an earlier run with identical inputs instead of simulating, and stores
+            the outputs of a successful run for later (see run_cache.py).
+        ct_resampling (CtResampling, optional): DICOM runs simulate the CT series resampled to this voxel size, written
+            into the run folder (see ct_resampling.py).
+        material_compaction (MaterialCompaction, optional): DICOM runs map the HU values of the CT onto fewer
+            materials and include a compacted conversion table, see material_compaction.py.
+        phase_space (PhaseSpaceSettings, optional): Runs start from the phase space below the bowtie of the run's head,
+            taken from the phase space library or simulated once into it (see phase_space.py).
+        ctdi_single_process (str, optional): CTDI runs score all plug positions in one TOPAS process, every plug made
+            of this material ('Air' or 'PMMA'), instead of one process per position (see render_combined_plug_file).
+            An approximation of the per-position layout, the material is recorded in dose_results.json and keys the
+            run cache.
+        arcs (int): Splits the sequential times of every TOPAS file into this many contiguous sub-arcs that run as
+            concurrent jobs with their own seeds, the outputs are merged back under their original names (see
+            arc_splitting.run_arcs). Sub-arcs can be sharded, not run adaptively.
+        history_allocation (HistoryAllocationSettings, optional): Spreads the histories over the sequential times
+            (uniform, tube current modulated or variance optimal), writes NbParticlesInTime.txt and its weights and runs
+            the segments as weighted sub-arcs (see history_allocation.py). Can be sharded, not combined with arcs,
+            adaptive runs or phase spaces.
 
     Returns:
         str: A string indicating the status of the simulation.
     """
-    rundatadir = os.path.join(
-        os.getcwd(), "runfolder", datetime.now().strftime('%Y-%m-%d_%H-%M-%S'))
+    if arcs > 1 and adaptive is not None:
+        return 'Error encountered: sub-arcs can not be run adaptively'
+    if history_allocation is not None and (arcs > 1 or adaptive is not None or phase_space is not None):
+        return 'Error encountered: history allocations run their own sub-arcs, not with arcs, adaptive runs or phase spaces'
+    path = os.getcwd()
+    tmp_dir = tmp_dir or os.path.join(path, 'tmp')
+    rundatadir = rundatadir or os.path.join(
+        path, "runfolder", datetime.now().strftime('%Y-%m-%d_%H-%M-%S'))
     os.makedirs(rundatadir, exist_ok=True)
     shutil.copy(input_file_path, rundatadir)
-    path = os.getcwd()
 
     def copy_common_files():
-        common_files = [
-            'Muen.dat',
-            'NbParticlesInTime.txt',
-            'ConvertedTopasFile.txt',
-            'head_calibration_factor.txt'
-        ]
-        for file in common_files:
-            shutil.copy(os.path.join(path, 'src/boilerplates/TOPAS_includeFiles', file), rundatadir)
+        # static include files are hardlinked from the include store, see include_staging.py
+        # a history allocation writes its own NbParticlesInTime.txt
+        stage_static_files(['Muen.dat'] if history_allocation is not None else ['Muen.dat', 'NbParticlesInTime.txt'],
+                           rundatadir)
+        # beam spectrum and calibration are generated per run by Energyspectrum.generate_new_topas_beam_profile
+        for file in ['ConvertedTopasFile.txt', 'head_calibration_factor.txt']:
+            shutil.copy(os.path.join(tmp_dir, file), rundatadir)
 
     def copy_fan_file():
-        fan_file = 'fullfan.txt' if fan_tag == 'Full Fan' else 'halffan.txt'
-        shutil.copy(os.path.join(path, 'src/boilerplates/TOPAS_includeFiles', fan_file), rundatadir)
+        stage_static_files(['fullfan.txt' if fan_tag == 'Full Fan' else 'halffan.txt'], rundatadir)
 
-    pool_size = mp.cpu_count() - 1
+    scheduler = get_scheduler()
 
     if tag == 'dicom':
-        shutil.copy(os.path.join(path, 'src/boilerplates/TOPAS_includeFiles', 'HUtoMaterialSchneider.txt'), rundatadir)
+        stage_static_files(['HUtoMaterialSchneider.txt'], rundatadir)
+        copy_common_files()
         copy_fan_file()
-        shutil.copy(os.path.join(path, 'tmp', 'headsourcecode.txt'), rundatadir)
-        shutil.copy(os.path.join(path, 'tmp', 'patientDICOM.txt'), rundatadir)
-        command = [f"{topas_application_path} {rundatadir}/headsourcecode.txt"]
-        with mp.Pool(pool_size) as pool:
-            pool.map_async(run_topas, [(command, [rundatadir])])
-            pool.close()
-            pool.join()
-        run_status = "DICOM simulation completed"
+        shutil.copy(os.path.join(tmp_dir, 'headsourcecode.txt'), rundatadir)
+        shutil.copy(os.path.join(tmp_dir, 'patientDICOM.txt'), rundatadir)
+        if ct_resampling is not None:
+            patient_file = os.path.join(rundatadir, 'patientDICOM.txt')
+            dicom_directory = TopasParameterFile.from_file(patient_file).value('Ge/Patient/DicomDirectory').strip('"')
+            prepare_resampled_patient(dicom_directory, rundatadir, ct_resampling, patient_file)
+        if material_compaction is not None:
+            compact_patient_materials(rundatadir, material_compaction)
+        job = topas_job(topas_application_path, os.path.join(rundatadir, 'headsourcecode.txt'), rundatadir, priority)
+        allocation = _allocate_histories(history_allocation, tmp_dir, rundatadir,
+                                         patient_file=os.path.join(rundatadir, 'patientDICOM.txt'))
+        if isinstance(allocation, str):
+            return allocation
+        if phase_space is not None:
+            error = _use_phase_space([job], tmp_dir, rundatadir, topas_application_path, phase_space, priority)
+            if error:
+                return error
+        cache = _cache_lookup(rundatadir, [job], topas_application_path, shards, adaptive, use_cache, arcs)
+        if cache['hit']:
+            exit_codes = [0]
+        else:
+            exit_codes = _run_jobs(scheduler, [job], topas_application_path, priority, shards, adaptive, DicomRoiMetric(),
+                                   arcs, allocation)
+            if material_compaction is not None:
+                record_initialisation_time(rundatadir)
+        run_status = _run_status("DICOM simulation completed", exit_codes)
 
     elif tag in ['ctdi16', 'ctdi32']:
         copy_common_files()
         copy_fan_file()
-        commands = plugsgenerator(tag, rundatadir, topas_application_path)
-        with mp.Pool(pool_size) as pool:
-            pool.map_async(run_topas, commands)
-            pool.close()
-            pool.join()
-        run_status = "CTDI simulation completed"
+        jobs = plugsgenerator(tag, rundatadir, topas_application_path, priority=priority, tmp_dir=tmp_dir,
+                              single_process=ctdi_single_process)
+        allocation = _allocate_histories(history_allocation, tmp_dir, rundatadir, phantom_file=os.path.join(
+            tmp_dir, 'CTDIphantom_16.txt' if tag == 'ctdi16' else 'CTDIphantom_32.txt'))
+        if isinstance(allocation, str):
+            return allocation
+        if phase_space is not None:
+            error = _use_phase_space(jobs, tmp_dir, rundatadir, topas_application_path, phase_space, priority)
+            if error:
+                return error
+        cache = _cache_lookup(rundatadir, jobs, topas_application_path, shards, adaptive, use_cache, arcs,
+                              ctdi_single_process)
+        if cache['hit']:
+            exit_codes = [0] * len(jobs)
+        else:
+            exit_codes = _run_jobs(scheduler, jobs, topas_application_path, priority, shards, adaptive, CtdiwMetric(),
+                                   arcs, allocation)
+        run_status = _run_status("CTDI simulation completed", exit_codes)
+        if not any(exit_codes) and (not cache['hit'] or cache['exposure_scale'] != 1.):
+            # dose_results.csv / dose_results.json from the plug scorers, calibrated for the exposure of this run
+            process_ctdi_run(rundatadir, single_process_material=ctdi_single_process)
 
     else:
-        run_status = 'Error encountered'
+        return 'Error encountered'
 
+    if not cache['hit'] and cache['key'] is not None and not any(exit_codes):
+        store_run(cache['key'], rundatadir, cache['inputs'], factor=cache['factor'],
+                  parameter_files=cache['parameter_files'])
+    if tag in ['ctdi16', 'ctdi32']:
+        # written after the run is keyed and stored, the estimate depends on the exposure and is not a cached output
+        _write_ctdi_estimate(tmp_dir, tag, rundatadir)
+    if cache['hit']:
+        scale = cache['exposure_scale']
+        rescaled = '' if scale == 1. else ', exposure scaled by ' + format(scale, '.4g')
+        return run_status + ' (cached result of ' + cache['hit']['rundatadir'] + rescaled + ')'
     return run_status
 
+def _write_ctdi_estimate(tmp_dir: str, tag: str, rundatadir: str) -> Optional[str]:
+    """Writes ctdi_estimate.json with the deterministic estimate of the run compared to its dose_results.json, None
+    when the rendered files can not be estimated (the estimate is a check and never fails a run)."""
+    phantom_file = os.path.join(tmp_dir, 'CTDIphantom_16.txt' if tag == 'ctdi16' else 'CTDIphantom_32.txt')
+    try:
+        estimate = estimate_ctdi(os.path.join(tmp_dir, 'headsourcecode.txt'), phantom_file)
+    except (OSError, ValueError, KeyError):
+        return None
+    return write_estimate(estimate, rundatadir)
+
+def _allocate_histories(settings: Optional[HistoryAllocationSettings], tmp_dir: str, rundatadir: str,
+                        phantom_file: Optional[str] = None, patient_file: Optional[str] = None):
+    """Writes the history allocation of the run into its folder before it is keyed. Returns the HistoryAllocation,
+    None without settings, or an error status when the rendered files can not be allocated."""
+    if settings is None:
+        return None
+    try:
+        return prepare_history_allocation(os.path.join(tmp_dir, 'headsourcecode.txt'), rundatadir, settings,
+                                          phantom_file, patient_file)
+    except (OSError, ValueError, KeyError) as error:
+        return 'Error encountered: ' + str(error)
+
+def _use_phase_space(jobs: List[TopasJob], tmp_dir: str, rundatadir: str, topas_application_path: str,
+                     phase_space: PhaseSpaceSettings, priority: int) -> Optional[str]:
+    """Turns the run files into phase space runs, returns an error status when the head-only run fails."""
+    try:
+        prepare_phase_space_runs([job.command[-1] for job in jobs], os.path.join(tmp_dir, 'headsourcecode.txt'),
+                                 rundatadir, topas_application_path, phase_space, priority=priority)
+    except RuntimeError as error:
+        return 'Error encountered: ' + str(error)
+    return None
+
+def _cache_lookup(rundatadir: str, jobs: List[TopasJob], topas_application_path: str, shards: int,
+                  adaptive: Optional[AdaptiveTarget], use_cache: bool, arcs: int = 1,
+                  ctdi_single_process: Optional[str] = None) -> Dict[str, object]:
+    """Keys the prepared run folder and restores the outputs of a cached run with the same key, scaled to the exposure
+    of this run when the cached run had another one. Single process CTDI runs are keyed on their plug material, they
+    never share an entry with the per-position layout."""
+    if not use_cache:
+        return {'key': None, 'inputs': None, 'hit': None, 'factor': None, 'exposure_scale': 1., 'parameter_files': None}
+    run_options = {'shards': shards, 'adaptive': None if adaptive is None else adaptive._asdict()}
+    if arcs > 1:
+        run_options['arcs'] = arcs # keys of unsplit runs stay as before
+    if ctdi_single_process is not None:
+        run_options['ctdi_single_process'] = ctdi_single_process
+    parameter_files = [job.command[-1] for job in jobs]
+    key = run_cache_key(rundatadir, parameter_files, topas_application_path, run_options)
+    inputs = snapshot_files(rundatadir)
+    factor = calibration_factor(rundatadir)
+    entry = lookup_run(key)
+    scale = 1.
+    if entry is not None:
+        scale = exposure_scale(entry, factor)
+        restore_run(entry, rundatadir, scale)
+    return {'key': key, 'inputs': inputs, 'hit': entry, 'factor': factor, 'exposure_scale': scale,
+            'parameter_files': parameter_files}
+
+def _run_jobs(scheduler, jobs: List[TopasJob], topas_application_path: str, priority: int, shards: int,
+              adaptive: Optional[AdaptiveTarget] = None, metric=None, arcs: int = 1,
+              allocation: Optional[HistoryAllocation] = None) -> List[int]:
+    if allocation is not None:
+        parameter_files = [job.command[-1] for job in jobs]
+        merged = run_arcs(parameter_files, topas_application_path, len(allocation.segments), shards=shards,
+                          scheduler=scheduler, priority=priority, allocation=list(allocation.segments))
+        return [0 if parameter_file in merged else 1 for parameter_file in parameter_files]
+    if arcs > 1:
+        parameter_files = [job.command[-1] for job in jobs]
+        merged = run_arcs(parameter_files, topas_application_path, arcs, shards=shards, scheduler=scheduler,
+                          priority=priority)
+        return [0 if parameter_file in merged else 1 for parameter_file in parameter_files]
+    if adaptive is not None:
+        report = run_adaptive([job.command[-1] for job in jobs], topas_application_path, adaptive, metric,
+                              scheduler=scheduler, priority=priority)
+        return [1 if report['stop_reason'] == 'failed' else 0] * len(jobs)
+    if shards <= 1:
+        return wait_for_jobs([scheduler.submit(job) for job in jobs])
+    parameter_files = [job.command[-1] for job in jobs]
+    merged = run_sharded(parameter_files, topas_application_path, shards, scheduler=scheduler, priority=priority)
+    return [0 if parameter_file in merged else 1 for parameter_file in parameter_files]
+
+def _run_status(completed_message: str, exit_codes: List[int]) -> str:
+    failed = sum(1 for code in exit_codes if code != 0)
+    if failed:
+        return completed_message + ' with ' + str(failed) + ' of ' + str(len(exit_codes)) + ' TOPAS runs failing'
+    return completed_message
+
 if __name__ == "__main__":
     pass
     
\ No newline at end of file
@@ -0,0 +1,238 @@
+# History sharding: one TOPAS run is split into K independent runs (shards) that share the requested histories.
+# Every shard gets its own i:Ts/Seed from a SeedStream and writes its scorer outputs under a _shardNN suffix, the shards
+# then run concurrently through the JobScheduler and their outputs are merged into the file names of the original run.
+# The state of every shard is kept in a manifest next to the shard files, so when a shard dies only that shard is rerun.
+import os
+import json
+from concurrent.futures import Future
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from src.dose_summation import sum_dose_grids
+from src.job_scheduler import JobScheduler, get_scheduler, parameter_file_job, wait_for_jobs
+from src.topas_outputs import merge_topas_csv, scorer_output_files
+from src.topas_parameters import TopasParameterFile, chain_value, find_scorers, load_parameter_chain
+
+MAX_TOPAS_SEED = 2 ** 31 - 1
+# Reports needed to merge CSV outputs of independent runs with the pooled variance
+MERGEABLE_REPORT = '3 "Sum" "Mean" "Standard_Deviation"'
+
+
+class SeedStream:
+    """Deterministic stream of distinct TOPAS seeds derived from one base seed.
+
+    Seed n of the stream is drawn from numpy's SeedSequence with spawn key n, so the same base seed always gives the
+    same stream and later batches (eg. a resumed or adaptive run) continue it from the stored position.
+
+    Args:
+        base_seed (int): Seed of the original run.
+        position (int): Number of seeds already taken from the stream.
+    """
+
+    def __init__(self, base_seed: int, position: int = 0):
+        self.base_seed = int(base_seed)
+        self.position = int(position)
+        self._issued = set()
+
+    def take(self, count: int) -> List[int]:
+        seeds = []
+        while len(seeds) < count:
+            state = np.random.SeedSequence(self.base_seed, spawn_key=(self.position,)).generate_state(1)[0]
+            self.position += 1
+            seed = int(state) % MAX_TOPAS_SEED + 1
+            if seed in self._issued:
+                continue # never hand out the same seed twice
+            self._issued.add(seed)
+            seeds.append(seed)
+        return seeds
+
+
+def split_histories(histories: int, shards: int) -> List[int]:
+    """Splits histories over shards as evenly as possible, shards that would get no history are dropped."""
+    base, remainder = divmod(int(histories), int(shards))
+    counts = [base + 1 if shard < remainder else base for shard in range(shards)]
+    return [count for count in counts if count > 0]
+
+
+def histories_per_run_count(chain: List[TopasParameterFile]) -> Tuple[int, int]:
+    """Histories per run and number of runs (sequential times) of a parameter chain."""
+    histories = int(chain_value(chain, 'So/beam/NumberOfHistoriesInRun', '0').split()[0])
+    runs = int(chain_value(chain, 'Tf/NumberOfSequentialTimes', '1').split()[0])
+    return histories, max(runs, 1)
+
+
+def render_seeded_copy(template: TopasParameterFile, scorers: Dict[str, Dict[str, str]], parameter_file: str,
+                       suffix: str, seed: int, histories_per_run: int, threads: Optional[int] = None) -> Dict[str, object]:
+    """Writes a copy of the template next to parameter_file with its own seed, histories per run and scorer outputs.
+
+    The copy and its scorer outputs get suffix (eg. _shard03) after their original names, CSV scorers are set to
+    report Sum, Mean and Standard_Deviation so the copies can be merged with the pooled variance.
+
+    Returns:
+        Dict[str, object]: 'file', 'seed', 'histories' (per run), 'outputs' (scorer -> output name) and 'exit_code'.
+    """
+    changes = {'i:Ts/Seed': str(seed), 'i:So/beam/NumberOfHistoriesInRun': str(histories_per_run)}
+    if threads is not None:
+        changes['i:Ts/NumberOfThreads'] = str(threads)
+    copy = template.copy()
+    for name, value in changes.items():
+        copy.set(name, value, parameter_type=name.split(':')[0])
+    outputs = {}
+    for scorer, settings in scorers.items():
+        outputs[scorer] = settings['output_file'] + suffix
+        # parameter_type given so scorers defined in an includeFile are overridden from the copy
+        copy.set('s:Sc/' + scorer + '/OutputFile', '"' + outputs[scorer] + '"', parameter_type='s')
+        if settings['output_type'] == 'csv':
+            copy.set('sv:Sc/' + scorer + '/Report', MERGEABLE_REPORT, parameter_type='sv')
+    copy_file = os.path.splitext(parameter_file)[0] + suffix + '.txt'
+    copy.write(copy_file)
+    return {'file': copy_file, 'seed': seed, 'histories': histories_per_run, 'outputs': outputs, 'exit_code': None}
+
+
+def render_shards(parameter_file: str, shards: int, seed_stream: SeedStream,
+                  threads_per_shard: Optional[int] = None) -> Dict[str, object]:
+    """Writes the shard parameter files next to parameter_file and returns the manifest describing them.
+
+    Each shard gets its share of So/beam/NumberOfHistoriesInRun (per run, so time features keep their timeline), a seed
+    from the stream, and _shardNN scorer output names. CSV scorers are set to report Sum, Mean and Standard_Deviation
+    so the shards can be merged with the pooled variance.
+
+    Args:
+        parameter_file (str): Rendered run file (eg. headsourcecode.txt or a CTDI plug file).
+        shards (int): Number of shards.
+        seed_stream (SeedStream): Source of the shard seeds.
+        threads_per_shard (int, optional): Overrides i:Ts/NumberOfThreads of every shard.
+    """
+    chain = load_parameter_chain(parameter_file)
+    template = chain[0]
+    histories, runs = histories_per_run_count(chain)
+    scorers = find_scorers(chain)
+
+    manifest = {'parameter_file': parameter_file, 'base_seed': seed_stream.base_seed, 'runs': runs,
+                'scorers': scorers, 'shards': []}
+    shard_histories = split_histories(histories, shards)
+    for index, (shard_history, seed) in enumerate(zip(shard_histories, seed_stream.take(len(shard_histories)))):
+        shard = render_seeded_copy(template, scorers, parameter_file, '_shard' + format(index, '02d'), seed,
+                                   shard_history, threads_per_shard)
+        shard['histories'] *= runs
+        manifest['shards'].append(shard)
+    manifest['seed_position'] = seed_stream.position
+    return manifest
+
+
+def manifest_path_for(parameter_file: str) -> str:
+    return os.path.splitext(parameter_file)[0] + '_shards.json'
+
+
+def save_manifest(manifest: Dict[str, object]) -> str:
+    manifest_path = manifest_path_for(manifest['parameter_file'])
+    with open(manifest_path, 'w') as f:
+        json.dump(manifest, f, indent=2)
+    return manifest_path
+
+
+def load_manifest(manifest_path: str) -> Dict[str, object]:
+    with open(manifest_path, 'r') as f:
+        return json.load(f)
+
+
+def submit_pending_shards(manifest: Dict[str, object], topas_application_path: str,
+                          scheduler: Optional[JobScheduler] = None, priority: int = 0) -> List[Tuple[int, Future]]:
+    """Submits every shard that has not finished successfully, returns (shard index, future) pairs."""
+    scheduler = scheduler or get_scheduler()
+    rundatadir = os.path.dirname(os.path.abspath(manifest['parameter_file']))
+    submitted = []
+    for index, shard in enumerate(manifest['shards']):
+        if shard['exit_code'] == 0:
+            continue
+        job = parameter_file_job(topas_application_path, shard['file'], rundatadir, priority)
+        submitted.append((index, scheduler.submit(job)))
+    return submitted
+
+
+def record_shard_results(manifest: Dict[str, object], submitted: List[Tuple[int, Future]]) -> List[int]:
+    """Waits for submitted shards, stores their exit codes in the manifest and returns the indices of failed shards."""
+    exit_codes = wait_for_jobs([future for _, future in submitted])
+    for (index, _), exit_code in zip(submitted, exit_codes):
+        manifest['shards'][index]['exit_code'] = exit_code
+    save_manifest(manifest)
+    return [index for index, shard in enumerate(manifest['shards']) if shard['exit_code'] != 0]
+
+
+def merge_shards(manifest: Dict[str, object]) -> Dict[str, str]:
+    """Merges the outputs of all shards into the output names of the original run.
+
+    CSV outputs are merged with the pooled statistics of topas_outputs.merge_topas_csv. DICOM dose outputs are summed
+    with dose_summation.sum_dose_grids, which also writes the standard error from the spread of the shards.
+
+    Returns:
+        Dict[str, str]: Scorer name to merged output file.
+
+    Raises:
+        RuntimeError: If a shard has not finished successfully, rerun it with submit_pending_shards first.
+    """
+    failed = [shard['file'] for shard in manifest['shards'] if shard['exit_code'] != 0]
+    if failed:
+        raise RuntimeError('Shards not finished: ' + ', '.join(failed))
+    rundatadir = os.path.dirname(os.path.abspath(manifest['parameter_file']))
+    histories = [shard['histories'] for shard in manifest['shards']]
+    merged = {}
+    for scorer, settings in manifest['scorers'].items():
+        shard_files = [scorer_output_files(rundatadir, shard['outputs'][scorer]) for shard in manifest['shards']]
+        if not all(shard_files):
+            continue # scorer wrote nothing, eg. a disabled component
+        extension = os.path.splitext(shard_files[0][0])[1]
+        output_filepath = os.path.join(rundatadir, settings['output_file'] + extension)
+        if extension == '.csv':
+            merge_topas_csv([files[0] for files in shard_files], histories, output_filepath)
+        elif extension == '.dcm':
+            sum_dose_grids([files[0] for files in shard_files], output_filepath, histories, replicates=True)
+        else:
+            continue # binary/root outputs are left per shard
+        merged[scorer] = output_filepath
+    return merged
+
+
+def run_sharded(parameter_files: List[str], topas_application_path: str, shards: int,
+                base_seed: Optional[int] = None, threads_per_shard: Optional[int] = None,
+                scheduler: Optional[JobScheduler] = None, priority: int = 0) -> Dict[str, Dict[str, str]]:
+    """Shards every parameter file, runs all shards concurrently and merges the outputs of each file.
+
+    Args:
+        parameter_files (List[str]): Rendered run files in their run folder.
+        topas_application_path (str): TOPAS executable.
+        shards (int): Number of shards per parameter file.
+        base_seed (int, optional): Start of the seed stream, defaults to the i:Ts/Seed of each file.
+        threads_per_shard (int, optional): Overrides i:Ts/NumberOfThreads of the shards.
+        scheduler (JobScheduler, optional): Defaults to the shared scheduler.
+        priority (int): Queue priority of the shards.
+
+    Returns:
+        Dict[str, Dict[str, str]]: Parameter file to its merged outputs (see merge_shards). Files with failed shards
+        are left out, their manifests can be resumed with resume_sharded.
+    """
+    manifests, submitted = [], []
+    for parameter_file in parameter_files:
+        seed = base_seed if base_seed is not None else int(
+            chain_value(load_parameter_chain(parameter_file), 'Ts/Seed', '1').split()[0])
+        manifest = render_shards(parameter_file, shards, SeedStream(seed), threads_per_shard)
+        save_manifest(manifest)
+        manifests.append(manifest)
+        submitted.append(submit_pending_shards(manifest, topas_application_path, scheduler, priority))
+
+    merged = {}
+    for manifest, manifest_jobs in zip(manifests, submitted):
+        if not record_shard_results(manifest, manifest_jobs):
+            merged[manifest['parameter_file']] = merge_shards(manifest)
+    return merged
+
+
+def resume_sharded(manifest_path: str, topas_application_path: str, scheduler: Optional[JobScheduler] = None,
+                   priority: int = 0) -> Optional[Dict[str, str]]:
+    """Reruns the unfinished shards of a manifest and merges when all shards are done, None if some still fail."""
+    manifest = load_manifest(manifest_path)
+    submitted = submit_pending_shards(manifest, topas_application_path, scheduler, priority)
+    if record_shard_results(manifest, submitted):
+        return None
+    return merge_shards(manifest)
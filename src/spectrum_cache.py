@@ -0,0 +1,90 @@
+# On-disk cache for the spekpy beam spectra used by Energyspectrum.py.
+# Every protocol in imaging_modes_lookup only uses a handful of kVp values, so the spectra are generated once and
+# stored as .npz files named by a hash of everything that goes into the spekpy model. The exposure (mAs) is not part of
+# the key as the fluence scales linearly with it, spectra are stored per 1 mAs and scaled by the caller.
+# The number of cached spectra is capped, the least recently used files are removed first.
+import os
+import json
+import hashlib
+import zipfile
+from typing import Dict, Optional, Sequence, Tuple
+
+import numpy as np
+
+
+def spectrum_cache_key(
+        anode_voltage: float,
+        target_angle: float,
+        energy_bin: float,
+        filtration: Sequence[Tuple[str, float]],
+        spekpy_version: str,
+        distance: float
+    ) -> str:
+    """Builds the content address of a spectrum from the inputs of the spekpy model.
+
+    Args:
+        anode_voltage (float): Tube voltage in kV.
+        target_angle (float): Anode angle in degrees.
+        energy_bin (float): Energy bin width (dk) in keV.
+        filtration (Sequence[Tuple[str, float]]): Filters applied to the spectrum as (material, thickness in mm) pairs.
+        spekpy_version (str): Version string of spekpy, a new version may change the physics data.
+        distance (float): Distance (z) at which the fluence is evaluated in cm.
+
+    Returns:
+        str: sha256 hex digest used as the cache file name.
+    """
+    description = json.dumps({
+        'kvp': float(anode_voltage),
+        'th': float(target_angle),
+        'dk': float(energy_bin),
+        'z': float(distance),
+        'filtration': [[str(material), float(thickness)] for material, thickness in filtration],
+        'spekpy': str(spekpy_version),
+    }, sort_keys=True)
+    return hashlib.sha256(description.encode('utf-8')).hexdigest()
+
+
+def load_cached_spectrum(cache_dir: str, key: str) -> Optional[Dict[str, np.ndarray]]:
+    """Returns the cached spectrum for key, or None on a cache miss.
+
+    A hit refreshes the modification time of the file so that the eviction order is least recently used.
+    Unreadable files (eg. from an interrupted write) are removed and treated as a miss.
+    """
+    cache_file = os.path.join(cache_dir, key + '.npz')
+    if not os.path.isfile(cache_file):
+        return None
+    try:
+        with np.load(cache_file) as data:
+            spectrum = {name: data[name] for name in data.files}
+    except (OSError, ValueError, zipfile.BadZipFile):
+        os.remove(cache_file)
+        return None
+    os.utime(cache_file)
+    return spectrum
+
+
+def store_cached_spectrum(cache_dir: str, key: str, spectrum: Dict[str, np.ndarray], max_entries: int) -> None:
+    """Writes a spectrum to the cache and evicts the least recently used entries above max_entries.
+
+    The file is written under a temporary name and renamed into place so that concurrent runs never read a partial file.
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    cache_file = os.path.join(cache_dir, key + '.npz')
+    partial_file = cache_file + '.' + str(os.getpid()) + '.tmp'
+    with open(partial_file, 'wb') as f:
+        np.savez(f, **spectrum)
+    os.replace(partial_file, cache_file)
+    evict_spectrum_cache(cache_dir, max_entries)
+
+
+def evict_spectrum_cache(cache_dir: str, max_entries: int) -> None:
+    """Removes the least recently used spectra until at most max_entries are left."""
+    if not os.path.isdir(cache_dir):
+        return
+    cache_files = [os.path.join(cache_dir, name) for name in os.listdir(cache_dir) if name.endswith('.npz')]
+    cache_files.sort(key=os.path.getmtime, reverse=True)
+    for stale_file in cache_files[max(max_entries, 0):]:
+        try:
+            os.remove(stale_file)
+        except FileNotFoundError:
+            pass # already evicted by another run
@@ -0,0 +1,161 @@
+# Readers, writers and statistics for the files written by TOPAS scorers.
+# CSV scorers write a block of '#' header lines followed by one row per bin: the bin indices (x, y, z or r, phi, z)
+# and one column per reported statistic, eg. "# DoseToMaterial ( Gy ) : Sum   Mean   Standard_Deviation".
+# Mean and Standard_Deviation are per history statistics, so outputs of independent runs of the same scorer can be
+# merged exactly if the number of histories of each run is known.
+import os
+from typing import Dict, List, Optional
+
+import numpy as np
+
+INDEX_COLUMNS = 3
+# Reports recomputed by pooled_statistics, lower case report name -> key of the pooled dictionary
+_POOLED_REPORTS = {'sum': 'Sum', 'mean': 'Mean', 'standard_deviation': 'Standard_Deviation', 'variance': 'Variance'}
+
+
+def read_topas_csv(filepath: str) -> Dict[str, object]:
+    """Reads a TOPAS CSV scorer output.
+
+    Returns:
+        Dict[str, object]: 'header' (list of header lines), 'quantity' (text left of the ':' in the last header line),
+        'reports' (names of the reported statistics), 'bins' (int array, one row of indices per bin) and 'values'
+        (float array, one column per report).
+    """
+    header = []
+    with open(filepath, 'r') as f:
+        for line in f:
+            if not line.startswith('#'):
+                break
+            header.append(line.rstrip('\n'))
+    quantity, reports = '', ['Sum']
+    if header and ':' in header[-1]:
+        quantity, report_names = header[-1][1:].rsplit(':', 1)
+        reports = report_names.split()
+        quantity = quantity.strip()
+    data = np.loadtxt(filepath, delimiter=',', comments='#', ndmin=2)
+    return {
+        'header': header,
+        'quantity': quantity,
+        'reports': reports,
+        'bins': data[:, :INDEX_COLUMNS].astype(int),
+        'values': data[:, INDEX_COLUMNS:],
+    }
+
+
+def write_topas_csv(filepath: str, scorer: Dict[str, object]) -> None:
+    """Writes a scorer dictionary (as returned by read_topas_csv) back in the TOPAS CSV layout."""
+    header = list(scorer['header'])
+    report_line = '# ' + scorer['quantity'] + ' : ' + '   '.join(scorer['reports']) + '   '
+    if header and ':' in header[-1]:
+        header[-1] = report_line
+    else:
+        header.append(report_line)
+    rows = np.column_stack((scorer['bins'], scorer['values']))
+    row_format = ', '.join(['%d'] * INDEX_COLUMNS + ['%.10g'] * scorer['values'].shape[1])
+    with open(filepath, 'w') as f:
+        f.write('\n'.join(header) + '\n')
+        np.savetxt(f, rows, fmt=row_format)
+
+
+def report_column(scorer: Dict[str, object], report: str) -> Optional[np.ndarray]:
+    """Values of one reported statistic (case insensitive), or None when the scorer does not report it."""
+    names = [name.lower() for name in scorer['reports']]
+    if report.lower() not in names:
+        return None
+    return scorer['values'][:, names.index(report.lower())]
+
+
+def pooled_statistics(sums: List[np.ndarray], histories: List[int],
+                      standard_deviations: Optional[List[np.ndarray]] = None) -> Dict[str, np.ndarray]:
+    """Combines per history statistics of independent runs.
+
+    With N = sum(N_k) and the run means m_k = Sum_k / N_k, the pooled mean is m = sum(Sum_k) / N and the pooled
+    variance is (sum((N_k - 1) s_k^2 + N_k (m_k - m)^2)) / (N - 1), s_k being the sample standard deviation of run k.
+
+    Returns:
+        Dict[str, np.ndarray]: 'Sum', 'Mean' and, when standard deviations are given, 'Variance' and 'Standard_Deviation'.
+    """
+    counts = np.asarray(histories, dtype=float)
+    total_histories = counts.sum()
+    stacked_sums = np.stack(sums)
+    total = stacked_sums.sum(axis=0)
+    mean = total / total_histories
+    pooled = {'Sum': total, 'Mean': mean}
+    if standard_deviations is not None:
+        run_means = stacked_sums / counts[:, None]
+        squared_deviations = np.stack(standard_deviations) ** 2
+        m2 = ((counts[:, None] - 1) * squared_deviations + counts[:, None] * (run_means - mean) ** 2).sum(axis=0)
+        pooled['Variance'] = m2 / max(total_histories - 1, 1)
+        pooled['Standard_Deviation'] = np.sqrt(pooled['Variance'])
+    return pooled
+
+
+def merge_topas_csv(filepaths: List[str], histories: List[int], output_filepath: str,
+                    weights: Optional[List[float]] = None) -> Dict[str, object]:
+    """Merges the CSV outputs of one scorer from independent runs (shards, batches or sub-arcs) into one file.
+
+    Sum, Mean, Standard_Deviation and Variance are pooled with pooled_statistics, Count_In_Bin and Histories are added,
+    Min and Max are taken over the runs. Other reports are dropped as they can not be merged from the outputs alone.
+
+    Args:
+        filepaths (List[str]): CSV output of every run.
+        histories (List[int]): Number of histories of every run.
+        output_filepath (str): Merged CSV file.
+        weights (List[float], optional): Statistical weight of the histories of every run (see history_allocation.py),
+            the values of a run are scaled by it before pooling.
+
+    Returns:
+        Dict[str, object]: The merged scorer, as read_topas_csv would return it.
+    """
+    runs = [read_topas_csv(filepath) for filepath in filepaths]
+    first = runs[0]
+    for filepath, run in zip(filepaths, runs):
+        if run['values'].shape != first['values'].shape or not np.array_equal(run['bins'], first['bins']):
+            raise ValueError(filepath + ' does not have the same binning as ' + filepaths[0])
+
+    sums = []
+    for run in runs:
+        run_sum = report_column(run, 'Sum')
+        if run_sum is None:
+            run_mean = report_column(run, 'Mean')
+            if run_mean is None:
+                raise ValueError('Scorer outputs need a Sum or Mean report to be merged')
+            run_sum = run_mean * histories[len(sums)]
+        sums.append(run_sum)
+    deviations = [report_column(run, 'Standard_Deviation') for run in runs]
+    if any(deviation is None for deviation in deviations):
+        variances = [report_column(run, 'Variance') for run in runs]
+        deviations = None if any(v is None for v in variances) else [np.sqrt(v) for v in variances]
+    weights = weights if weights is not None else [1.] * len(runs)
+    sums = [run_sum * weight for run_sum, weight in zip(sums, weights)]
+    if deviations is not None:
+        deviations = [deviation * weight for deviation, weight in zip(deviations, weights)]
+    pooled = pooled_statistics(sums, histories, deviations)
+
+    reports, columns = [], []
+    for report in first['reports']:
+        key = report.lower()
+        if _POOLED_REPORTS.get(key) in pooled:
+            column = pooled[_POOLED_REPORTS[key]]
+        elif key in ('count_in_bin', 'histories'):
+            column = np.sum([report_column(run, report) for run in runs], axis=0)
+        elif key == 'min':
+            column = np.min([report_column(run, report) * weight for run, weight in zip(runs, weights)], axis=0)
+        elif key == 'max':
+            column = np.max([report_column(run, report) * weight for run, weight in zip(runs, weights)], axis=0)
+        else:
+            continue
+        reports.append(report)
+        columns.append(column)
+
+    merged = dict(first)
+    merged['reports'] = reports
+    merged['values'] = np.column_stack(columns)
+    write_topas_csv(output_filepath, merged)
+    return merged
+
+
+def scorer_output_files(rundatadir: str, output_name: str) -> List[str]:
+    """Files written for a scorer OutputFile name in a run folder (TOPAS adds the extension for the output type)."""
+    return sorted(os.path.join(rundatadir, name) for name in os.listdir(rundatadir)
+                  if os.path.splitext(name)[0] == output_name)
@@ -0,0 +1,248 @@
+# Parsed model of a TOPAS parameter file, used to edit the boilerplates without rescanning the file for every edit.
+# The file is parsed once into its lines plus an index of parameter name -> line, lines that are not edited are written
+# back exactly as they were read (including comments and spacing). TOPAS parameter names are case insensitive so the
+# index is too. includeFile lines are tracked separately as a file may contain several of them.
+import os
+import re
+from typing import Dict, List, NamedTuple, Optional
+
+
+class TopasParameter(NamedTuple):
+    type: str # eg. 'd', 'dc', 'sv' ; empty when the line has no type prefix (eg. Ts/UseQt="True")
+    name: str # eg. 'Ge/Coll1/TransY'
+    value: str # everything right of the '=' without the comment, eg. '5.3 cm' or '"Lead"'
+    unit: str # last word of the value for dimensioned (d) parameters, otherwise empty
+    comment: str # trailing comment including the '#', empty when there is none
+
+
+_PARAMETER_LINE = re.compile(r'^(?P<lead>\s*)(?:(?P<type>[A-Za-z]+):)?(?P<name>[A-Za-z][\w/.\-]*)\s*=(?P<rest>.*?)(?P<newline>\r?\n?)$')
+_INCLUDE_NAME = 'includefile'
+_SCORER_QUANTITY = re.compile(r'^Sc/(?P<scorer>[^/]+)/Quantity$', re.IGNORECASE)
+UNIT_MM = {'um': 1e-3, 'mm': 1., 'cm': 10., 'm': 1000.}
+
+
+def _split_comment(text: str):
+    # '#' starts a comment unless it is inside a quoted string
+    in_quotes = False
+    for position, character in enumerate(text):
+        if character == '"':
+            in_quotes = not in_quotes
+        elif character == '#' and not in_quotes:
+            return text[:position], text[position:]
+    return text, ''
+
+
+def parse_parameter_line(line: str) -> Optional[TopasParameter]:
+    """Parses one line of a parameter file, returns None for comments, blank lines and anything that is not a parameter."""
+    match = _PARAMETER_LINE.match(line)
+    if match is None:
+        return None
+    value, comment = _split_comment(match.group('rest'))
+    value = value.strip()
+    parameter_type = (match.group('type') or '')
+    unit = ''
+    if parameter_type.lower().startswith('d'):
+        words = value.split()
+        if words and re.fullmatch(r'[A-Za-z][\w/]*', words[-1]):
+            unit = words[-1]
+    return TopasParameter(parameter_type, match.group('name'), value, unit, comment.rstrip())
+
+
+def _parameter_key(name: str) -> str:
+    # Accepts the name with or without its type prefix, 'dc:Ge/Coll1/TransY' and 'ge/coll1/transy' give the same key
+    if ':' in name:
+        name = name.split(':', 1)[1]
+    return name.strip().lower()
+
+
+class TopasParameterFile:
+    """Ordered, indexed view of a TOPAS parameter file.
+
+    get/set/delete are dictionary lookups on the parameter name. Deleted lines are dropped from the output, edited lines
+    keep their type prefix and trailing comment, and every other line is serialised byte for byte.
+    """
+
+    def __init__(self, lines: List[str]):
+        self._lines = list(lines)
+        self._index: Dict[str, int] = {}
+        self._includes: List[int] = []
+        for position, line in enumerate(self._lines):
+            self._index_line(position, line)
+
+    @classmethod
+    def from_file(cls, filepath: str) -> 'TopasParameterFile':
+        with open(filepath, 'r', newline='') as f:
+            return cls(f.readlines())
+
+    @classmethod
+    def from_text(cls, text: str) -> 'TopasParameterFile':
+        return cls(text.splitlines(keepends=True))
+
+    def _index_line(self, position: int, line: str) -> None:
+        parameter = parse_parameter_line(line)
+        if parameter is None:
+            return
+        key = _parameter_key(parameter.name)
+        if key == _INCLUDE_NAME:
+            self._includes.append(position)
+        elif key not in self._index:
+            # first definition wins, as with the previous line scan editing
+            self._index[key] = position
+
+    def copy(self) -> 'TopasParameterFile':
+        duplicate = TopasParameterFile.__new__(TopasParameterFile)
+        duplicate._lines = list(self._lines)
+        duplicate._index = dict(self._index)
+        duplicate._includes = list(self._includes)
+        return duplicate
+
+    def __contains__(self, name: str) -> bool:
+        return _parameter_key(name) in self._index
+
+    def names(self) -> List[str]:
+        """Parameter names in file order."""
+        return [parse_parameter_line(self._lines[position]).name for position in sorted(self._index.values())]
+
+    def get(self, name: str) -> Optional[TopasParameter]:
+        """Returns the parsed parameter, or None when it is not defined in this file."""
+        position = self._index.get(_parameter_key(name))
+        if position is None:
+            return None
+        return parse_parameter_line(self._lines[position])
+
+    def value(self, name: str, default: Optional[str] = None) -> Optional[str]:
+        """Returns the value string of a parameter (eg. '5.3 cm'), or default when it is not defined."""
+        parameter = self.get(name)
+        return default if parameter is None else parameter.value
+
+    def set(self, name: str, value: str, parameter_type: Optional[str] = None) -> None:
+        """Sets the value of a parameter.
+
+        An existing line keeps its type prefix and comment. A parameter that is not in the file is only appended at the
+        end when parameter_type is given, otherwise a KeyError is raised.
+        """
+        key = _parameter_key(name)
+        position = self._index.get(key)
+        if position is None:
+            if not parameter_type:
+                raise KeyError(name + ' is not defined in this file and no parameter type was given')
+            plain_name = name.split(':', 1)[1] if ':' in name else name
+            if self._lines and not self._lines[-1].endswith('\n'):
+                self._lines[-1] += '\n'
+            self._lines.append(parameter_type + ':' + plain_name + ' = ' + value + '\n')
+            self._index[key] = len(self._lines) - 1
+            return
+        line = self._lines[position]
+        match = _PARAMETER_LINE.match(line)
+        parameter = parse_parameter_line(line)
+        prefix = match.group('lead') + (parameter.type + ':' if parameter.type else '') + parameter.name
+        comment = ' ' + parameter.comment if parameter.comment else ''
+        self._lines[position] = prefix + ' = ' + value + comment + (match.group('newline') or '\n')
+
+    def delete(self, name: str) -> bool:
+        """Removes a parameter line, returns False when the parameter was not defined."""
+        position = self._index.pop(_parameter_key(name), None)
+        if position is None:
+            return False
+        self._lines[position] = ''
+        return True
+
+    def include_files(self) -> List[str]:
+        """Names of all included files, in file order."""
+        files = []
+        for position in self._includes:
+            parameter = parse_parameter_line(self._lines[position])
+            if parameter is not None:
+                files.extend(parameter.value.split())
+        return files
+
+    def add_include(self, filename: str) -> None:
+        """Adds an includeFile line after the last existing one (or at the top of the file)."""
+        if filename in self.include_files():
+            return
+        position = self._includes[-1] + 1 if self._includes else 0
+        self._lines.insert(position, 'includeFile = ' + filename + '\n')
+        # Shift the stored positions of every line after the inserted one
+        self._index = {key: line + 1 if line >= position else line for key, line in self._index.items()}
+        self._includes = [line + 1 if line >= position else line for line in self._includes] + [position]
+        self._includes.sort()
+
+    def remove_include(self, filename: str) -> bool:
+        """Removes a file from the includeFile lines, the line is dropped when no other file is left on it."""
+        for position in self._includes:
+            parameter = parse_parameter_line(self._lines[position])
+            if parameter is None or filename not in parameter.value.split():
+                continue
+            remaining = [name for name in parameter.value.split() if name != filename]
+            if remaining:
+                self._lines[position] = 'includeFile = ' + ' '.join(remaining) + '\n'
+            else:
+                self._lines[position] = ''
+            return True
+        return False
+
+    def render(self, changes: Dict[str, Optional[str]]) -> str:
+        """Returns the text of a copy of this file with changes applied, the file itself is not modified.
+
+        changes maps parameter names to new values, a value of None deletes the parameter. Meant for rendering many
+        configurations from one parsed template.
+        """
+        rendered = self.copy()
+        for name, value in changes.items():
+            if value is None:
+                rendered.delete(name)
+            else:
+                rendered.set(name, value)
+        return rendered.to_text()
+
+    def to_text(self) -> str:
+        return ''.join(self._lines)
+
+    def write(self, filepath: str) -> None:
+        with open(filepath, 'w', newline='') as f:
+            f.write(self.to_text())
+
+
+def length_mm(value: str) -> float:
+    """A length parameter value in mm, '-70.0 mm' -> -70., '6.175 cm' -> 61.75, without unit in mm."""
+    parts = value.split()
+    return float(parts[0]) * (UNIT_MM[parts[1]] if len(parts) > 1 else 1.)
+
+
+def load_parameter_chain(parameter_file: str) -> List[TopasParameterFile]:
+    """The parameter file followed by its includeFiles (recursively), in TOPAS lookup order."""
+    directory = os.path.dirname(os.path.abspath(parameter_file))
+    chain, pending, seen = [], [os.path.abspath(parameter_file)], set()
+    while pending:
+        filepath = pending.pop(0)
+        if filepath in seen or not os.path.isfile(filepath):
+            continue
+        seen.add(filepath)
+        parameters = TopasParameterFile.from_file(filepath)
+        chain.append(parameters)
+        pending.extend(os.path.join(directory, name) for name in parameters.include_files())
+    return chain
+
+
+def chain_value(chain: List[TopasParameterFile], name: str, default: Optional[str] = None) -> Optional[str]:
+    """Value of a parameter as TOPAS resolves it, the including file wins over the files it includes."""
+    for parameters in chain:
+        value = parameters.value(name)
+        if value is not None:
+            return value
+    return default
+
+
+def find_scorers(chain: List[TopasParameterFile]) -> Dict[str, Dict[str, str]]:
+    """Scorers defined in a parameter chain, with their output file name (without extension) and output type."""
+    scorers = {}
+    for parameters in chain:
+        for name in parameters.names():
+            match = _SCORER_QUANTITY.match(name)
+            if match is None or match.group('scorer') in scorers:
+                continue
+            scorer = match.group('scorer')
+            output_file = chain_value(chain, 'Sc/' + scorer + '/OutputFile', '"' + scorer + '"').strip('"')
+            output_type = chain_value(chain, 'Sc/' + scorer + '/OutputType', '"csv"').strip('"').lower()
+            scorers[scorer] = {'output_file': output_file, 'output_type': output_type}
+    return scorers
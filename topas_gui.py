@@ -1,7 +1,11 @@
 import os
 import FreeSimpleGUI as sg
 import shutil
-from pydicom import dcmread
+from src.dicom_index import ct_series_summary, plan_isocentre
+from src.ct_resampling import CtResampling
+from src.material_compaction import MaterialCompaction
+from src.phase_space import PhaseSpaceSettings
+from src.progress_monitor import format_progress, get_monitor
 from src.runtime_handler import log_output
 from src.edits_handler import editor
 from src.guilayers import *
@@ -59,6 +63,36 @@ def quantity_unit_stripper(string_value):
             unit = t
     return quantity , unit
 
+def index_dicom_folder(dicom_path):
+    '''
+    Runs in the background (window.perform_long_operation) so the GUI stays responsive while the headers are indexed.
+    Returns the CT summary of the folder from dicom_index.ct_series_summary, or the exception if the folder has no CT set of one patient.
+    '''
+    try:
+        return ct_series_summary(dicom_path)
+    except Exception as error:
+        return error
+
+def run_simulation(error_message, *args, **kwargs):
+    """
+    log_output in the background (window.perform_long_operation), so the window keeps handling the progress events of
+    the run. Returns the run status, or error_message when the run raised.
+    """
+    try:
+        return log_output(*args, **kwargs)
+    except Exception:
+        return error_message
+
+
+def phase_space_settings(values):
+    '''
+    Head phase space settings of a run when 'Reuse head phase space' is ticked, otherwise None.
+    The protocol label (imaging mode, direction and fan) is recorded with the phase space in the library.
+    '''
+    if not values['-PHASE_SPACE-']:
+        return None
+    return PhaseSpaceSettings(protocol=values['-IMAGEMODE-'] + ' ' + values['-DIRECTROT-'] + ' ' + values['-FAN-'])
+
 
 ####################################################################
 
@@ -89,7 +123,8 @@ layout = [[ sg.Text('Monte Carlo - Dose Calculation for Risk Evaluation', justif
                          sg.Tab('CTDI phantom menu' , chamber_layout, key= '-CTDI_TAB-', visible=False),
                          ]],
                          key='-TAB GROUP-' ,expand_x=True, expand_y=True),
-                        ]]
+                        ],
+          [sg.Text('', key='-PROGRESS-', expand_x=True)]]
 
 sg.set_options(scaling=1)
 window = sg.Window(title= "MC-DCaRE", layout=layout, finalize=True, auto_size_text=True, font = ('', 15))
@@ -99,6 +134,8 @@ path = os.getcwd()
 initiate = True
 reset_tmp()
 window["-G4FOLDERNAME-"].bind("<Return>","_ENTER") # for quick and dirty debuggin with G4 enter, remove for actual release
+# Progress of the TOPAS jobs is published from the threads running them, write_event_value hands it to this event loop
+get_monitor().subscribe(lambda job, aggregate: window.write_event_value('-RUN_PROGRESS-', format_progress(job, aggregate)))
 
 while True:
     event,values = window.read()
@@ -140,39 +177,35 @@ while True:
             
     if event == '-DICOM-':
         # Takes DICOM imageset location and checks it for CT images and pulls relevant data tags
-        count_of_CT_images = 0
-        try:    
-            DICOM_PATH = values['-DICOM-']
-            list_of_files = os.listdir(DICOM_PATH)
-            for files in list_of_files: 
-                if  dcmread(os.path.join(DICOM_PATH,files)).Modality == 'CT':
-                    if count_of_CT_images == 0:
-                        count_of_CT_images += 1
-                        patient_ID = dcmread(os.path.join(DICOM_PATH,files)).PatientID
-                    elif count_of_CT_images != 0 : 
-                        if dcmread(os.path.join(DICOM_PATH,files)).PatientID == patient_ID:
-                            count_of_CT_images += 1
-                        else:
-                            raise 
+        # Only the headers are read, in parallel and in the background, the index of the folder is saved so reopening it is instant
+        window.perform_long_operation(lambda dicom_path=values['-DICOM-']: index_dicom_folder(dicom_path), '-DICOM_INDEXED-')
+
+    if event == '-DICOM_INDEXED-':
+        ct_summary = values['-DICOM_INDEXED-']
+        if isinstance(ct_summary, Exception):
+            sg.popup_error("No CT images found in the folder or more than 1 patient file found")
+        else:
+            patient_ID = ct_summary['patient_id']
             values['-PATID-'] = patient_ID
             window['-PATID-'].update(values['-PATID-'])
-            sg.popup("Number of " + patient_ID + " CT images found" , count_of_CT_images , auto_close= True, non_blocking=True)
-        except: 
-            sg.popup_error("No CT images found in the folder or more than 1 patient file found")
+            sg.popup("Number of " + patient_ID + " CT images found" , ct_summary['images'] , auto_close= True, non_blocking=True)
 
     if event == '-DICOMRP-':
         # Takes DICOM RT plan and checks patientID match and pulls out isocentre data. 
-        if dcmread(values['-DICOMRP-']).PatientID == values['-PATID-']: 
-            try:    
-                isocentre_coors = dcmread(values['-DICOMRP-']).BeamSequence[0].ControlPointSequence[0].IsocenterPosition
-                values['-DICOM_ISOX-'] = str(round(isocentre_coors[0], 5)) + ' mm' #figure out how to get units form dicom 
-                values['-DICOM_ISOY-'] = str(round(isocentre_coors[1], 5)) + ' mm'
-                values['-DICOM_ISOZ-'] = str(round(isocentre_coors[2], 5)) + ' mm'
-                window['-DICOM_ISOX-'].update(values['-DICOM_ISOX-'])
-                window['-DICOM_ISOY-'].update(values['-DICOM_ISOY-'])
-                window['-DICOM_ISOZ-'].update(values['-DICOM_ISOZ-'])
-            except: 
-                sg.popup_error("No isocentre found")
+        try:
+            plan = plan_isocentre(values['-DICOMRP-'])
+        except (OSError, ValueError):
+            plan = None
+        if plan is None:
+            sg.popup_error("No isocentre found")
+        elif plan['patient_id'] == values['-PATID-']: 
+            isocentre_coors = plan['isocentre']
+            values['-DICOM_ISOX-'] = str(round(isocentre_coors[0], 5)) + ' mm' #figure out how to get units form dicom 
+            values['-DICOM_ISOY-'] = str(round(isocentre_coors[1], 5)) + ' mm'
+            values['-DICOM_ISOZ-'] = str(round(isocentre_coors[2], 5)) + ' mm'
+            window['-DICOM_ISOX-'].update(values['-DICOM_ISOX-'])
+            window['-DICOM_ISOY-'].update(values['-DICOM_ISOY-'])
+            window['-DICOM_ISOZ-'].update(values['-DICOM_ISOZ-'])
         else: 
             sg.popup_error('Patient ID for the CT image set and treatment plan does not match')        
 
@@ -189,9 +222,18 @@ while True:
             float_anode_voltage, unit_anode_voltage = quantity_unit_stripper(values['-IMAGEVOLTAGE-'])
             float_exposure, unit_exposure = quantity_unit_stripper(values['-EXPOSURE-'])
             generate_new_topas_beam_profile(float_anode_voltage, float_exposure, values['-HIST-'], path)
-            run_status = log_output(tmp_headsource_file_path, 'dicom', topas_application_path, values['-FAN-'])
-            reset_tmp()
-            sg.popup(run_status)
+            ct_resampling = None
+            if values['-DICOM_VOXEL-'].strip():
+                # Simulates the CT on coarser voxels, the resampled series is written into the run folder
+                voxel_text = values['-DICOM_VOXEL-'].split() # '2 mm', '0.3 cm' or '2' in mm
+                voxel_size = float(voxel_text[0]) * (10. if voxel_text[-1] == 'cm' else 1.)
+                ct_resampling = CtResampling(voxel_size, values['-DICOM_CROP-'])
+            material_compaction = MaterialCompaction() if values['-DICOM_COMPACT-'] else None
+            run_options = dict(ct_resampling=ct_resampling, material_compaction=material_compaction, phase_space=phase_space_settings(values))
+            window['-DICOM_RUN-'].update(disabled=True)
+            window['-CTDI_RUN-'].update(disabled=True)
+            run_args = (tmp_headsource_file_path, 'dicom', topas_application_path, values['-FAN-'])
+            window.perform_long_operation(lambda run_args=run_args, run_options=run_options: run_simulation("Ensure that you have specified a valid DICOM folder and file", *run_args, **run_options), '-RUN_DONE-')
         except:
             sg.popup_error("Ensure that you have specified a valid DICOM folder and file")
     
@@ -205,19 +247,30 @@ while True:
         float_anode_voltage, unit_anode_voltage = quantity_unit_stripper(values['-IMAGEVOLTAGE-'])
         float_exposure, unit_exposure = quantity_unit_stripper(values['-EXPOSURE-'])
         generate_new_topas_beam_profile(float_anode_voltage, float_exposure, values['-HIST-'], path)
+        phase_space = phase_space_settings(values)
 
         if values['-CTDI_PHANTOM-'] == '16 cm': 
             tmp_16cm_file_path = path + '/tmp/CTDIphantom_16.txt'
             editor(values, tmp_16cm_file_path, 'sub')
-            run_status = log_output(tmp_headsource_file_path, 'ctdi16', topas_application_path, values['-FAN-'])
-            reset_tmp()
-            sg.popup(run_status)        
+            phantom_tag = 'ctdi16'
         elif values['-CTDI_PHANTOM-'] == '32 cm': 
             tmp_32cm_file_path = path + '/tmp/CTDIphantom_32.txt'
             editor(values, tmp_32cm_file_path, 'sub')
-            run_status = log_output(tmp_headsource_file_path, 'ctdi32', topas_application_path, values['-FAN-'])
-            reset_tmp()
-            sg.popup(run_status)
+            phantom_tag = 'ctdi32'
+        window['-DICOM_RUN-'].update(disabled=True)
+        window['-CTDI_RUN-'].update(disabled=True)
+        run_args = (tmp_headsource_file_path, phantom_tag, topas_application_path, values['-FAN-'])
+        window.perform_long_operation(lambda run_args=run_args, phase_space=phase_space: run_simulation('Error encountered', *run_args, phase_space=phase_space), '-RUN_DONE-')
+
+    if event == '-RUN_PROGRESS-':
+        window['-PROGRESS-'].update(values['-RUN_PROGRESS-'])
+
+    if event == '-RUN_DONE-':
+        # the run thread has ended, the templates are reset for the next run as before
+        reset_tmp()
+        window['-DICOM_RUN-'].update(disabled=False)
+        window['-CTDI_RUN-'].update(disabled=False)
+        sg.popup(values['-RUN_DONE-'])
 
     if event == '-IMAGEMODE-' or event == '-DIRECTROT-':
         # When users select the image protocol, this block will run and input the imaging parameteres